@@ -0,0 +1,74 @@
+"""
+Micro-benchmark del despacho de mensajes a esperas (response_waiters).
+
+Compara el recorrido lineal anterior de _on_new_message (copiar las claves y revisar
+cada espera, recalculando el nombre del bot remitente) con los índices por (ruta, DNI)
+de _find_waiters_for_message (ruta = cuenta principal y bot), con 1, 100 y 1000 esperas simultáneas.
+
+Uso: python benchmarks/bench_dispatch.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+BOT = main.LEDERDATA_BOT_ID
+BOT_TELEGRAM_ID = 1001
+BOT_IDS = {main.LEDERDATA_BOT_ID: BOT_TELEGRAM_ID, main.LEDERDATA_BACKUP_BOT_ID: 1002}
+REPEAT = 2000
+ACCOUNT = main.accounts[0]["name"]
+
+
+def _fill_waiters(count: int):
+    """Registra 'count' esperas por DNI repartidas entre ambos bots."""
+    main.response_waiters.clear()
+    main._waiters_by_dni.clear()
+    main._waiters_without_dni.clear()
+    for i in range(count):
+        command_id = next(main._command_ids)
+        main._register_waiter(command_id, {
+            "dni": f"{10000000 + i}",
+            "sent_to_bot": main.ALL_BOT_IDS[i % len(main.ALL_BOT_IDS)],
+            "route": (ACCOUNT, main.ALL_BOT_IDS[i % len(main.ALL_BOT_IDS)]),
+            "messages": [],
+        })
+
+
+def _legacy_scan(sender_id: int, message_dni: str):
+    """Despacho anterior: recorrido lineal con búsqueda del nombre del bot en cada iteración."""
+    matched = []
+    for command_id in list(main.response_waiters.keys()):
+        waiter_data = main.response_waiters.get(command_id)
+        if not waiter_data:
+            continue
+        command_dni = waiter_data.get("dni")
+        dni_match = command_dni and command_dni == message_dni
+        sender_bot_name = next((name for name, id_ in BOT_IDS.items() if id_ == sender_id), None)
+        if sender_bot_name and sender_bot_name == waiter_data.get("sent_to_bot") and (dni_match or not command_dni):
+            matched.append(command_id)
+    return matched
+
+
+def _indexed_dispatch(sender_id: int, message_dni: str):
+    """Despacho actual: nombre del bot por diccionario y esperas por índice."""
+    sender_bot_name = main._bot_name_by_id.get(sender_id)
+    return main._find_waiters_for_message((ACCOUNT, sender_bot_name), message_dni)
+
+
+def run():
+    main._bot_name_by_id.update({id_: name for name, id_ in BOT_IDS.items()})
+    print(f"{'esperas':>8} {'lineal (µs)':>12} {'indexado (µs)':>14}")
+    for count in (1, 100, 1000):
+        _fill_waiters(count)
+        message_dni = "10000000" # Coincide con la primera espera (enviada a BOT)
+        with main._messages_lock:
+            legacy = timeit.timeit(lambda: _legacy_scan(BOT_TELEGRAM_ID, message_dni), number=REPEAT)
+            indexed = timeit.timeit(lambda: _indexed_dispatch(BOT_TELEGRAM_ID, message_dni), number=REPEAT)
+        print(f"{count:>8} {legacy / REPEAT * 1e6:>12.2f} {indexed / REPEAT * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,112 @@
+"""
+Micro-benchmark de la extracción de campos de los mensajes del bot.
+
+Compara clean_and_extract + _extract_data_for_save anteriores (patrones en línea, una búsqueda
+re.search por campo sobre el 'message' completo) con el motor de extracción actual (patrones
+compilados al importar y una sola pasada de 'clave : valor'), sobre el corpus de mensajes de
+benchmarks/bot_messages.json. Antes de medir verifica que ambos extraigan lo mismo.
+
+Uso: python benchmarks/bench_extract.py
+"""
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+REPEAT = 500
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot_messages.json")
+
+
+def _legacy_clean_and_extract(raw_text: str):
+    """clean_and_extract anterior (patrones en línea, tres re.search para los campos)."""
+    if not raw_text:
+        return {"text": "", "fields": {}, "page": None}
+    text = raw_text
+    page = None
+    page_match = re.search(r"Página\s*(\d+)\s*\/\s*(\d+)", raw_text, re.IGNORECASE)
+    if page_match:
+        page = [int(page_match.group(1)), int(page_match.group(2))]
+    text = re.sub(r"^\[\#LEDER\_BOT\]", "[CONSULTA PE]", text, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r"^\[.*?\]\s*→\s*.*?\[.*?\](\r?\n){1,2}", "", text, flags=re.IGNORECASE | re.DOTALL)
+    footer_pattern = r"((\r?\n){1,2}\[|Página\s*\d+\/\d+.*|(\r?\n){1,2}Por favor, usa el formato correcto.*|↞ Anterior|Siguiente ↠.*|Credits\s*:.+|Wanted for\s*:.+)"
+    text = re.sub(footer_pattern, "", text, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r"\-{3,}", "", text, flags=re.IGNORECASE | re.DOTALL)
+    text = text.strip()
+    fields = {}
+    dni_match = re.search(r"DNI\s*:\s*(\d{8})", text, re.IGNORECASE)
+    if dni_match: fields["dni"] = dni_match.group(1)
+    ruc_match = re.search(r"RUC\s*:\s*(\d{11})", text, re.IGNORECASE)
+    if ruc_match: fields["ruc"] = ruc_match.group(1)
+    photo_type_match = re.search(r"Foto\s*:\s*(rostro|huella|firma|adverso|reverso).*", text, re.IGNORECASE)
+    if photo_type_match: fields["photo_type"] = photo_type_match.group(1).lower()
+    return {"text": text, "fields": fields, "page": page}
+
+
+def _legacy_save_fields(message: str) -> dict:
+    """Las búsquedas que hacía _extract_data_for_save sobre el 'message' unido."""
+    found = {}
+    for key, pattern in (
+        ("razon_social", r"Razón Social\s*:\s*(.*)"), ("actividad", r"Actividad Principal\s*:\s*(.*)"),
+        ("nombres", r"Nombres\s*:\s*(.*)"), ("apellido_paterno", r"Apellido Paterno\s*:\s*(.*)"),
+        ("apellido_materno", r"Apellido Materno\s*:\s*(.*)"), ("fecha_emision", r"Fecha de Emisión\s*:\s*(\d{4}-\d{2}-\d{2})"),
+        ("operador", r"Operador\s*:\s*(.*)"), ("titular", r"Titular\s*:\s*(.*)"), ("nombre", r"Nombre\s*:\s*(.*)"),
+    ):
+        match = re.search(pattern, message)
+        if match:
+            found[key] = match.group(1).strip()
+    return found
+
+
+def _legacy_pipeline(corpus):
+    for sample in corpus:
+        cleaned = _legacy_clean_and_extract(sample["text"])
+        _legacy_save_fields(cleaned["text"])
+
+
+def _current_pipeline(corpus):
+    for sample in corpus:
+        cleaned = main.clean_and_extract(sample["text"])
+        main._extract_data_for_save(sample["command"], {"dni": cleaned["fields"].get("dni"), "fields": cleaned["fields"]})
+
+
+# Clave de 'fields' en la que el motor actual deja lo que encontraba cada búsqueda de _legacy_save_fields
+_SAVE_FIELD_KEYS = {"actividad": "actividad_principal", "fecha_emision": "fecha_de_emision"}
+
+
+def _check_equivalence(corpus):
+    """
+    El texto, la paginación y los campos canónicos no deben cambiar respecto a la versión anterior.
+    Lo que encontraban las búsquedas del guardado debe seguir apareciendo; ahora sin el resto de la
+    línea cuando venía otro par detrás ("CLARO | Titular : X" -> "CLARO").
+    """
+    for sample in corpus:
+        legacy = _legacy_clean_and_extract(sample["text"])
+        current = main.clean_and_extract(sample["text"])
+        assert legacy["text"] == current["text"], sample["command"]
+        assert legacy["page"] == current["page"], sample["command"]
+        for key, value in legacy["fields"].items():
+            assert current["fields"].get(key) == value, (sample["command"], key)
+        for key, value in _legacy_save_fields(legacy["text"]).items():
+            found = current["fields"].get(_SAVE_FIELD_KEYS.get(key, key))
+            assert found and value.startswith(found), (sample["command"], key, found)
+
+
+def run():
+    with open(CORPUS_FILE, encoding="utf-8") as f:
+        corpus = json.load(f)
+    _check_equivalence(corpus)
+    legacy = timeit.timeit(lambda: _legacy_pipeline(corpus), number=REPEAT)
+    current = timeit.timeit(lambda: _current_pipeline(corpus), number=REPEAT)
+    per_message = REPEAT * len(corpus)
+    print(f"{len(corpus)} mensajes x {REPEAT} repeticiones")
+    print(f"{'anterior (µs/msg)':>18} {'actual (µs/msg)':>16}")
+    print(f"{legacy / per_message * 1e6:>18.2f} {current / per_message * 1e6:>16.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,32 @@
+"""
+Configuración de gunicorn (se carga sola desde el directorio de trabajo).
+
+Con GATEWAY_ROLE=worker, el master de gunicorn lanza un único proceso broker
+(`python main.py` con GATEWAY_ROLE=broker) que es el dueño de la sesión de Telegram,
+y los workers HTTP (WEB_CONCURRENCY) le envían las consultas por el socket BROKER_SOCKET.
+En cualquier otro modo no hace nada y gunicorn se comporta como siempre.
+"""
+import os
+import subprocess
+import sys
+
+_broker = None
+
+
+def on_starting(server):
+    global _broker
+    if os.getenv("GATEWAY_ROLE", "standalone").lower() != "worker":
+        return
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    _broker = subprocess.Popen([sys.executable, main_path], env=dict(os.environ, GATEWAY_ROLE="broker"))
+    server.log.info("Broker de Telegram lanzado (pid %s)", _broker.pid)
+
+
+def on_exit(server):
+    if _broker is None or _broker.poll() is not None:
+        return
+    _broker.terminate()
+    try:
+        _broker.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        _broker.kill()
@@ -4,13 +4,31 @@ import asyncio
 import threading
 import traceback
 import time
+import json
+import itertools
+import copy
+import random
+import sqlite3
+import shutil
+import hashlib
+import base64
+import uuid
+import unicodedata
+import socket
+import ipaddress
 import requests # Necesario para hacer la llamada GET a la API de guardar
-from collections import deque
-from datetime import datetime, timezone, timedelta
-from urllib.parse import unquote, quote
-from flask import Flask, request, jsonify, send_from_directory
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import unquote, quote, urlsplit
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
-from telethon import TelegramClient, events, errors
+from aiohttp import web
+try:
+    from PIL import Image # Opcional: variantes de imagen en /files (?w=, ?format=webp)
+except ImportError:
+    Image = None
+from telethon import TelegramClient, events, errors, utils
 from telethon.sessions import StringSession
 from telethon.tl.types import PeerUser
 from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
@@ -27,6 +45,25 @@ PORT = int(os.getenv("PORT", 8080))
 
 DOWNLOAD_DIR = "downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+# Los archivos de /files no cambian nunca para un mismo nombre: se pueden cachear "para siempre"
+FILES_MAX_AGE = int(os.getenv("FILES_MAX_AGE", str(365 * 24 * 3600)))
+FILES_CACHE_CONTROL = f"public, max-age={FILES_MAX_AGE}, immutable"
+
+# Reparto en procesos, para correr gunicorn con varios workers sin duplicar la sesión de Telegram:
+# - "standalone": un solo proceso con HTTP y cliente de Telegram (comportamiento clásico).
+# - "broker": único proceso dueño del cliente de Telegram, las esperas, la caché y la salud de los bots.
+#   No sirve HTTP: atiende a los workers por el socket Unix BROKER_SOCKET.
+# - "worker": solo HTTP; cada operación de Telegram se le pide al broker (ver gunicorn.conf.py).
+GATEWAY_ROLE = os.getenv("GATEWAY_ROLE", "standalone").lower()
+BROKER_SOCKET = os.getenv("BROKER_SOCKET", "/tmp/telegram_gateway_broker.sock")
+BROKER_MAX_LINE = 16 * 1024 * 1024 # Tamaño máximo de una respuesta por IPC (una línea JSON)
+
+# Servidor HTTP al ejecutar 'python main.py':
+# - "flask": un hilo por petición, bloqueado en run_coro mientras espera al bot (compatibilidad;
+#   es también lo que sirve 'gunicorn main:app').
+# - "aiohttp": las mismas rutas servidas directamente en el bucle de Telethon; cada consulta en
+#   espera es una corrutina y no un hilo. Ej. en el Procfile: web: SERVER_MODE=aiohttp python main.py
+SERVER_MODE = os.getenv("SERVER_MODE", "flask").lower()
 
 # El chat ID/nombre del bot al que enviar los comandos (BOT PRINCIPAL)
 LEDERDATA_BOT_ID = "@LEDERDATA_OFC_BOT" 
@@ -34,8 +71,26 @@ LEDERDATA_BOT_ID = "@LEDERDATA_OFC_BOT"
 # El chat ID/nombre del bot de respaldo (NUEVO BOT)
 LEDERDATA_BACKUP_BOT_ID = "@lederdata_publico_bot"
 
+# Pool de bots. Por defecto el principal y el de respaldo, pero se pueden añadir bots sin tocar el código:
+# BOT_POOL='[{"id": "@LEDERDATA_OFC_BOT", "weight": 3}, {"id": "@otro_bot", "weight": 1, "commands": ["dni", "c4"],
+#            "max_in_flight": 2, "messages_per_second": 0.5}]'
+# - weight: peso relativo en el reparto de carga entre bots sanos.
+# - commands: comandos que el bot soporta (["*"] = todos).
+# - max_in_flight / messages_per_second: límites del planificador para ese bot (opcionales).
+BOT_POOL = json.loads(os.getenv("BOT_POOL", "null")) or [
+    {"id": LEDERDATA_BOT_ID, "weight": 1, "commands": ["*"]},
+    {"id": LEDERDATA_BACKUP_BOT_ID, "weight": 1, "commands": ["*"]},
+]
+for _bot in BOT_POOL:
+    _bot.setdefault("weight", 1)
+    _bot.setdefault("commands", ["*"])
+
+# Orden de preferencia por comando (los bots listados se prueban primero, en ese orden):
+# COMMAND_BOT_PREFERENCE='{"dnif": ["@LEDERDATA_OFC_BOT", "@lederdata_publico_bot"]}'
+COMMAND_BOT_PREFERENCE = json.loads(os.getenv("COMMAND_BOT_PREFERENCE", "{}"))
+
 # Lista de bots para verificar en el handler
-ALL_BOT_IDS = [LEDERDATA_BOT_ID, LEDERDATA_BACKUP_BOT_ID]
+ALL_BOT_IDS = [bot["id"] for bot in BOT_POOL]
 
 # Tiempo de espera (en segundos) para el bot principal antes de intentar con el de respaldo.
 # ESTE ES EL TIEMPO MÁXIMO PARA RECIBIR *TODOS* LOS MENSAJES DEL BOT PRINCIPAL antes del failover
@@ -44,47 +99,1000 @@ TIMEOUT_FAILOVER = 25
 # Si el bot de respaldo se usa, tiene 40 segundos.
 TIMEOUT_TOTAL = 40 
 
+# --- Hedging (consulta duplicada al bot de respaldo) ---
+
+# Si está activo y el bot elegido no ha enviado NADA tras HEDGE_DELAY (o su p95 aprendido de
+# tiempo al primer mensaje), el mismo comando se envía también al siguiente bot: gana el primero
+# que empiece a responder y los mensajes tardíos del otro se descartan.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "0")) # 0 = usar el p95 aprendido del perfil del comando
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "8")) # Mientras no haya perfil aprendido
+# Durante cuánto tiempo se descartan los mensajes tardíos de un intento abandonado
+DISCARD_LATE_REPLIES_SECONDS = float(os.getenv("DISCARD_LATE_REPLIES_SECONDS", "120"))
+
+# --- Planificador de envíos por bot ---
+
+# Máximo de comandos en curso (enviados y esperando respuesta) por bot
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", "4"))
+# Máximo de mensajes enviados por segundo a cada bot
+SCHEDULER_MESSAGES_PER_SECOND = float(os.getenv("SCHEDULER_MESSAGES_PER_SECOND", "1"))
+# Tamaño máximo de la cola de espera por bot. Si se llena, se intenta con otro bot.
+SCHEDULER_QUEUE_SIZE = int(os.getenv("SCHEDULER_QUEUE_SIZE", "200"))
+# Un FloodWait mayor que esto (segundos) no se espera: se pasa al siguiente bot
+SCHEDULER_MAX_FLOOD_WAIT = int(os.getenv("SCHEDULER_MAX_FLOOD_WAIT", "30"))
+# Límites por bot: SCHEDULER_LIMITS='{"@LEDERDATA_OFC_BOT": {"max_in_flight": 2, "messages_per_second": 0.5}}'
+# (también se pueden declarar directamente en BOT_POOL)
+SCHEDULER_LIMITS = json.loads(os.getenv("SCHEDULER_LIMITS", "{}"))
+for _bot in BOT_POOL:
+    _pool_limits = {k: _bot[k] for k in ("max_in_flight", "messages_per_second") if k in _bot}
+    if _pool_limits:
+        SCHEDULER_LIMITS.setdefault(_bot["id"], {}).update(_pool_limits)
+
+# Carriles de prioridad (menor = antes): las consultas interactivas adelantan a los trabajos masivos
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# --- Detección de fin de respuesta (para no esperar siempre el timeout completo) ---
+
+# Silencio (en segundos) tras el último mensaje para dar la respuesta por terminada
+IDLE_GAP_SECONDS = float(os.getenv("IDLE_GAP_SECONDS", "4"))
+# Silencio más largo si el comando espera fotos/archivos que aún no han llegado
+IDLE_GAP_MEDIA_SECONDS = float(os.getenv("IDLE_GAP_MEDIA_SECONDS", "10"))
+# Pequeño margen tras detectar la respuesta completa, por si llega un mensaje rezagado
+COMPLETION_GRACE_SECONDS = float(os.getenv("COMPLETION_GRACE_SECONDS", "0.5"))
+
+# Tipos de media que cada comando devuelve. Cuando llegan todos, la respuesta está completa.
+EXPECTED_MEDIA_BY_COMMAND = {
+    "dnif": {"rostro", "huella", "firma"},
+    "dnifdb": {"rostro", "huella", "firma"},
+    "dnivaz": {"adverso", "reverso"},
+}
+
 # API para guardar los datos
 SAVE_API_BASE_URL = "https://base-datos-consulta-pe.fly.dev/guardar"
 
-# --- Manejo de Fallos por Bot (Implementación de tu lógica) ---
+# --- Manejo de Fallos por Bot: Circuit Breaker con Salud Móvil ---
+
+# Un bot ya no se bloquea 6 horas por un solo timeout. Cada bot tiene un circuito:
+# - "closed": recibe tráfico normalmente.
+# - "open": fuera de rotación hasta 'open_until' (backoff exponencial desde BREAKER_BASE_BACKOFF
+#   hasta un máximo de BOT_FAIL_TIMEOUT_HOURS).
+# - "half_open": pasado el backoff, se deja pasar UNA consulta de prueba. Si responde, vuelve a
+#   "closed"; si falla, vuelve a "open" con el doble de backoff.
+BOT_FAIL_TIMEOUT_HOURS = 6 # Tiempo MÁXIMO de bloqueo (tope del backoff)
+BREAKER_BASE_BACKOFF = int(os.getenv("BREAKER_BASE_BACKOFF", "30")) # Segundos del primer bloqueo
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3")) # Fallos seguidos para abrir
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20")) # Resultados recientes considerados
+BREAKER_MIN_SAMPLES = int(os.getenv("BREAKER_MIN_SAMPLES", "5")) # Mínimo de resultados para evaluar la tasa
+BREAKER_MIN_SUCCESS_RATE = float(os.getenv("BREAKER_MIN_SUCCESS_RATE", "0.5")) # Tasa de éxito mínima en la ventana
+BOT_HEALTH_FILE = os.getenv("BOT_HEALTH_FILE", "bot_health.json") # Persistencia entre reinicios/deploys
+
+# {bot_id: {"state": str, "consecutive_failures": int, "open_count": int, "open_until": epoch,
+#           "last_fail": epoch, "probe_in_flight": bool, "window": deque([[epoch, ok, latency], ...])}}
+bot_health = {}
+_health_lock = threading.Lock()
+
+def _get_bot_health(bot_id: str) -> dict:
+    """Estado del circuito del bot (lo crea en "closed" la primera vez). Requiere _health_lock."""
+    health = bot_health.get(bot_id)
+    if health is None:
+        health = {
+            "state": "closed",
+            "consecutive_failures": 0,
+            "open_count": 0,
+            "open_until": None,
+            "last_fail": None,
+            "probe_in_flight": False,
+            "window": deque(maxlen=BREAKER_WINDOW),
+        }
+        bot_health[bot_id] = health
+    return health
 
-# Diccionario para rastrear los fallos por timeout/bloqueo: {bot_id: datetime_of_failure}
-bot_fail_tracker = {}
-BOT_FAIL_TIMEOUT_HOURS = 6 # Tiempo de bloqueo de 6 horas
+def _refresh_breaker_state(bot_id: str, health: dict):
+    """Pasa de "open" a "half_open" cuando vence el backoff. Requiere _health_lock."""
+    if health["state"] == "open" and health["open_until"] and time.time() >= health["open_until"]:
+        health["state"] = "half_open"
+        health["probe_in_flight"] = False
+        print(f"🟡 Bot {bot_id} cumplió su backoff. Semi-abierto: se enviará una consulta de prueba.")
 
 def is_bot_blocked(bot_id: str) -> bool:
-    """Verifica si el bot está temporalmente bloqueado por fallos previos."""
-    last_fail_time = bot_fail_tracker.get(bot_id)
-    if not last_fail_time:
-        return False
-
-    # Usamos la hora actual para la verificación
-    now = datetime.now()
-    six_hours_ago = now - timedelta(hours=BOT_FAIL_TIMEOUT_HOURS)
-
-    # Si la última falla fue más reciente que 'six_hours_ago', está bloqueado
-    if last_fail_time > six_hours_ago:
-        # Imprimir el tiempo restante para depuración
-        time_left = last_fail_time + timedelta(hours=BOT_FAIL_TIMEOUT_HOURS) - now
-        print(f"🚫 Bot {bot_id} bloqueado. Restan: {time_left}")
+    """Verifica si el bot está fuera de rotación (circuito abierto o prueba semi-abierta ya en curso)."""
+    with _health_lock:
+        health = _get_bot_health(bot_id)
+        _refresh_breaker_state(bot_id, health)
+        if health["state"] == "open":
+            return True
+        return health["state"] == "half_open" and health["probe_in_flight"]
+
+def claim_bot(bot_id: str) -> bool:
+    """
+    Reserva el bot para una consulta. En "half_open" solo la primera consulta (la prueba)
+    obtiene el bot; el resto lo ve bloqueado hasta que la prueba termine.
+    """
+    with _health_lock:
+        health = _get_bot_health(bot_id)
+        _refresh_breaker_state(bot_id, health)
+        if health["state"] == "open":
+            return False
+        if health["state"] == "half_open":
+            if health["probe_in_flight"]:
+                return False
+            health["probe_in_flight"] = True
+            print(f"🧪 Consulta de prueba hacia {bot_id} (semi-abierto).")
         return True
-    
-    # Si ya pasó el tiempo, eliminamos el registro y permitimos el intento
-    print(f"✅ Bot {bot_id} ha cumplido su tiempo de bloqueo. Desbloqueado.")
-    bot_fail_tracker.pop(bot_id, None)
-    return False
 
-def record_bot_failure(bot_id: str):
-    """Registra la hora actual como la última hora de fallo del bot."""
-    print(f"🚨 Bot {bot_id} ha fallado y será BLOQUEADO por {BOT_FAIL_TIMEOUT_HOURS} horas.")
-    # Usamos datetime.now() para que coincida con la verificación en is_bot_blocked
-    bot_fail_tracker[bot_id] = datetime.now()
+def release_bot_probe(bot_id: str):
+    """Libera la prueba semi-abierta sin registrar resultado (ej: el comando no llegó a enviarse)."""
+    with _health_lock:
+        _get_bot_health(bot_id)["probe_in_flight"] = False
+
+def bot_health_score(bot_id: str) -> float:
+    """Puntaje de salud: tasa de éxito (suavizada) penalizada por la latencia mediana al primer mensaje."""
+    with _health_lock:
+        window = list(_get_bot_health(bot_id)["window"])
+    successes = sum(1 for _, ok, _ in window if ok)
+    success_rate = (successes + 1) / (len(window) + 2)
+    latencies = [latency for _, ok, latency in window if ok and latency is not None]
+    median_latency = _percentile(latencies, 50) or 0.0
+    return success_rate / (1 + median_latency / 10)
+
+def bot_supports_command(bot: dict, command_name: str) -> bool:
+    return "*" in bot["commands"] or command_name in bot["commands"]
+
+def select_bots_for_command(command_name: str) -> list:
+    """
+    Orden en que se probarán los bots del pool para un comando:
+    1. Los de COMMAND_BOT_PREFERENCE para ese comando, en el orden configurado.
+    2. El resto de bots que soportan el comando, repartidos al azar según su peso, su salud
+       (circuit breaker) y su carga actual en el planificador. Los bloqueados van al final.
+    """
+    candidates = {bot["id"]: bot for bot in BOT_POOL if bot_supports_command(bot, command_name)}
+    preferred = [bot_id for bot_id in COMMAND_BOT_PREFERENCE.get(command_name, []) if bot_id in candidates]
+
+    def _sort_key(bot_id):
+        bot = candidates[bot_id]
+        load = bot_load(bot_id)
+        effective_weight = max(float(bot["weight"]), 0.0) * bot_health_score(bot_id) / (1 + load)
+        # Muestreo ponderado sin reemplazo (Efraimidis-Spirakis): mayor clave = antes
+        return random.random() ** (1 / effective_weight) if effective_weight > 0 else 0.0
+
+    balanced = sorted((bot_id for bot_id in candidates if bot_id not in preferred), key=_sort_key, reverse=True)
+    ordered = preferred + balanced
+    return [bot_id for bot_id in ordered if not is_bot_blocked(bot_id)] + [bot_id for bot_id in ordered if is_bot_blocked(bot_id)]
+
+def _open_breaker(bot_id: str, health: dict, reason: str):
+    """Abre el circuito con backoff exponencial. Requiere _health_lock."""
+    backoff = min(BREAKER_BASE_BACKOFF * (2 ** health["open_count"]), BOT_FAIL_TIMEOUT_HOURS * 3600)
+    health["state"] = "open"
+    health["open_count"] += 1
+    health["open_until"] = time.time() + backoff
+    health["probe_in_flight"] = False
+    print(f"🚨 Bot {bot_id} fuera de rotación por {int(backoff)}s ({reason}).")
+
+def record_bot_failure(bot_id: str, force_open: bool = False):
+    """Registra un fallo del bot y abre el circuito si corresponde (o siempre, con force_open)."""
+    with _health_lock:
+        health = _get_bot_health(bot_id)
+        health["window"].append([time.time(), False, None])
+        health["consecutive_failures"] += 1
+        health["last_fail"] = time.time()
+        window = health["window"]
+        success_rate = sum(1 for _, ok, _ in window if ok) / len(window)
+
+        if force_open:
+            _open_breaker(bot_id, health, "bloqueo explícito")
+        elif health["state"] == "half_open":
+            _open_breaker(bot_id, health, "falló la consulta de prueba")
+        elif health["consecutive_failures"] >= BREAKER_FAILURE_THRESHOLD:
+            _open_breaker(bot_id, health, f"{health['consecutive_failures']} fallos seguidos")
+        elif len(window) >= BREAKER_MIN_SAMPLES and success_rate < BREAKER_MIN_SUCCESS_RATE:
+            _open_breaker(bot_id, health, f"tasa de éxito {success_rate:.0%}")
+        else:
+            print(f"⚠️ Fallo registrado para {bot_id} ({health['consecutive_failures']} seguido(s)).")
+    _schedule_bot_health_save()
+
+def record_bot_success(bot_id: str, latency: float | None = None):
+    """Registra una respuesta del bot (latencia al primer mensaje) y cierra el circuito si estaba semi-abierto."""
+    with _health_lock:
+        health = _get_bot_health(bot_id)
+        health["window"].append([time.time(), True, round(latency, 3) if latency is not None else None])
+        health["consecutive_failures"] = 0
+        transitioned = health["state"] != "closed"
+        if transitioned:
+            print(f"✅ Bot {bot_id} respondió. Circuito cerrado, vuelve a la rotación.")
+            health["state"] = "closed"
+            health["open_count"] = 0
+            health["open_until"] = None
+        health["probe_in_flight"] = False
+    if transitioned:
+        _schedule_bot_health_save()
+
+def get_bot_health_status(bot_id: str) -> dict:
+    """Resumen del circuito del bot para /status."""
+    blocked = is_bot_blocked(bot_id)
+    score = bot_health_score(bot_id)
+    with _health_lock:
+        health = _get_bot_health(bot_id)
+        window = list(health["window"])
+        latencies = [latency for _, ok, latency in window if ok and latency is not None]
+        return {
+            "blocked": blocked,
+            "state": health["state"],
+            "open_until": datetime.fromtimestamp(health["open_until"]).isoformat() if health["open_until"] else None,
+            "last_fail": datetime.fromtimestamp(health["last_fail"]).isoformat() if health["last_fail"] else None,
+            "consecutive_failures": health["consecutive_failures"],
+            "success_rate": round(sum(1 for _, ok, _ in window if ok) / len(window), 3) if window else None,
+            "p50_latency": _percentile(latencies, 50),
+            "p95_latency": _percentile(latencies, 95),
+            "score": round(score, 4),
+        }
+
+def save_bot_health():
+    """Escribe el estado de los circuitos a BOT_HEALTH_FILE de forma atómica."""
+    with _health_lock:
+        data = {
+            bot_id: {**{k: v for k, v in health.items() if k != "window"}, "window": list(health["window"]), "probe_in_flight": False}
+            for bot_id, health in bot_health.items()
+        }
+    try:
+        tmp_path = f"{BOT_HEALTH_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, BOT_HEALTH_FILE)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el estado de salud de los bots: {e}")
+
+def _schedule_bot_health_save():
+    """
+    Guarda el estado de salud sin bloquear el bucle de Telethon. Se puede llamar desde cualquier hilo
+    (también desde los de Flask): la escritura se encarga al executor a través del propio bucle.
+    """
+    try:
+        loop.call_soon_threadsafe(loop.run_in_executor, None, save_bot_health)
+    except RuntimeError:
+        save_bot_health() # Bucle cerrado (apagado)
+
+def load_bot_health():
+    """Restaura el estado de los circuitos guardado antes del último reinicio."""
+    try:
+        with open(BOT_HEALTH_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"⚠️ No se pudo cargar el estado de salud de los bots: {e}")
+        return
+    with _health_lock:
+        for bot_id, stored in data.items():
+            health = _get_bot_health(bot_id)
+            health.update({k: v for k, v in stored.items() if k in health and k != "window"})
+            health["window"].extend(stored.get("window", []))
+    print(f"🩺 Estado de salud restaurado para {len(data)} bot(s).")
+
+load_bot_health()
+
+# --- Perfiles de Respuesta por Comando (Timeouts Adaptativos) ---
+
+# Archivo donde se persisten los perfiles para que sobrevivan a los reinicios
+PROFILES_FILE = os.getenv("PROFILES_FILE", "command_profiles.json")
+PROFILE_MAX_SAMPLES = int(os.getenv("PROFILE_MAX_SAMPLES", "200")) # Muestras guardadas por métrica
+PROFILE_MIN_SAMPLES = int(os.getenv("PROFILE_MIN_SAMPLES", "10")) # Mínimo de muestras para confiar en el perfil
+PROFILE_SAVE_INTERVAL = int(os.getenv("PROFILE_SAVE_INTERVAL", "60")) # Segundos entre guardados a disco
+PROFILE_MIN_DEADLINE = float(os.getenv("PROFILE_MIN_DEADLINE", "6")) # Nunca esperar menos que esto al primer mensaje
+
+# Métricas registradas por respuesta: tiempo al primer mensaje, tiempo al último,
+# mayor silencio entre mensajes, cantidad de mensajes y cantidad de archivos.
+PROFILE_METRICS = ("ttfm", "ttlm", "max_gap", "messages", "media")
+
+# {command_name: {bot_id: {"ttfm": deque, ..., "timeouts": int}}}
+command_profiles = {}
+_profiles_lock = threading.Lock()
+_profiles_dirty = False
+
+def _new_profile():
+    profile = {metric: deque(maxlen=PROFILE_MAX_SAMPLES) for metric in PROFILE_METRICS}
+    profile["timeouts"] = 0
+    return profile
+
+def _percentile(values, pct: float):
+    """Percentil por rango más cercano. Devuelve None si no hay valores."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def record_command_profile(command_name: str, bot_id: str, ttfm: float, ttlm: float, max_gap: float, message_count: int, media_count: int):
+    """Registra una respuesta exitosa en el perfil del comando para ese bot."""
+    global _profiles_dirty
+    with _profiles_lock:
+        profile = command_profiles.setdefault(command_name, {}).setdefault(bot_id, _new_profile())
+        profile["ttfm"].append(round(ttfm, 3))
+        profile["ttlm"].append(round(ttlm, 3))
+        profile["max_gap"].append(round(max_gap, 3))
+        profile["messages"].append(message_count)
+        profile["media"].append(media_count)
+        _profiles_dirty = True
+
+def record_command_timeout(command_name: str, bot_id: str):
+    """Registra que el bot no respondió al comando dentro del plazo."""
+    global _profiles_dirty
+    with _profiles_lock:
+        profile = command_profiles.setdefault(command_name, {}).setdefault(bot_id, _new_profile())
+        profile["timeouts"] += 1
+        _profiles_dirty = True
+
+def get_command_timing(command_name: str, bot_id: str, default_deadline: float) -> dict:
+    """
+    Calcula los plazos de espera para un comando en un bot a partir de su perfil.
+
+    :return: {"first_deadline": s, "total_deadline": s, "idle_gap": s | None, "learned": bool}
+             'first_deadline' es el plazo para el primer mensaje (si no llega, failover),
+             'total_deadline' el tope de acumulación e 'idle_gap' el silencio que cierra la respuesta
+             (None = usar la detección por defecto).
+    """
+    with _profiles_lock:
+        profile = command_profiles.get(command_name, {}).get(bot_id)
+        samples = len(profile["ttfm"]) if profile else 0
+        if samples < PROFILE_MIN_SAMPLES:
+            return {"first_deadline": default_deadline, "total_deadline": default_deadline, "idle_gap": None, "learned": False}
+        p99_ttfm = _percentile(profile["ttfm"], 99)
+        p99_ttlm = _percentile(profile["ttlm"], 99)
+        p95_gap = _percentile(profile["max_gap"], 95)
+
+    idle_gap = min(IDLE_GAP_MEDIA_SECONDS, max(1.0, p95_gap * 1.5 + 0.5))
+    first_deadline = min(default_deadline, max(PROFILE_MIN_DEADLINE, p99_ttfm * 1.5 + 2))
+    total_deadline = min(TIMEOUT_TOTAL, max(first_deadline, p99_ttlm * 1.5 + idle_gap))
+    return {"first_deadline": first_deadline, "total_deadline": total_deadline, "idle_gap": idle_gap, "learned": True}
+
+def get_profiles_summary() -> dict:
+    """Resumen legible (percentiles) de todos los perfiles para el endpoint /profiles."""
+    summary = {}
+    with _profiles_lock:
+        snapshot = {
+            command_name: {bot_id: {k: (list(v) if isinstance(v, deque) else v) for k, v in profile.items()} for bot_id, profile in bots.items()}
+            for command_name, bots in command_profiles.items()
+        }
+    for command_name, bots in snapshot.items():
+        summary[command_name] = {}
+        for bot_id, profile in bots.items():
+            bot_summary = {"samples": len(profile["ttfm"]), "timeouts": profile["timeouts"]}
+            for metric in PROFILE_METRICS:
+                bot_summary[metric] = {
+                    "p50": _percentile(profile[metric], 50),
+                    "p95": _percentile(profile[metric], 95),
+                    "max": max(profile[metric]) if profile[metric] else None,
+                }
+            bot_summary["timing"] = get_command_timing(command_name, bot_id, TIMEOUT_FAILOVER)
+            summary[command_name][bot_id] = bot_summary
+    return summary
+
+def load_command_profiles():
+    """Carga los perfiles guardados en PROFILES_FILE (si existe)."""
+    try:
+        with open(PROFILES_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"⚠️ No se pudieron cargar los perfiles de comandos: {e}")
+        return
+
+    with _profiles_lock:
+        for command_name, bots in data.items():
+            for bot_id, stored in bots.items():
+                profile = _new_profile()
+                for metric in PROFILE_METRICS:
+                    profile[metric].extend(stored.get(metric, []))
+                profile["timeouts"] = stored.get("timeouts", 0)
+                command_profiles.setdefault(command_name, {})[bot_id] = profile
+    print(f"📈 Perfiles de comandos cargados: {len(command_profiles)} comando(s).")
+
+def save_command_profiles():
+    """Escribe los perfiles a disco de forma atómica (archivo temporal + reemplazo)."""
+    global _profiles_dirty
+    with _profiles_lock:
+        if not _profiles_dirty:
+            return
+        data = {
+            command_name: {bot_id: {k: (list(v) if isinstance(v, deque) else v) for k, v in profile.items()} for bot_id, profile in bots.items()}
+            for command_name, bots in command_profiles.items()
+        }
+        _profiles_dirty = False
+    try:
+        tmp_path = f"{PROFILES_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, PROFILES_FILE)
+    except Exception as e:
+        print(f"⚠️ No se pudieron guardar los perfiles de comandos: {e}")
+
+load_command_profiles()
+
+# --- Almacén de Media Direccionado por Contenido ---
+
+# Los archivos se nombran por su id de Telegram ("photo_<id>.jpg", "doc_<id>.pdf"), así que la misma
+# foto pedida por /dni, /dnif y /c4 se descarga una sola vez y tiene siempre la misma URL. Además se
+# guarda el SHA-256 de cada archivo: si llega el mismo contenido con otro id, el nuevo nombre pasa a
+# ser un enlace duro al archivo existente (un solo archivo en disco).
+# 'refs' cuenta las entradas de la caché de resultados que apuntan a cada archivo.
+MEDIA_INDEX_FILE = os.getenv("MEDIA_INDEX_FILE", "media_index.json") # Hashes conocidos (persistidos)
+
+# {nombre de archivo: {"sha256": str | None, "size": int | None, "refs": int}}
+_media_store = {}
+_media_by_hash = {} # {sha256: nombre de archivo canónico}
+_media_store_lock = threading.Lock()
+media_store_stats = {"skipped_downloads": 0, "shared_downloads": 0, "content_duplicates": 0}
+
+def media_store_name(media) -> str | None:
+    """Nombre estable del archivo de una media de Telegram, o None si no tiene id."""
+    document = getattr(media, "document", None)
+    if document is not None and getattr(document, "id", None):
+        return f"doc_{document.id}{utils.get_extension(media) or '.file'}"
+    photo = getattr(media, "photo", None)
+    if photo is not None and getattr(photo, "id", None):
+        return f"photo_{photo.id}.jpg"
+    return None
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def media_store_add(filename: str):
+    """
+    Registra un archivo recién guardado en DOWNLOAD_DIR (bloqueante: se llama en un executor).
+    Si su contenido ya existe con otro nombre, lo reemplaza por un enlace duro al existente.
+    """
+    path = os.path.join(DOWNLOAD_DIR, filename)
+    try:
+        sha256 = _hash_file(path)
+        with _media_store_lock:
+            canonical = _media_by_hash.get(sha256)
+            if canonical and canonical != filename and os.path.exists(os.path.join(DOWNLOAD_DIR, canonical)):
+                tmp_link = f"{path}.link"
+                os.link(os.path.join(DOWNLOAD_DIR, canonical), tmp_link)
+                os.replace(tmp_link, path)
+                media_store_stats["content_duplicates"] += 1
+            else:
+                _media_by_hash[sha256] = filename
+            entry = _media_store.setdefault(filename, {"sha256": None, "size": None, "refs": 0})
+            entry["sha256"] = sha256
+            entry["size"] = os.path.getsize(path)
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar {filename} en el almacén de media: {e}")
+    retention_track(filename)
+
+def media_store_forget(filename: str):
+    """Quita un archivo borrado del disco del índice (sus referencias se conservan)."""
+    with _media_store_lock:
+        entry = _media_store.get(filename)
+        if entry is None:
+            return
+        if entry["sha256"] and _media_by_hash.get(entry["sha256"]) == filename:
+            del _media_by_hash[entry["sha256"]]
+        if entry["refs"] > 0:
+            entry["sha256"] = entry["size"] = None
+        else:
+            del _media_store[filename]
+
+def _media_filenames_in_result(result: dict) -> list:
+    prefix = f"{PUBLIC_URL}/files/"
+    return [unquote(url[len(prefix):]) for url in (result.get("urls") or {}).values() if isinstance(url, str) and url.startswith(prefix)]
+
+def media_store_retain(result: dict, delta: int):
+    """Suma (+1) o resta (-1) una referencia a cada archivo de un resultado cacheado."""
+    with _media_store_lock:
+        for filename in _media_filenames_in_result(result):
+            entry = _media_store.setdefault(filename, {"sha256": None, "size": None, "refs": 0})
+            entry["refs"] = max(entry["refs"] + delta, 0)
+
+def media_etag(filename: str) -> str | bool:
+    """
+    ETag fuerte por identidad de contenido, siempre el mismo para un archivo: el id de Telegram del
+    nombre ("photo_<id>") o, para otros nombres, el SHA-256 del almacén si se conoce.
+    True = el ETag por defecto de Werkzeug.
+    """
+    filename = os.path.basename(filename)
+    if filename.startswith(("photo_", "doc_")):
+        # No depende del almacén: no cambia al terminar el hash ni en un worker (donde el almacén está vacío)
+        return os.path.splitext(filename)[0]
+    with _media_store_lock:
+        entry = _media_store.get(filename)
+        if entry and entry["sha256"]:
+            return entry["sha256"]
+    return True
+
+def media_store_refs(filename: str) -> int:
+    """Entradas de la caché de resultados que apuntan al archivo (la retención no borra los que tienen alguna)."""
+    with _media_store_lock:
+        entry = _media_store.get(filename)
+        return entry["refs"] if entry else 0
+
+def get_media_store_status() -> dict:
+    with _media_store_lock:
+        return {
+            "files": sum(1 for entry in _media_store.values() if entry["sha256"]),
+            "unique_contents": len(_media_by_hash),
+            "referenced": sum(1 for entry in _media_store.values() if entry["refs"] > 0),
+            **media_store_stats,
+        }
+
+def save_media_store():
+    """Escribe los hashes conocidos a MEDIA_INDEX_FILE de forma atómica (las referencias se recalculan al cargar la caché)."""
+    with _media_store_lock:
+        data = {filename: {"sha256": entry["sha256"], "size": entry["size"]} for filename, entry in _media_store.items() if entry["sha256"]}
+    try:
+        tmp_path = f"{MEDIA_INDEX_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, MEDIA_INDEX_FILE)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el índice de media: {e}")
+
+def load_media_store():
+    """Restaura el índice de hashes de los archivos que siguen en disco."""
+    try:
+        with open(MEDIA_INDEX_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"⚠️ No se pudo cargar el índice de media: {e}")
+        return
+    with _media_store_lock:
+        for filename, stored in data.items():
+            if os.path.exists(os.path.join(DOWNLOAD_DIR, filename)):
+                _media_store[filename] = {"sha256": stored.get("sha256"), "size": stored.get("size"), "refs": 0}
+                if stored.get("sha256"):
+                    _media_by_hash.setdefault(stored["sha256"], filename)
+    print(f"🗂️ Índice de media restaurado: {len(_media_store)} archivo(s).")
+
+if GATEWAY_ROLE != "worker":
+    load_media_store()
+
+# --- Retención de DOWNLOAD_DIR (presupuesto de bytes y edad máxima) ---
+
+# Los archivos se borran por último acceso (LRU): cada /files marca el 'atime' del archivo, lo que
+# también ven los workers en otro proceso. El índice se arma con un solo recorrido del directorio
+# al arrancar y luego se mantiene con las descargas nuevas; cada pasada revisa solo el extremo
+# menos usado (RETENTION_BATCH archivos como máximo), sin volver a recorrer el directorio.
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(2 * 1024 ** 3))) # 0 = sin límite de tamaño
+MEDIA_MAX_AGE_HOURS = float(os.getenv("MEDIA_MAX_AGE_HOURS", "72")) # Sin accesos en este tiempo = se borra (0 = sin límite)
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "60")) # Segundos entre pasadas
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "200")) # Archivos revisados por pasada
+TEMP_FILE_SUFFIXES = (".part", ".tmp", ".link") # Escrituras en curso (nunca se indexan)
+
+# {nombre de archivo: {"size": int, "inode": (st_dev, st_ino), "last_access": epoch}}, el menos usado primero
+_retention_index = OrderedDict()
+# {(st_dev, st_ino): nombres que apuntan a él}. Los duplicados del almacén de media son enlaces duros:
+# el contenido ocupa disco una sola vez, así que los bytes se cuentan por inodo y no por nombre.
+_retention_inodes = {}
+_retention_lock = threading.Lock()
+retention_stats = {"bytes": 0, "evicted_files": 0, "evicted_bytes": 0, "skipped_referenced": 0, "last_pass_at": None, "last_pass_seconds": None}
+
+def _retention_add(filename: str, size: int, inode: tuple, last_access: float):
+    """Registra un nombre en el índice. Requiere _retention_lock."""
+    _retention_index[filename] = {"size": size, "inode": inode, "last_access": last_access}
+    _retention_inodes[inode] = _retention_inodes.get(inode, 0) + 1
+    if _retention_inodes[inode] == 1:
+        retention_stats["bytes"] += size
+
+def _retention_remove(filename: str) -> int:
+    """Quita un nombre del índice y devuelve los bytes que libera (0 si otro nombre comparte su inodo). Requiere _retention_lock."""
+    entry = _retention_index.pop(filename, None)
+    if entry is None:
+        return 0
+    _retention_inodes[entry["inode"]] -= 1
+    if _retention_inodes[entry["inode"]] > 0:
+        return 0
+    del _retention_inodes[entry["inode"]]
+    retention_stats["bytes"] -= entry["size"]
+    return entry["size"]
+
+def retention_track(filename: str):
+    """Añade (o actualiza) un archivo recién escrito en DOWNLOAD_DIR al índice de retención."""
+    try:
+        stat = os.stat(os.path.join(DOWNLOAD_DIR, filename))
+    except OSError:
+        return
+    with _retention_lock:
+        _retention_remove(filename)
+        _retention_add(filename, stat.st_size, (stat.st_dev, stat.st_ino), time.time())
+
+def resolve_media_filename(filename: str) -> str | None:
+    """Nombre del archivo si la ruta pedida cae directamente dentro de DOWNLOAD_DIR; None si intenta salir de él."""
+    base_dir = os.path.realpath(DOWNLOAD_DIR)
+    path = os.path.realpath(os.path.join(base_dir, filename))
+    if os.path.dirname(path) != base_dir:
+        return None
+    return os.path.basename(path)
+
+def touch_media_file(filename: str):
+    """Marca un acceso a /files: actualiza el 'atime' del archivo (visible desde cualquier proceso)."""
+    filename = resolve_media_filename(filename)
+    if filename is None:
+        return # Solo archivos directamente dentro de DOWNLOAD_DIR
+    path = os.path.join(DOWNLOAD_DIR, filename)
+    try:
+        now = time.time()
+        os.utime(path, (now, os.stat(path).st_mtime)) # Solo el acceso: la fecha de modificación no cambia
+    except OSError:
+        return
+    with _retention_lock:
+        entry = _retention_index.get(filename)
+        if entry:
+            entry["last_access"] = now
+            _retention_index.move_to_end(filename)
+
+def _retention_initial_scan():
+    """Único recorrido completo de DOWNLOAD_DIR: arma el índice y borra temporales huérfanos."""
+    entries = []
+    with os.scandir(DOWNLOAD_DIR) as it:
+        for dir_entry in it:
+            if not dir_entry.is_file():
+                continue
+            stat = dir_entry.stat()
+            if dir_entry.name.endswith(TEMP_FILE_SUFFIXES):
+                if time.time() - stat.st_mtime > 3600:
+                    os.remove(dir_entry.path) # Descarga interrumpida por un reinicio
+                continue
+            entries.append((max(stat.st_atime, stat.st_mtime), dir_entry.name, stat.st_size, (stat.st_dev, stat.st_ino)))
+    with _retention_lock:
+        tracked = _retention_index.copy() # Descargas registradas durante el recorrido (las más recientes)
+        _retention_index.clear()
+        _retention_inodes.clear()
+        retention_stats["bytes"] = 0
+        for last_access, name, size, inode in sorted(entries):
+            if name not in tracked:
+                _retention_add(name, size, inode, last_access)
+        for name, entry in tracked.items():
+            _retention_add(name, entry["size"], entry["inode"], entry["last_access"])
+    print(f"🧹 Retención: {len(entries)} archivo(s) en {DOWNLOAD_DIR} ({retention_stats['bytes'] / 1024 ** 2:.1f} MiB).")
+
+def _retention_pass():
+    """Una pasada incremental: borra desde el extremo menos usado mientras sobren bytes o edad."""
+    started = time.time()
+    max_age = MEDIA_MAX_AGE_HOURS * 3600
+    for _ in range(RETENTION_BATCH):
+        with _retention_lock:
+            if not _retention_index:
+                break
+            filename, entry = next(iter(_retention_index.items()))
+            over_budget = MEDIA_MAX_BYTES > 0 and retention_stats["bytes"] > MEDIA_MAX_BYTES
+            too_old = max_age > 0 and started - entry["last_access"] > max_age
+            if not over_budget and not too_old:
+                break # El menos usado está dentro de los límites: no hay nada más que borrar
+        path = os.path.join(DOWNLOAD_DIR, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        with _retention_lock:
+            if _retention_index.get(filename) is not entry:
+                continue # Cambió mientras tanto (acceso o nueva descarga)
+            if stat is not None and stat.st_atime > entry["last_access"] + 1:
+                # Otro proceso lo sirvió desde la última vez: se reordena en lugar de borrarlo
+                entry["last_access"] = stat.st_atime
+                _retention_index.move_to_end(filename)
+                continue
+            if path in _media_downloads_in_flight:
+                _retention_index.move_to_end(filename)
+                continue
+            if media_store_refs(filename) > 0:
+                # Lo usa una entrada vigente de la caché de resultados: borrarlo la dejaría rota
+                _retention_index.move_to_end(filename)
+                retention_stats["skipped_referenced"] += 1
+                continue
+            freed = _retention_remove(filename)
+        if stat is not None:
+            try:
+                os.remove(path)
+                retention_stats["evicted_files"] += 1
+                retention_stats["evicted_bytes"] += freed
+            except OSError as e:
+                print(f"⚠️ Retención: no se pudo borrar {filename}: {e}")
+        media_store_forget(filename)
+    retention_stats["last_pass_at"] = datetime.now(timezone.utc).isoformat()
+    retention_stats["last_pass_seconds"] = round(time.time() - started, 3)
+
+async def _retention_loop():
+    await loop.run_in_executor(None, _retention_initial_scan)
+    while True:
+        try:
+            await loop.run_in_executor(None, _retention_pass)
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+def get_retention_status() -> dict:
+    """Uso de DOWNLOAD_DIR para /status."""
+    with _retention_lock:
+        status = {"files": len(_retention_index), "max_bytes": MEDIA_MAX_BYTES, "max_age_hours": MEDIA_MAX_AGE_HOURS, **retention_stats}
+    try:
+        disk = shutil.disk_usage(DOWNLOAD_DIR)
+        status["disk_free_bytes"] = disk.free
+        status["disk_total_bytes"] = disk.total
+    except OSError:
+        pass
+    return status
+
+# --- Variantes de Imagen (miniaturas / WebP) ---
+
+# /files/<foto>?w=256&format=webp devuelve una versión reducida y/o en WebP. Cada variante se genera
+# una sola vez en VARIANTS_DIR y luego se sirve desde ahí. El ancho se ajusta al siguiente de
+# VARIANT_WIDTHS para no crear una variante por cada número. Pillow es opcional: sin él se sirve
+# siempre el original.
+VARIANTS_DIR = os.getenv("VARIANTS_DIR", f"{DOWNLOAD_DIR}_variants")
+VARIANT_WIDTHS = (64, 128, 256, 512, 1024)
+VARIANT_FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg"), "jpg": ("JPEG", ".jpg"), "png": ("PNG", ".png")}
+VARIANT_CACHE_MAX_BYTES = int(os.getenv("VARIANT_CACHE_MAX_BYTES", str(256 * 1024 ** 2)))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+os.makedirs(VARIANTS_DIR, exist_ok=True)
+
+def parse_variant_args(args) -> tuple[int | None, str | None, str | None]:
+    """Lee 'w' y 'format' de la petición. Devuelve (ancho, formato, None) o (None, None, mensaje de error)."""
+    width, fmt = args.get("w"), (args.get("format") or "").lower() or None
+    if width is not None:
+        # isascii: isdigit también acepta '²' o '٣', que int() no convierte o no debería aceptar
+        if not (width.isascii() and width.isdigit()) or int(width) <= 0:
+            return None, None, "Parámetro 'w' debe ser un entero positivo."
+        width = next((allowed for allowed in VARIANT_WIDTHS if allowed >= int(width)), VARIANT_WIDTHS[-1])
+    if fmt is not None and fmt not in VARIANT_FORMATS:
+        return None, None, f"Parámetro 'format' debe ser uno de: {', '.join(VARIANT_FORMATS)}."
+    return width, fmt, None
+
+def _prune_variants():
+    """Borra las variantes menos usadas (por atime) mientras VARIANTS_DIR supere su presupuesto."""
+    variants = []
+    with os.scandir(VARIANTS_DIR) as it:
+        for dir_entry in it:
+            if dir_entry.is_file() and not dir_entry.name.endswith(".tmp"): # Las que se están generando no
+                stat = dir_entry.stat()
+                variants.append((stat.st_atime, dir_entry.path, stat.st_size))
+    total = sum(size for _, _, size in variants)
+    for _, path, size in sorted(variants):
+        if total <= VARIANT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def image_variant_path(filename: str, width: int | None, fmt: str | None) -> str | None:
+    """
+    Ruta de la variante pedida de una imagen de DOWNLOAD_DIR, generándola si no existe (bloqueante).
+    None si no aplica (no es una imagen, no existe o Pillow no está instalado): se sirve el original.
+    """
+    filename = resolve_media_filename(filename)
+    if filename is None:
+        return None
+    source = os.path.join(DOWNLOAD_DIR, filename)
+    stem, ext = os.path.splitext(filename)
+    if Image is None or ext.lower() not in IMAGE_EXTENSIONS or not os.path.isfile(source):
+        return None
+    # Sin 'format' se conserva el del original
+    pil_format, variant_ext = VARIANT_FORMATS[fmt or ext.lower().lstrip(".")]
+    # La extensión del original va en el nombre: 'x.jpg' y 'x.png' no comparten variante
+    variant_path = os.path.join(VARIANTS_DIR, f"{stem}_{ext.lower().lstrip('.')}_w{width or 0}{variant_ext}")
+    if os.path.exists(variant_path):
+        os.utime(variant_path, (time.time(), os.stat(variant_path).st_mtime)) # Último acceso (para el presupuesto)
+        return variant_path
+    tmp_path = f"{variant_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with Image.open(source) as image:
+            if width and image.width > width:
+                image.thumbnail((width, image.height)) # Mantiene la proporción; nunca agranda
+            if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(tmp_path, pil_format, quality=80, optimize=True)
+        os.replace(tmp_path, variant_path)
+    except Exception as e:
+        print(f"⚠️ No se pudo generar la variante de {filename}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    _prune_variants()
+    return variant_path
+
+# --- Caché de Resultados (TTL + LRU, con persistencia opcional en SQLite) ---
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+CACHE_DEFAULT_TTL = int(os.getenv("CACHE_DEFAULT_TTL", str(6 * 3600))) # 6 horas
+# Ruta del archivo SQLite para que la caché sobreviva reinicios. Vacío = solo en memoria.
+CACHE_DB = os.getenv("CACHE_DB", "")
+
+# TTL (segundos) por comando. 0 = no cachear. Los datos de identidad cambian poco;
+# antecedentes, denuncias y requisitorias pueden cambiar en horas.
+CACHE_TTL_BY_COMMAND = {
+    "dni": 7 * 86400, "dnif": 7 * 86400, "dnidb": 7 * 86400, "dnifdb": 7 * 86400, "c4": 7 * 86400,
+    "dnivaz": 7 * 86400, "dnivam": 7 * 86400, "dnivel": 7 * 86400, "dniveln": 7 * 86400,
+    "fa": 3 * 86400, "fadb": 3 * 86400, "fb": 3 * 86400, "fbdb": 3 * 86400, "agv": 3 * 86400, "agvp": 3 * 86400,
+    "nm": 86400, "nmv": 86400, "cedula": 86400,
+    "antpen": 3600, "antpol": 3600, "antjud": 3600, "antpenv": 3600,
+    "rqh": 3600, "det": 3600, "fis": 3600, "fisdet": 3600,
+    "dend": 3600, "dence": 3600, "denpas": 3600, "denci": 3600, "denp": 3600, "denar": 3600, "dencl": 3600,
+}
+# Permite ajustar los TTL sin tocar el código: CACHE_TTL_OVERRIDES='{"tel": 600, "dni": 0}'
+CACHE_TTL_BY_COMMAND.update(json.loads(os.getenv("CACHE_TTL_OVERRIDES", "{}")))
+
+# Cada cuánto (segundos) se vuelve a comprobar que siguen en disco los archivos de una entrada.
+# Entre comprobaciones vale la última: la retención no borra archivos con entradas vigentes.
+CACHE_FILES_CHECK_SECONDS = int(os.getenv("CACHE_FILES_CHECK_SECONDS", "60"))
+
+# {clave_normalizada: {"expires_at": epoch, "result": dict, "files_checked_at": epoch}}
+# en orden LRU (el más reciente al final)
+_result_cache = OrderedDict()
+_cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "missing_files": 0}
+_cache_db = None
+# Todas las escrituras en SQLite pasan por este único hilo: no bloquean el bucle de Telethon, se
+# aplican en el mismo orden en que cambió la memoria y se pueden encargar desde cualquier hilo.
+_cache_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-db")
+
+def _normalize_command_key(command: str) -> str:
+    """Clave de caché para un comando: '/DNI  12345678 ' -> '/dni 12345678'."""
+    parts = command.strip().split(None, 1)
+    if not parts:
+        return ""
+    name = parts[0].lower()
+    param = " ".join(parts[1].split()).upper() if len(parts) > 1 else ""
+    return f"{name} {param}".strip()
+
+def _local_path_for_url(url: str) -> str | None:
+    """Ruta en DOWNLOAD_DIR de una URL pública '/files/<nombre>' generada por este servicio."""
+    prefix = f"{PUBLIC_URL}/files/"
+    if not isinstance(url, str) or not url.startswith(prefix):
+        return None
+    return os.path.join(DOWNLOAD_DIR, unquote(url[len(prefix):]))
+
+def _result_files_exist(result: dict) -> bool:
+    """Verifica que todos los archivos referenciados en 'urls' sigan en disco."""
+    for url in (result.get("urls") or {}).values():
+        path = _local_path_for_url(url)
+        # En modo lazy el archivo puede no estar aún en disco, pero se sirve desde Telegram
+        if path and not os.path.exists(path) and os.path.basename(path) not in _lazy_media:
+            return False
+    return True
+
+def _cache_ttl_for(command: str) -> int:
+    command_name = command.split(' ')[0].lstrip('/').lower()
+    return int(CACHE_TTL_BY_COMMAND.get(command_name, CACHE_DEFAULT_TTL))
+
+def _cache_db_execute(sql: str, params: tuple = ()):
+    """Ejecuta una escritura en la base SQLite de la caché (en el hilo de _cache_db_executor)."""
+    if not _cache_db:
+        return
+    try:
+        _cache_db.execute(sql, params)
+        _cache_db.commit()
+    except Exception as e:
+        print(f"⚠️ Error al escribir en la caché SQLite: {e}")
+
+def _cache_remove(key: str, stat: str):
+    """Elimina una entrada de la caché (memoria y disco). Requiere _cache_lock."""
+    entry = _result_cache.pop(key, None)
+    if entry is not None:
+        media_store_retain(entry["result"], -1)
+    cache_stats[stat] += 1
+    if _cache_db:
+        _cache_db_executor.submit(_cache_db_execute, "DELETE FROM result_cache WHERE key = ?", (key,))
+
+def cache_get(command: str) -> dict | None:
+    """Devuelve una copia del resultado cacheado del comando, o None si no hay uno vigente."""
+    if not CACHE_ENABLED:
+        return None
+    key = _normalize_command_key(command)
+    now = time.time()
+    with _cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None:
+            cache_stats["misses"] += 1
+            return None
+        if entry["expires_at"] <= now:
+            _cache_remove(key, "expired")
+            cache_stats["misses"] += 1
+            return None
+        result = copy.deepcopy(entry["result"])
+        check_files = now - entry.get("files_checked_at", 0) >= CACHE_FILES_CHECK_SECONDS
+
+    # Los os.path.exists van sin el lock y solo cada CACHE_FILES_CHECK_SECONDS por entrada
+    # (cache_get corre en el bucle de Telethon)
+    if check_files and not _result_files_exist(result):
+        with _cache_lock:
+            # Alguna foto/PDF ya no existe en disco: la entrada no sirve (si nadie la reemplazó entretanto)
+            if _result_cache.get(key) is entry:
+                _cache_remove(key, "missing_files")
+            cache_stats["misses"] += 1
+        return None
+
+    with _cache_lock:
+        if check_files:
+            entry["files_checked_at"] = now
+        if _result_cache.get(key) is entry:
+            _result_cache.move_to_end(key)
+        cache_stats["hits"] += 1
+    return result
+
+def cache_put(command: str, result: dict):
+    """Guarda un resultado exitoso ('status' == 'ok') con el TTL de su comando."""
+    if not CACHE_ENABLED or result.get("status") != "ok":
+        return
+    ttl = _cache_ttl_for(command)
+    if ttl <= 0:
+        return
+    key = _normalize_command_key(command)
+    expires_at = time.time() + ttl
+    stored = copy.deepcopy(result)
+    stored_json = json.dumps(stored) if _cache_db else None
+    with _cache_lock:
+        previous = _result_cache.get(key)
+        if previous is not None:
+            media_store_retain(previous["result"], -1)
+        _result_cache[key] = {"expires_at": expires_at, "result": stored}
+        media_store_retain(stored, +1)
+        _result_cache.move_to_end(key)
+        cache_stats["stores"] += 1
+        while len(_result_cache) > CACHE_MAX_ENTRIES:
+            evicted_key, evicted = _result_cache.popitem(last=False)
+            media_store_retain(evicted["result"], -1)
+            cache_stats["evictions"] += 1
+            if _cache_db:
+                _cache_db_executor.submit(_cache_db_execute, "DELETE FROM result_cache WHERE key = ?", (evicted_key,))
+        # Se encarga dentro del lock (solo encola) para que el orden en disco sea el de la memoria
+        if _cache_db:
+            _cache_db_executor.submit(_cache_db_execute,
+                "INSERT OR REPLACE INTO result_cache (key, expires_at, result) VALUES (?, ?, ?)",
+                (key, expires_at, stored_json))
+
+def get_cache_status() -> dict:
+    """Contadores de la caché para /status."""
+    with _cache_lock:
+        lookups = cache_stats["hits"] + cache_stats["misses"]
+        return {
+            "enabled": CACHE_ENABLED,
+            "entries": len(_result_cache),
+            "max_entries": CACHE_MAX_ENTRIES,
+            "persistent": bool(_cache_db),
+            "hit_rate": round(cache_stats["hits"] / lookups, 4) if lookups else None,
+            **cache_stats,
+        }
+
+def load_result_cache():
+    """Abre la base SQLite de la caché (si CACHE_DB está definido) y carga las entradas vigentes."""
+    global _cache_db
+    if not CACHE_ENABLED or not CACHE_DB:
+        return
+    try:
+        _cache_db = sqlite3.connect(CACHE_DB, check_same_thread=False)
+        _cache_db.execute("CREATE TABLE IF NOT EXISTS result_cache (key TEXT PRIMARY KEY, expires_at REAL, result TEXT)")
+        _cache_db.execute("DELETE FROM result_cache WHERE expires_at <= ?", (time.time(),))
+        _cache_db.commit()
+        rows = _cache_db.execute(
+            "SELECT key, expires_at, result FROM result_cache ORDER BY expires_at DESC LIMIT ?", (CACHE_MAX_ENTRIES,)
+        ).fetchall()
+        with _cache_lock:
+            for key, expires_at, result in reversed(rows):
+                _result_cache[key] = {"expires_at": expires_at, "result": json.loads(result)}
+                media_store_retain(_result_cache[key]["result"], +1)
+        print(f"🗃️ Caché de resultados cargada desde {CACHE_DB}: {len(rows)} entrada(s).")
+    except Exception as e:
+        print(f"⚠️ No se pudo abrir la caché SQLite {CACHE_DB}: {e}. Se usará solo memoria.")
+        _cache_db = None
+
+if GATEWAY_ROLE != "worker": # En modo worker la caché vive en el broker
+    load_result_cache()
 
 # --- Aplicación Flask ---
 
 app = Flask(__name__)
 CORS(app)
+# Con un proxy delante (nginx/Apache), /files puede delegarle el envío del archivo (X-Sendfile)
+app.config["USE_X_SENDFILE"] = os.getenv("FILES_X_SENDFILE", "0") == "1"
 
 # --- Bucle Asíncrono para Telethon ---
 
@@ -109,7 +1117,65 @@ else:
     session = "consulta_pe_session" 
     print("📂 Usando sesión 'consulta_pe_session'")
 
-client = TelegramClient(session, API_ID, API_HASH, loop=loop)
+if GATEWAY_ROLE == "worker":
+    # Los workers HTTP no abren la sesión de Telegram: todo pasa por el broker
+    client = None
+else:
+    client = TelegramClient(session, API_ID, API_HASH, loop=loop)
+
+# --- Pool de Cuentas de Telegram ---
+
+# Cuentas adicionales para repartir las consultas (cada cuenta tiene sus propios límites de Telegram):
+# SESSION_STRINGS="sesion2,sesion3". La cuenta principal ('principal') es siempre 'client' y es la
+# que usan /login, /code, /send y /status.
+SESSION_STRINGS = [value.strip() for value in os.getenv("SESSION_STRINGS", "").split(",") if value.strip()]
+
+# [{"name": str, "client": TelegramClient, "authorized": bool | None, "paused_until": loop.time(), ...}]
+accounts = []
+# {id(TelegramClient): cuenta} para saber qué cuenta recibió cada mensaje
+_account_by_client_id = {}
+
+def _add_account(name: str, account_client: TelegramClient) -> dict:
+    account = {
+        "name": name,
+        "client": account_client,
+        "authorized": None, # None = aún no verificado
+        "paused_until": 0.0, # loop.time() hasta el que la cuenta está en FloodWait
+        "flood_waits": 0,
+        "sent": 0,
+    }
+    accounts.append(account)
+    _account_by_client_id[id(account_client)] = account
+    return account
+
+if client is not None:
+    _add_account("principal", client)
+    for _index, _session_string in enumerate(SESSION_STRINGS, 2):
+        _add_account(f"cuenta_{_index}", TelegramClient(StringSession(_session_string), API_ID, API_HASH, loop=loop))
+if len(accounts) > 1:
+    print(f"👥 Pool de {len(accounts)} cuentas de Telegram configurado.")
+
+async def _refresh_accounts_authorization() -> bool:
+    """Actualiza el estado de autorización de cada cuenta. Devuelve True si alguna está autorizada."""
+    for account in accounts:
+        try:
+            account["authorized"] = await account["client"].is_user_authorized()
+        except Exception:
+            account["authorized"] = False
+    return any(account["authorized"] for account in accounts)
+
+def get_accounts_status() -> list:
+    """Estado de las cuentas del pool para /status."""
+    return [
+        {
+            "name": account["name"],
+            "authorized": account["authorized"],
+            "paused_for": round(account_flood_wait_remaining(account), 1),
+            "flood_waits": account["flood_waits"],
+            "sent": account["sent"],
+        }
+        for account in accounts
+    ]
 
 # Mensajes en memoria (usaremos esto como caché de respuestas)
 messages = deque(maxlen=2000)
@@ -119,89 +1185,542 @@ _messages_lock = threading.Lock()
 # {command_id: {"future": asyncio.Future, "messages": list, "dni": str, "command": str, "timer": asyncio.TimerHandle, "sent_to_bot": str, "has_response": bool}}
 response_waiters = {} 
 
+# Índices sobre response_waiters para despachar cada mensaje en O(1) (protegidos por _messages_lock).
+# Una "ruta" es (cuenta, bot_id): las respuestas de un bot solo van a esperas de la cuenta que envió el comando.
+# {(ruta, dni): {command_id, ...}} para comandos por DNI y {ruta: {command_id, ...}} para el resto
+_waiters_by_dni = {}
+_waiters_without_dni = {}
+# {(ruta, id_del_mensaje_enviado): command_id} para correlacionar por el 'reply_to' del bot
+_waiters_by_reply = {}
+# {ruta: (command_id, loop.time())} última espera que recibió un mensaje correlacionado por esa ruta
+_last_correlated_waiter = {}
+
+# Correlaciones de intentos abandonados (hedging): {("reply", ruta, msg_id) | ("dni", ruta, dni): expira_en}
+_discarded_correlations = {}
+
+# Longitud mínima del valor consultado (teléfono, placa, RUC...) para buscarlo en el texto de la respuesta
+MIN_QUERY_KEY_LENGTH = 5
+
+# IDs de comando únicos (time.time() podía repetirse con consultas simultáneas)
+_command_ids = itertools.count(1)
+
+# {telegram_user_id: bot_id} para identificar al bot remitente sin recorrer la lista de bots
+_bot_name_by_id = {}
+
+def _normalize_query_value(value: str) -> str:
+    """Normaliza un valor de consulta o un texto para compararlos (mayúsculas, solo letras y dígitos)."""
+    return re.sub(r"[^0-9A-Z]", "", (value or "").upper())
+
+def _query_key_for_command(command: str) -> str | None:
+    """Valor consultado por un comando sin DNI (ej: '/denp ABC-123' -> 'ABC123'), si es suficientemente distintivo."""
+    parts = command.split(' ', 1)
+    if len(parts) < 2:
+        return None
+    key = _normalize_query_value(parts[1])
+    return key if len(key) >= MIN_QUERY_KEY_LENGTH else None
+
+def _register_waiter(command_id, waiter_data):
+    """Registra una espera y la indexa por (ruta, DNI) o por ruta. Requiere _messages_lock."""
+    response_waiters[command_id] = waiter_data
+    route = waiter_data["route"]
+    if waiter_data.get("dni"):
+        _waiters_by_dni.setdefault((route, waiter_data["dni"]), set()).add(command_id)
+    else:
+        _waiters_without_dni.setdefault(route, set()).add(command_id)
+
+def _index_waiter_reply(command_id, sent_msg_id: int):
+    """Asocia el ID del mensaje enviado al bot con la espera, para reconocer sus 'reply_to'. Requiere _messages_lock."""
+    waiter_data = response_waiters.get(command_id)
+    if not waiter_data or sent_msg_id is None:
+        return
+    waiter_data["sent_msg_id"] = sent_msg_id
+    _waiters_by_reply[(waiter_data["route"], sent_msg_id)] = command_id
+
+def _unregister_waiter(command_id):
+    """Elimina una espera y sus entradas de índice. Devuelve el waiter o None. Requiere _messages_lock."""
+    waiter_data = response_waiters.pop(command_id, None)
+    if not waiter_data:
+        return None
+    route = waiter_data["route"]
+    if waiter_data.get("dni"):
+        index_key, index = (route, waiter_data["dni"]), _waiters_by_dni
+    else:
+        index_key, index = route, _waiters_without_dni
+    ids = index.get(index_key)
+    if ids is not None:
+        ids.discard(command_id)
+        if not ids:
+            index.pop(index_key, None)
+    if waiter_data.get("sent_msg_id") is not None:
+        _waiters_by_reply.pop((route, waiter_data["sent_msg_id"]), None)
+    return waiter_data
+
+def _discard_late_replies(route: tuple, sent_msg_id: int | None, dni: str | None):
+    """Marca las respuestas de un intento abandonado para descartarlas al llegar. Requiere _messages_lock."""
+    now = loop.time()
+    if len(_discarded_correlations) > 1000:
+        for key in [k for k, expires_at in _discarded_correlations.items() if expires_at <= now]:
+            _discarded_correlations.pop(key, None)
+    expires_at = now + DISCARD_LATE_REPLIES_SECONDS
+    if sent_msg_id is not None:
+        _discarded_correlations[("reply", route, sent_msg_id)] = expires_at
+    if dni:
+        _discarded_correlations[("dni", route, dni)] = expires_at
+
+def _is_discarded_reply(route: tuple, reply_to_msg_id: int | None, dni: str | None) -> bool:
+    """True si el mensaje es una respuesta tardía de un intento abandonado. Requiere _messages_lock."""
+    now = loop.time()
+    for key in (("reply", route, reply_to_msg_id), ("dni", route, dni)):
+        expires_at = _discarded_correlations.get(key)
+        if expires_at is not None and expires_at > now:
+            return True
+    return False
+
+def _find_waiters_for_message(route: tuple, message_dni: str | None, reply_to_msg_id: int | None = None, raw_text: str = "") -> list:
+    """
+    Devuelve [(command_id, waiter_data), ...] que deben recibir un mensaje llegado por la ruta (cuenta, bot).
+    Requiere _messages_lock.
+
+    Orden de correlación:
+    1. 'reply_to' del bot == ID del mensaje que enviamos: la espera exacta y solo esa.
+    2. DNI del mensaje: las esperas de ese DNI en ese bot.
+    3. Comandos sin DNI: las esperas cuyo valor consultado (teléfono, placa, RUC...) aparece en el texto.
+    4. Si nada coincide: la única espera sin DNI pendiente en el bot o, si hay varias, la última
+       espera del bot que recibió un mensaje correlacionado (mensajes de continuación: fotos, PDFs).
+    """
+    if reply_to_msg_id is not None:
+        command_id = _waiters_by_reply.get((route, reply_to_msg_id))
+        if command_id in response_waiters:
+            _last_correlated_waiter[route] = (command_id, loop.time())
+            return [(command_id, response_waiters[command_id])]
+
+    command_ids = []
+    if message_dni:
+        command_ids.extend(_waiters_by_dni.get((route, message_dni), ()))
+
+    candidates = _waiters_without_dni.get(route, ())
+    if candidates:
+        normalized_text = _normalize_query_value(raw_text)
+        command_ids.extend(
+            command_id for command_id in candidates
+            if response_waiters[command_id].get("query_key") and response_waiters[command_id]["query_key"] in normalized_text
+        )
+
+    if command_ids:
+        command_ids.sort() # Orden de llegada (los IDs son crecientes)
+        _last_correlated_waiter[route] = (command_ids[0], loop.time())
+    elif len(candidates) == 1:
+        command_ids = list(candidates)
+    else:
+        last = _last_correlated_waiter.get(route)
+        if last and last[0] in response_waiters and loop.time() - last[1] <= IDLE_GAP_MEDIA_SECONDS:
+            command_ids = [last[0]]
+
+    return [(command_id, response_waiters[command_id]) for command_id in command_ids if command_id in response_waiters]
+
 # Login pendiente
 pending_phone = {"phone": None, "sent_at": None}
 
 # --- Lógica de Limpieza y Extracción de Datos ---
 
+# Patrones de limpieza, compilados una sola vez al importar
+_PAGE_RE = re.compile(r"Página\s*(\d+)\s*\/\s*(\d+)", re.IGNORECASE)
+_BRAND_RE = re.compile(r"^\[\#LEDER\_BOT\]", re.IGNORECASE | re.DOTALL)
+_HEADER_RE = re.compile(r"^\[.*?\]\s*→\s*.*?\[.*?\](\r?\n){1,2}", re.IGNORECASE | re.DOTALL)
+_FOOTER_RE = re.compile(
+    r"(?=[\r\npsc↞w])((\r?\n){1,2}\[|Página\s*\d+\/\d+.*|(\r?\n){1,2}Por favor, usa el formato correcto.*|↞ Anterior|Siguiente ↠.*|Credits\s*:.+|Wanted for\s*:.+)",
+    re.IGNORECASE | re.DOTALL,
+)
+_SEPARATOR_RE = re.compile(r"\-{3,}")
+
+# Un par "CLAVE : valor" al inicio de una línea (con viñetas o emojis opcionales delante) o en medio
+# de ella tras 2+ espacios o un "|" ("NOMBRES : X  DNI : 12345678", "A : 1 | B : 2"), o un separador
+# "---" entre elementos de una lista. Un solo finditer sobre el mensaje recoge todos los pares.
+# Las etiquetas del bot no llevan comas (así no se toman frases) y tras los dos puntos no puede
+# venir "//" (una línea con solo una URL no es un par "https : //..."). El valor llega hasta el final
+# de la línea o hasta el siguiente par de la misma línea.
+_INLINE_SEPARATOR = r"(?:[ \t]{2,}|[ \t]*\|[ \t]*)[^\w\n]*"
+_FIELD_LABEL = r"[^\W\d_][^:,|\n]{0,59}?[ \t]*:(?!//)"
+_FIELD_LINE_RE = re.compile(
+    rf"^[ \t]*(-{{3,}})[ \t]*$"
+    rf"|(?:^[^\w\n]*|{_INLINE_SEPARATOR})([^\W\d_][^:,|\n]{{0,59}}?)[ \t]*:(?!//)[ \t]*"
+    rf"((?:[^ \t|\n]+|(?!{_INLINE_SEPARATOR}{_FIELD_LABEL})[ \t|])*)",
+    re.MULTILINE,
+)
+# Pares del pie del bot que no son datos de la consulta
+_IGNORED_FIELD_KEYS = {"credits", "wanted_for"}
+
+# Campos canónicos de 'fields', elegidos por la última palabra de la clave normalizada
+# ("DNI", "N° DNI" -> dni). Valor: (campo, patrón del valor, pasar a minúsculas). Gana el primero válido.
+_CANONICAL_FIELDS = {
+    "dni": ("dni", re.compile(r"\d{8}"), False),
+    "ruc": ("ruc", re.compile(r"\d{11}"), False),
+    # Etiqueta las fotos de /dnif y /dnivaz ('rostro', 'huella', ... como las nombra el bot original)
+    "foto": ("photo_type", re.compile(r"rostro|huella|firma|adverso|reverso", re.IGNORECASE), True),
+}
+_CANONICAL_NAMES = {spec[0] for spec in _CANONICAL_FIELDS.values()}
+
+# Si la pasada no encontró el DNI (del que depende la correlación con las esperas) se busca una vez
+# en cualquier parte del texto, con los patrones de siempre, para etiquetas pegadas a otro texto.
+_CANONICAL_FALLBACK_RE = re.compile(
+    r"DNI\s*:\s*(\d{8})|RUC\s*:\s*(\d{11})|Foto\s*:\s*(rostro|huella|firma|adverso|reverso)", re.IGNORECASE
+)
+
+# Claves que usa el guardado: una etiqueta con prefijo ("Ciudadano Nombres", "N° Operador") también
+# las rellena, como hacían las búsquedas por subcadena de antes.
+_SAVE_FIELD_SUFFIXES = (
+    "nombres", "nombre", "apellido_paterno", "apellido_materno", "razon_social",
+    "actividad_principal", "fecha_de_emision", "operador", "titular",
+)
+_field_aliases = {} # {clave normalizada: clave de _SAVE_FIELD_SUFFIXES en la que termina, o None}
+
+def _field_alias(key: str) -> str | None:
+    if key not in _field_aliases:
+        _field_aliases[key] = next((suffix for suffix in _SAVE_FIELD_SUFFIXES if key.endswith("_" + suffix)), None)
+    return _field_aliases[key]
+
+_field_keys = {} # Memo de normalize_field_key (las claves que usa el bot son pocas)
+
+def normalize_field_key(label: str) -> str:
+    """'Apellido Paterno' -> 'apellido_paterno', 'Razón Social' -> 'razon_social'."""
+    key = _field_keys.get(label)
+    if key is None:
+        ascii_label = unicodedata.normalize("NFKD", label).encode("ascii", "ignore").decode("ascii")
+        key = "_".join(re.findall(r"[a-z0-9]+", ascii_label.lower()))
+        if len(_field_keys) < 4096:
+            _field_keys[label] = key
+    return key
+
+def extract_fields(text: str) -> tuple[dict, list]:
+    """
+    Recorre el texto una vez y devuelve (fields, pairs):
+    - fields: todos los pares 'clave : valor' con la clave normalizada, más los campos canónicos
+      (dni, ruc, photo_type) validados. Ante claves repetidas gana la primera.
+    - pairs: los mismos pares en orden, [clave, valor], con None en cada separador "---"
+      (de ahí salen las listas de la salida estructurada).
+    """
+    fields = {}
+    pairs = []
+    for match in _FIELD_LINE_RE.finditer(text):
+        if match.group(1):
+            pairs.append(None)
+            continue
+        key = normalize_field_key(match.group(2))
+        if not key or key in _IGNORED_FIELD_KEYS:
+            continue
+        value = match.group(3).rstrip()
+        pairs.append([key, value])
+        canonical = _CANONICAL_FIELDS.get(key.rsplit("_", 1)[-1])
+        if canonical and canonical[0] not in fields:
+            value_match = canonical[1].match(value)
+            if value_match:
+                fields[canonical[0]] = value_match.group(0).lower() if canonical[2] else value_match.group(0)
+        # Los campos canónicos solo salen de su regla (un 'DNI : -' no debe llegar a fields["dni"])
+        if key not in _CANONICAL_NAMES and key not in fields:
+            fields[key] = value
+            alias = _field_alias(key)
+            if alias:
+                fields.setdefault(alias, value)
+    return fields, pairs
+
+def _fill_fallback_fields(text: str, fields: dict):
+    """Completa dni, ruc y photo_type con _CANONICAL_FALLBACK_RE (una sola búsqueda, solo si falta el DNI)."""
+    if "dni" in fields:
+        return
+    for match in _CANONICAL_FALLBACK_RE.finditer(text):
+        if match.group(1):
+            fields.setdefault("dni", match.group(1))
+        elif match.group(2):
+            fields.setdefault("ruc", match.group(2))
+        else:
+            fields.setdefault("photo_type", match.group(3).lower())
+
 def clean_and_extract(raw_text: str):
     """Limpia el texto de cabeceras/pies y extrae campos clave. REEMPLAZA MARCA LEDER BOT."""
     if not raw_text:
-        return {"text": "", "fields": {}}
+        return {"text": "", "fields": {}, "pairs": [], "page": None}
 
-    text = raw_text
-    
-    # 1. Reemplazar la marca LEDER_BOT por CONSULTA PE
-    # Esto busca y reemplaza la primera ocurrencia de [#LEDER_BOT]
-    text = re.sub(r"^\[\#LEDER\_BOT\]", "[CONSULTA PE]", text, flags=re.IGNORECASE | re.DOTALL)
-    
-    # 2. Eliminar cabecera (patrón más robusto)
-    # Buscamos la cabecera hasta "==============================\s*"
-    # Eliminamos el encabezado que contiene [CONSULTA PE] o [#LEDER_BOT]
-    header_pattern = r"^\[.*?\]\s*→\s*.*?\[.*?\](\r?\n){1,2}"
-    text = re.sub(header_pattern, "", text, flags=re.IGNORECASE | re.DOTALL)
-    
-    # 3. Eliminar pie (patrón más robusto para créditos/paginación/warnings al final)
-    footer_pattern = r"((\r?\n){1,2}\[|Página\s*\d+\/\d+.*|(\r?\n){1,2}Por favor, usa el formato correcto.*|↞ Anterior|Siguiente ↠.*|Credits\s*:.+|Wanted for\s*:.+)"
-    text = re.sub(footer_pattern, "", text, flags=re.IGNORECASE | re.DOTALL)
-    
-    # 4. Limpiar separador (si queda)
-    text = re.sub(r"\-{3,}", "", text, flags=re.IGNORECASE | re.DOTALL)
+    # 0. Capturar la paginación ("Página N/M") antes de que el pie la elimine.
+    # Se usa para saber si ya llegaron todas las páginas de la respuesta.
+    page = None
+    page_match = _PAGE_RE.search(raw_text)
+    if page_match:
+        page = [int(page_match.group(1)), int(page_match.group(2))]
 
-    # 5. Limpiar espacios
-    text = text.strip()
+    # 1. Reemplazar la primera marca [#LEDER_BOT] por [CONSULTA PE]
+    text = _BRAND_RE.sub("[CONSULTA PE]", raw_text)
+    # 2. Eliminar la cabecera "[...] → ... [...]"
+    text = _HEADER_RE.sub("", text)
+    # 3. Extraer todos los campos en una sola pasada. Se hace antes de quitar el pie, que también
+    # une las líneas de título de sección ("\n\n[📍] DIRECCION") con la línea anterior.
+    fields, pairs = extract_fields(text)
+    # 4. Eliminar el pie (créditos, paginación, avisos)
+    text = _FOOTER_RE.sub("", text)
+    # 5. Limpiar separador (si queda) y espacios
+    text = _SEPARATOR_RE.sub("", text).strip()
+    # 6. Sin DNI en la pasada: búsqueda de los campos canónicos en el texto limpio (como siempre)
+    _fill_fallback_fields(text, fields)
 
-    # 6. Extraer datos clave
-    fields = {}
-    # Extracción de DNI de 8 dígitos
-    dni_match = re.search(r"DNI\s*:\s*(\d{8})", text, re.IGNORECASE)
-    if dni_match: fields["dni"] = dni_match.group(1)
-    
-    # Extracción de RUC de 11 dígitos
-    ruc_match = re.search(r"RUC\s*:\s*(\d{11})", text, re.IGNORECASE)
-    if ruc_match: fields["ruc"] = ruc_match.group(1)
+    return {"text": text, "fields": fields, "pairs": pairs, "page": page}
 
-    # Extracción de tipo de foto para /dnif y /dnivaz (para etiquetar las URLs)
-    # NOTA: Se usan 'rostro', 'huella', 'firma', 'adverso', 'reverso' del bot original
-    photo_type_match = re.search(r"Foto\s*:\s*(rostro|huella|firma|adverso|reverso).*", text, re.IGNORECASE)
-    if photo_type_match: fields["photo_type"] = photo_type_match.group(1).lower()
+# --- Detección de respuesta completa ---
 
-    return {"text": text, "fields": fields}
+def _cancel_waiter_timers(waiter_data):
+    """Cancela el timer de timeout y el de silencio de una espera."""
+    for key in ("timer", "first_timer", "idle_timer"):
+        if waiter_data.get(key):
+            waiter_data[key].cancel()
 
-# --- Handler de nuevos mensajes ---
+def _resolve_waiter_on_idle(command_id):
+    """Resuelve la espera con los mensajes acumulados cuando el bot deja de enviar."""
+    with _messages_lock:
+        waiter_data = response_waiters.get(command_id)
+        if waiter_data and waiter_data["pending_downloads"]:
+            # El bot ya terminó pero falta media por descargar: se resuelve con la última descarga
+            waiter_data["resolve_after_downloads"] = True
+            return
+        waiter_data = _unregister_waiter(command_id)
+        if not waiter_data or waiter_data["future"].done():
+            return
+        _cancel_waiter_timers(waiter_data)
+        print(f"⚡ Respuesta completa de {waiter_data['sent_to_bot']} ({len(waiter_data['messages'])} mensaje(s)) sin esperar el timeout.")
+        waiter_data["future"].set_result(waiter_data["messages"])
 
-async def _on_new_message(event):
-    """Intercepta mensajes y resuelve las esperas de API si aplica."""
-    try:
-        # 1. Verificar si el mensaje viene de alguno de los bots
-        sender_is_bot = False
-        
-        # Obtenemos los IDs de los bots al inicio si es posible, para evitar llamadas a la API en cada mensaje
-        if not hasattr(_on_new_message, 'bot_ids'):
-            _on_new_message.bot_ids = {}
-            # Necesitamos resolver la entidad AQUI. Esto debe ser SÍNCRONO al cargar el handler
-            # pero dado que telethon requiere await, se hace la primera vez
-            for bot_name in ALL_BOT_IDS:
-                try:
-                    entity = await client.get_entity(bot_name)
-                    _on_new_message.bot_ids[bot_name] = entity.id
-                except Exception as e:
-                    print(f"Error al obtener entidad para {bot_name}: {e}")
+def _schedule_waiter_completion(command_id, waiter_data, msg_obj):
+    """
+    Decide cuánto esperar antes de dar la respuesta por terminada y reprograma el timer de silencio.
+    Debe llamarse con _messages_lock tomado y desde el bucle de Telethon.
 
+    - Si ya llegaron todas las páginas ("Página N/M") o todos los tipos de media esperados
+      por el comando, se cierra tras COMPLETION_GRACE_SECONDS.
+    - Si el comando espera media que aún no llegó, se usa IDLE_GAP_MEDIA_SECONDS.
+    - En otro caso se cierra tras IDLE_GAP_SECONDS sin mensajes nuevos.
+    """
+    # Llegó otro mensaje: el timer de silencio vuelve a decidir cuándo termina la respuesta
+    waiter_data["resolve_after_downloads"] = False
 
-        if event.sender_id in _on_new_message.bot_ids.values():
-            sender_is_bot = True
-        
-        if not sender_is_bot:
-            return # Ignorar mensajes que no sean de los bots
-            
-        raw_text = event.raw_text or ""
+    for url_obj in msg_obj.get("urls", []):
+        waiter_data["media_seen"].add(url_obj["type"].lower())
+
+    if msg_obj.get("page"):
+        page_num, page_total = msg_obj["page"]
+        waiter_data["pages_seen"].add(page_num)
+        waiter_data["pages_total"] = page_total
+
+    expected_media = waiter_data["expected_media"]
+    media_complete = bool(expected_media) and expected_media <= waiter_data["media_seen"]
+    pages_complete = bool(waiter_data["pages_total"]) and len(waiter_data["pages_seen"]) >= waiter_data["pages_total"]
+
+    if media_complete or (pages_complete and not expected_media):
+        delay = COMPLETION_GRACE_SECONDS
+    elif expected_media:
+        delay = IDLE_GAP_MEDIA_SECONDS
+    else:
+        delay = IDLE_GAP_SECONDS
+
+    # Un silencio aprendido del perfil del comando sustituye al valor por defecto
+    # (salvo cuando la respuesta ya se sabe completa o aún falta media)
+    if waiter_data.get("idle_gap") and delay == IDLE_GAP_SECONDS:
+        delay = waiter_data["idle_gap"]
+
+    if waiter_data["idle_timer"]:
+        waiter_data["idle_timer"].cancel()
+    waiter_data["idle_timer"] = loop.call_later(delay, _resolve_waiter_on_idle, command_id)
+
+# --- Descarga de media en segundo plano ---
+
+# _on_new_message no espera las descargas: registra el mensaje con la URL definitiva del archivo
+# (aún pendiente) y encola la descarga. Las esperas que reciben el mensaje no se dan por
+# terminadas hasta que se completan sus descargas (o vence su tope total).
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "4")) # Descargas en paralelo
+MEDIA_DOWNLOAD_QUEUE_SIZE = int(os.getenv("MEDIA_DOWNLOAD_QUEUE_SIZE", "500"))
+
+_media_download_queue = None # asyncio.Queue, se crea con los workers dentro del bucle de Telethon
+_media_download_workers = []
+_media_downloads_in_flight = {} # {ruta: job} para no descargar dos veces el mismo archivo a la vez
+media_stats = {"downloaded": 0, "failed": 0, "bytes": 0, "seconds": 0.0, "active": 0}
+_media_download_durations = deque(maxlen=200) # Segundos de las últimas descargas (para p50/p95)
+
+async def _media_download_worker():
+    while True:
+        job = await _media_download_queue.get()
+        started = loop.time()
+        media_stats["active"] += 1
+        try:
+            saved_path = await job["client"].download_media(job["message"], file=job["path"])
+            elapsed = loop.time() - started
+            media_stats["downloaded"] += 1
+            media_stats["bytes"] += os.path.getsize(saved_path)
+            media_stats["seconds"] += elapsed
+            _media_download_durations.append(elapsed)
+            if os.path.abspath(saved_path) != os.path.abspath(job["path"]):
+                # Telethon eligió otro nombre: la URL publicada debe apuntar al archivo real
+                with _messages_lock:
+                    for url_obj, _ in job["targets"]:
+                        url_obj["url"] = f"{PUBLIC_URL}/files/{os.path.basename(saved_path)}"
+            await loop.run_in_executor(None, media_store_add, os.path.basename(saved_path))
+            job["future"].set_result(saved_path)
+        except Exception as e:
+            print(f"Error al descargar media: {e}")
+            media_stats["failed"] += 1
+            # Como antes: un archivo que no se pudo descargar no aparece en 'urls'
+            with _messages_lock:
+                for url_obj, urls in job["targets"]:
+                    if url_obj in urls:
+                        urls.remove(url_obj)
+            job["future"].set_result(None)
+        finally:
+            media_stats["active"] -= 1
+            _media_downloads_in_flight.pop(job["path"], None)
+            _media_download_queue.task_done()
+
+async def _enqueue_media_download(account_client, message, path: str, url_obj: dict, urls: list) -> asyncio.Future:
+    """
+    Encola la descarga de la media del mensaje. El Future se resuelve con la ruta guardada (o None si falló).
+    Si el mismo archivo ya se está descargando, se comparte esa descarga.
+    """
+    global _media_download_queue
+    in_flight = _media_downloads_in_flight.get(path)
+    if in_flight is not None:
+        in_flight["targets"].append((url_obj, urls))
+        media_store_stats["shared_downloads"] += 1
+        return in_flight["future"]
+    if _media_download_queue is None:
+        _media_download_queue = asyncio.Queue(maxsize=MEDIA_DOWNLOAD_QUEUE_SIZE)
+        for _ in range(MEDIA_DOWNLOAD_WORKERS):
+            _media_download_workers.append(asyncio.ensure_future(_media_download_worker()))
+    # 'targets': (url_obj, lista 'urls' del mensaje) de cada mensaje que espera este archivo
+    job = {"client": account_client, "message": message, "path": path, "targets": [(url_obj, urls)], "future": loop.create_future()}
+    _media_downloads_in_flight[path] = job
+    await _media_download_queue.put(job) # Solo espera si la cola está llena (contrapresión)
+    return job["future"]
+
+def _on_waiter_download_done(command_id, download):
+    """Al terminar una descarga de la espera, la resuelve si el bot ya había terminado y no falta nada."""
+    with _messages_lock:
+        waiter_data = response_waiters.get(command_id)
+        if not waiter_data:
+            return
+        waiter_data["pending_downloads"].discard(download)
+        ready = not waiter_data["pending_downloads"] and waiter_data["resolve_after_downloads"]
+    if ready:
+        _resolve_waiter_on_idle(command_id)
+
+def get_media_status() -> dict:
+    """Estado de las descargas de media para /status."""
+    durations = list(_media_download_durations)
+    p50, p95 = _percentile(durations, 50), _percentile(durations, 95)
+    return {
+        **media_stats,
+        "seconds": round(media_stats["seconds"], 2),
+        "queued": _media_download_queue.qsize() if _media_download_queue else 0,
+        "workers": MEDIA_DOWNLOAD_WORKERS,
+        "p50_seconds": round(p50, 2) if p50 is not None else None,
+        "p95_seconds": round(p95, 2) if p95 is not None else None,
+        "store": get_media_store_status(),
+    }
+
+# --- Media perezosa (MEDIA_MODE=lazy) ---
+
+# En modo "lazy" no se descarga nada al recibir el mensaje: se guarda la referencia de Telegram
+# del archivo y se publica su URL. La primera petición a /files/<nombre> lo baja de Telegram y lo
+# envía al cliente a la vez que lo guarda en DOWNLOAD_DIR; las siguientes lo sirven del disco.
+MEDIA_MODE = os.getenv("MEDIA_MODE", "eager").lower() # "eager" (pool de descargas) o "lazy"
+LAZY_MEDIA_MAX_ENTRIES = int(os.getenv("LAZY_MEDIA_MAX_ENTRIES", "20000")) # Referencias guardadas
+
+# {nombre de archivo: {"client", "message", "size", "mime_type"}} en orden de registro (las más viejas se olvidan)
+_lazy_media = OrderedDict()
+
+def _register_lazy_media(filename: str, account_client, message, media):
+    document = getattr(media, "document", None)
+    _lazy_media[filename] = {
+        "client": account_client,
+        "message": message,
+        "size": getattr(document, "size", None), # Las fotos no traen tamaño: se envían sin Content-Length
+        "mime_type": getattr(document, "mime_type", None) or "image/jpeg",
+    }
+    while len(_lazy_media) > LAZY_MEDIA_MAX_ENTRIES:
+        _lazy_media.popitem(last=False)
+
+async def stream_lazy_media(filename: str):
+    """
+    Baja de Telegram un archivo registrado en modo lazy: produce ("meta", {"size", "mime_type"})
+    y luego ("chunk", bytes), guardándolo a la vez en DOWNLOAD_DIR. No produce nada si el
+    archivo no está registrado.
+    """
+    entry = _lazy_media.get(filename)
+    if entry is None:
+        return
+    path = os.path.join(DOWNLOAD_DIR, filename)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part" # Cada petición simultánea escribe su propio temporal
+    started = loop.time()
+    completed = False
+    yield "meta", {"size": entry["size"], "mime_type": entry["mime_type"]}
+    try:
+        with open(tmp_path, "wb") as tmp_file:
+            async for chunk in entry["client"].iter_download(entry["message"].media):
+                tmp_file.write(chunk)
+                yield "chunk", bytes(chunk)
+        os.replace(tmp_path, path) # Atómico: /files nunca ve un archivo a medias
+        completed = True
+        elapsed = loop.time() - started
+        media_stats["downloaded"] += 1
+        media_stats["bytes"] += os.path.getsize(path)
+        media_stats["seconds"] += elapsed
+        _media_download_durations.append(elapsed)
+        loop.run_in_executor(None, media_store_add, filename)
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path) # Cliente desconectado o error: no se guarda nada parcial
+
+# --- Handler de nuevos mensajes ---
+
+# Claves de uso interno de cada mensaje (paginación y pares para la salida estructurada).
+# No salen en /get ni en /stream: el mensaje público es el de siempre (chat_id, from_id, date, message, fields, urls).
+_MESSAGE_INTERNAL_KEYS = ("page", "pairs")
+
+def public_message(msg_obj: dict) -> dict:
+    return {key: value for key, value in msg_obj.items() if key not in _MESSAGE_INTERNAL_KEYS}
+
+async def _on_new_message(event):
+    """Intercepta mensajes y resuelve las esperas de API si aplica."""
+    try:
+        # 1. Verificar si el mensaje viene de alguno de los bots
+        sender_is_bot = False
+        # Cuenta del pool que recibió el mensaje: las respuestas se enrutan por (cuenta, bot)
+        account = _account_by_client_id.get(id(event.client), accounts[0])
+        account_client = account["client"]
+        
+        # Obtenemos los IDs de los bots al inicio si es posible, para evitar llamadas a la API en cada mensaje
+        if not hasattr(_on_new_message, 'bot_ids'):
+            _on_new_message.bot_ids = {}
+            # Necesitamos resolver la entidad AQUI. Esto debe ser SÍNCRONO al cargar el handler
+            # pero dado que telethon requiere await, se hace la primera vez
+            for bot_name in ALL_BOT_IDS:
+                try:
+                    entity = await account_client.get_entity(bot_name)
+                    _on_new_message.bot_ids[bot_name] = entity.id
+                    _bot_name_by_id[entity.id] = bot_name
+                except Exception as e:
+                    print(f"Error al obtener entidad para {bot_name}: {e}")
+
+
+        sender_bot_name = _bot_name_by_id.get(event.sender_id)
+        if sender_bot_name:
+            sender_is_bot = True
+        
+        if not sender_is_bot:
+            return # Ignorar mensajes que no sean de los bots
+        route = (account["name"], sender_bot_name)
+            
+        raw_text = event.raw_text or ""
         cleaned = clean_and_extract(raw_text)
         
         # Inicializar la lista de URLs para cada mensaje
         msg_urls = []
+        msg_downloads = [] # Descargas encoladas para este mensaje
 
-        # 2. Manejar archivos (media): Descarga TODOS los archivos adjuntos
+        # 2. Manejar archivos (media): encola la descarga de TODOS los archivos adjuntos
         if getattr(event, "message", None) and getattr(event.message, "media", None):
             media_list = []
             if isinstance(event.message.media, (MessageMediaDocument, MessageMediaPhoto)):
@@ -209,7 +1728,7 @@ async def _on_new_message(event):
             elif hasattr(event.message.media, 'webpage') and event.message.media.webpage and hasattr(event.message.media.webpage, 'photo'):
                  pass
             
-            # Si hay media, proceder a la descarga
+            # Si hay media, encolar su descarga (la URL se publica ya; el archivo llega después)
             if media_list:
                 try:
                     # Usar datetime.now(timezone.utc) para un nombre de archivo consistente
@@ -223,6 +1742,9 @@ async def _on_new_message(event):
                             file_ext = os.path.splitext(getattr(media.document, 'file_name', 'file'))[1]
                         elif isinstance(media, MessageMediaPhoto) or (hasattr(media, 'photo') and media.photo):
                             file_ext = '.jpg' # La foto de Telegram suele ser JPG
+                        if not file_ext:
+                            # El nombre debe fijarse ahora para que la URL publicada sea la definitiva
+                            file_ext = utils.get_extension(media) or '.file'
                             
                         # Si hay un DNI, lo incluimos en el nombre
                         dni_part = f"_{cleaned['fields'].get('dni')}" if cleaned["fields"].get("dni") else ""
@@ -230,24 +1752,34 @@ async def _on_new_message(event):
                         # Incluir el tipo de foto/documento en el nombre para depuración
                         type_part = f"_{cleaned['fields'].get('photo_type')}" if cleaned['fields'].get('photo_type') else ""
                         
-                        # Usar el ID del mensaje para unicidad
-                        unique_filename = f"{timestamp_str}_{event.message.id}{dni_part}{type_part}_{i}{file_ext}"
-                        
-                        # Descargar el medio
-                        saved_path = await client.download_media(event.message, file=os.path.join(DOWNLOAD_DIR, unique_filename))
-                        filename = os.path.basename(saved_path)
+                        # Nombre estable por id de Telegram (almacén direccionado por contenido); si la
+                        # media no trae id, se usa el ID del mensaje para unicidad
+                        unique_filename = media_store_name(media) or f"{timestamp_str}_{event.message.id}{dni_part}{type_part}_{i}{file_ext}"
+                        file_path = os.path.join(DOWNLOAD_DIR, unique_filename)
                         
                         # Estructura de URL mejorada
                         url_obj = {
-                            "url": f"{PUBLIC_URL}/files/{filename}", 
+                            "url": f"{PUBLIC_URL}/files/{unique_filename}", 
                             # Si es un PDF de denuncia de placa, el 'type' será 'file', lo dejamos así
                             "type": cleaned['fields'].get('photo_type', 'file'),
                             "text_context": raw_text.split('\n')[0].strip() # Cabecera del mensaje
                         }
                         msg_urls.append(url_obj)
+
+                        if file_path not in _media_downloads_in_flight and os.path.exists(file_path):
+                            # Ya está en disco (la misma foto de otra consulta): no se vuelve a descargar
+                            media_store_stats["skipped_downloads"] += 1
+                        elif MEDIA_MODE == "lazy":
+                            # Solo se guarda la referencia: se baja en la primera petición a /files
+                            _register_lazy_media(unique_filename, account_client, event.message, media)
+                        else:
+                            # Encolar la descarga en el pool de descargas
+                            msg_downloads.append(await _enqueue_media_download(
+                                account_client, event.message, file_path, url_obj, msg_urls
+                            ))
                         
                 except Exception as e:
-                    print(f"Error al descargar media: {e}")
+                    print(f"Error al encolar la descarga de media: {e}")
         
         msg_obj = {
             "chat_id": getattr(event, "chat_id", None),
@@ -255,50 +1787,57 @@ async def _on_new_message(event):
             "date": event.message.date.isoformat() if getattr(event, "message", None) else datetime.utcnow().isoformat(),
             "message": cleaned["text"],
             "fields": cleaned["fields"],
-            "urls": msg_urls # Usar la lista de URLs construida
+            "pairs": cleaned["pairs"],
+            "urls": msg_urls, # Usar la lista de URLs construida
+            "page": cleaned["page"]
         }
 
         # 3. Intentar resolver la espera de la API
         resolved = False
         with _messages_lock:
-            keys_to_check = list(response_waiters.keys())
-            for command_id in keys_to_check:
-                waiter_data = response_waiters.get(command_id)
-                if not waiter_data: continue
+            # Solo se consideran las esperas de la cuenta y bot remitentes: por 'reply_to', por DNI o por
+            # el valor consultado, gracias a los índices de _register_waiter.
+            reply_to_msg_id = getattr(event.message, "reply_to_msg_id", None) if getattr(event, "message", None) else None
+            matched_waiters = _find_waiters_for_message(route, cleaned["fields"].get("dni"), reply_to_msg_id, raw_text)
+            if not matched_waiters and _is_discarded_reply(route, reply_to_msg_id, cleaned["fields"].get("dni")):
+                # Respuesta tardía de un intento que perdió la carrera del hedging: se descarta
+                print(f"🗑️ Mensaje tardío de {sender_bot_name} ({account['name']}) descartado (intento abandonado).")
+                return
+            # Streaming (SSE): el mensaje sale ya hacia quien siga estas consultas en /stream
+            for command in {waiter_data["command"] for _, waiter_data in matched_waiters}:
+                _publish_partial_message(command, msg_obj)
+            for command_id, waiter_data in matched_waiters:
+                # Lógica de acumulación: Agregar el mensaje y marcar que HUBO respuesta
+                waiter_data["messages"].append(msg_obj)
+                waiter_data["has_response"] = True
 
-                command_dni = waiter_data.get("dni")
-                message_dni = cleaned["fields"].get("dni")
-                
-                # Coincidencia de DNI o si el comando no es por DNI 
-                dni_match = command_dni and command_dni == message_dni
-                no_dni_command = not command_dni 
-                
-                # Lógica simplificada: si el mensaje viene del bot al que se envió (sent_to_bot)
-                # O si el comando no es por DNI, solo verificamos que venga de CUALQUIER bot
-                sender_bot_name = next((name for name, id_ in _on_new_message.bot_ids.items() if id_ == event.sender_id), None)
-                sent_to_match = sender_bot_name and sender_bot_name == waiter_data.get("sent_to_bot")
+                # Tiempos para el perfil del comando
+                now = loop.time()
+                if waiter_data["first_at"] is None:
+                    waiter_data["first_at"] = now
+                    if not waiter_data["first_message"].done():
+                        waiter_data["first_message"].set_result(True)
+                else:
+                    waiter_data["max_gap"] = max(waiter_data["max_gap"], now - waiter_data["last_at"])
+                waiter_data["last_at"] = now
 
+                # La espera no se cierra por silencio mientras falten descargas de este mensaje
+                for download in msg_downloads:
+                    if not download.done():
+                        waiter_data["pending_downloads"].add(download)
+                        download.add_done_callback(lambda future, command_id=command_id: _on_waiter_download_done(command_id, future))
 
-                # Solo procesamos si:
-                # 1. La respuesta viene del bot al que se le envió el comando (sent_to_match)
-                # 2. El comando es por DNI y el DNI coincide (dni_match)
-                # 3. O el comando NO es por DNI (no_dni_command) y solo necesitamos que sea del bot correcto.
+                # Reprogramar el cierre por silencio según lo que falte por llegar
+                _schedule_waiter_completion(command_id, waiter_data, msg_obj)
                 
-                # La lógica debe ser más permisiva si el comando NO es por DNI, pero el bot SI debe ser el correcto.
-                if sent_to_match and (dni_match or no_dni_command):
-                    
-                    # Lógica de acumulación: Agregar el mensaje y marcar que HUBO respuesta
-                    waiter_data["messages"].append(msg_obj)
-                    waiter_data["has_response"] = True
-                    
-                    # El único caso de resolución forzada que dejamos es el de error de formato del bot
-                    if "Por favor, usa el formato correcto" in msg_obj["message"]:
-                        # Si es un error de formato, resolvemos de inmediato para no esperar el timeout
-                        loop.call_soon_threadsafe(waiter_data["future"].set_result, msg_obj)
-                        waiter_data["timer"].cancel()
-                        response_waiters.pop(command_id, None)
-                        resolved = True
-                        break
+                # El único caso de resolución forzada que dejamos es el de error de formato del bot
+                if "Por favor, usa el formato correcto" in msg_obj["message"]:
+                    # Si es un error de formato, resolvemos de inmediato para no esperar el timeout
+                    loop.call_soon_threadsafe(waiter_data["future"].set_result, msg_obj)
+                    _cancel_waiter_timers(waiter_data)
+                    _unregister_waiter(command_id)
+                    resolved = True
+                    break
 
         # 4. Agregar a la cola de historial si no se usó para una respuesta específica
         if not resolved:
@@ -308,12 +1847,57 @@ async def _on_new_message(event):
     except Exception:
         traceback.print_exc() 
 
-client.add_event_handler(_on_new_message, events.NewMessage(incoming=True))
+for _account in accounts:
+    _account["client"].add_event_handler(_on_new_message, events.NewMessage(incoming=True))
 
 # ----------------------------------------------------------------------
 # --- NUEVAS FUNCIONES PARA EL GUARDADO AUTOMÁTICO -----------------------
 # ----------------------------------------------------------------------
 
+# Cómo se guarda cada familia de comandos, por orden de prioridad:
+# 1. Si el resultado trae RUC -> "empresa" (o el tipo de _SAVE_TIPO_WITH_RUC para el comando).
+# 2. Si trae DNI -> el tipo de _SAVE_TIPO_WITH_DNI ("persona" por defecto).
+# 3. Si el comando está en _SAVE_BY_PARAM -> su tipo, con el parámetro del comando como documento.
+# Cada tipo copia los campos de 'fields' indicados en _SAVE_FIELDS ({clave en la API: clave en fields}).
+_SAVE_TIPO_WITH_RUC = {"denp": "denuncia_placa"}
+_SAVE_TIPO_WITH_DNI = {
+    "c4": "ficha_c4",
+    "dni": "persona", "dnif": "persona", "dnidb": "persona", "dnifdb": "persona",
+    "dnivaz": "persona", "dnivam": "persona", "dnivel": "persona", "dniveln": "persona",
+    "antpen": "antecedentes", "antpol": "antecedentes", "antjud": "antecedentes",
+    "tra": "trabajo", "sue": "trabajo",
+    "fa": "familia", "fb": "familia", "fadb": "familia", "fbdb": "familia",
+    "dend": "denuncia_dni",
+    "meta": "metadata",
+    "afp": "afp",
+}
+# {comando: (tipo, clave en la API para el parámetro del comando)}
+_SAVE_BY_PARAM = {
+    "tel": ("telefono", "numero"), "telp": ("telefono", "numero"), "osiptel": ("telefono", "numero"),
+    "claro": ("telefono", "numero"), "entel": ("telefono", "numero"),
+    "cedula": ("extranjero", "cedula"),
+    "denpas": ("denuncia_pasaporte", "pasaporte"),
+    "denci": ("denuncia_cedula", "cedula_identidad"),
+}
+_SAVE_FIELDS_EMPRESA = {"razon_social": "razon_social", "actividad": "actividad_principal"}
+_SAVE_FIELDS_TELEFONO = {"operador": "operador", "titular": "titular"}
+_SAVE_FIELDS_DOCUMENTO = {"nombre": ("nombre", "nombres", "nombre_completo")}
+_SAVE_FIELDS_BY_PARAM_TIPO = {
+    "telefono": _SAVE_FIELDS_TELEFONO,
+    "extranjero": _SAVE_FIELDS_DOCUMENTO,
+    "denuncia_pasaporte": _SAVE_FIELDS_DOCUMENTO,
+    "denuncia_cedula": _SAVE_FIELDS_DOCUMENTO,
+}
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def _copy_save_fields(data_to_save: dict, fields: dict, mapping: dict):
+    """Copia a data_to_save los campos de 'mapping'; una tupla son claves alternativas (gana la primera presente)."""
+    for api_key, field_keys in mapping.items():
+        for field_key in (field_keys if isinstance(field_keys, tuple) else (field_keys,)):
+            if fields.get(field_key):
+                data_to_save[api_key] = fields[field_key]
+                break
+
 def _extract_data_for_save(command: str, result: dict) -> tuple[str, dict] | tuple[None, None]:
     """
     Extrae el 'tipo' de archivo y los 'datos' clave para la API de guardado.
@@ -322,126 +1906,48 @@ def _extract_data_for_save(command: str, result: dict) -> tuple[str, dict] | tup
     :param result: El resultado JSON consolidado y exitoso del bot.
     :return: Una tupla (tipo, datos) o (None, None) si no se puede mapear.
     """
-    command_name = command.split(' ')[0].lstrip('/')
+    parts = command.split(' ')
+    command_name = parts[0].lstrip('/')
+    param = parts[1].strip() if len(parts) > 1 else ""
+    fields = result.get("fields") or {}
     data_to_save = {}
     tipo_archivo = None
-    
+
     # Intentar obtener DNI o RUC del resultado consolidado
     dni_val = result.get("dni")
-    ruc_val = result["fields"].get("ruc")
+    ruc_val = fields.get("ruc")
 
-    # Mapeo de comandos y extracción de datos
-    
-    # 1. RUC (Empresa/RUC) - Comandos: /ruc, /r, /tremp (Trabajadores por Empresa), /denp (Placa)
-    # Ya no existe /r ni /ruc en las rutas, así que se asume que si el resultado tiene RUC es una empresa
+    # 1. RUC (Empresa/RUC). Si es /denp, también se añade la placa
     if ruc_val:
-        tipo_archivo = "empresa"
+        tipo_archivo = _SAVE_TIPO_WITH_RUC.get(command_name, "empresa") if param else "empresa"
         data_to_save["ruc"] = ruc_val
-        
-        # Extracción de razón social
-        rs_match = re.search(r"Razón Social\s*:\s*(.*)", result["message"])
-        if rs_match:
-            data_to_save["razon_social"] = rs_match.group(1).strip()
-            
-        # Extracción de actividad
-        act_match = re.search(r"Actividad Principal\s*:\s*(.*)", result["message"])
-        if act_match:
-            data_to_save["actividad"] = act_match.group(1).strip()
-            
-        # Si es /denp, también se añade la placa
-        if command_name == "denp" and len(command.split(' ')) > 1:
-            data_to_save["placa"] = command.split(' ')[1].strip()
-            tipo_archivo = "denuncia_placa" # Tipo personalizado
-            
+        _copy_save_fields(data_to_save, fields, _SAVE_FIELDS_EMPRESA)
+        if tipo_archivo == "denuncia_placa":
+            data_to_save["placa"] = param
+
     # 2. DNI (Persona, Ficha C4, Antecedentes, etc.)
     elif dni_val:
+        tipo_archivo = _SAVE_TIPO_WITH_DNI.get(command_name, "persona")
         data_to_save["dni"] = dni_val
-        
-        # Mapeo por comandos específicos de DNI
-        if command_name in ["c4"]:
-            tipo_archivo = "ficha_c4"
-        elif command_name in ["dni", "dnif", "dnidb", "dnifdb", "dnivaz", "dnivam", "dnivel", "dniveln"]:
-            tipo_archivo = "persona"
-        elif command_name in ["antpen", "antpol", "antjud"]:
-            tipo_archivo = "antecedentes"
-        elif command_name in ["tra", "sue"]: # Trabajos o Sueldos
-            tipo_archivo = "trabajo"
-        elif command_name in ["fa", "fb", "fadb", "fbdb"]: # Familiares
-            tipo_archivo = "familia"
-        elif command_name in ["dend"]: # Denuncia DNI
-            tipo_archivo = "denuncia_dni"
-        elif command_name in ["meta"]: # Metadata
-            tipo_archivo = "metadata"
-        elif command_name in ["afp"]: # AFPs
-            tipo_archivo = "afp"
-        else:
-            tipo_archivo = "persona" # Default si tiene DNI
-            
-        # Extracción de nombre común (general para DNI)
-        nombre_match = re.search(r"Nombres\s*:\s*(.*)", result["message"])
-        apellido_p_match = re.search(r"Apellido Paterno\s*:\s*(.*)", result["message"])
-        apellido_m_match = re.search(r"Apellido Materno\s*:\s*(.*)", result["message"])
-        
-        nombre_completo = ""
-        if nombre_match:
-            nombre_completo += nombre_match.group(1).strip()
-        if apellido_p_match:
-            nombre_completo += " " + apellido_p_match.group(1).strip()
-        if apellido_m_match:
-            nombre_completo += " " + apellido_m_match.group(1).strip()
-            
+        nombre_completo = " ".join(
+            fields[key] for key in ("nombres", "apellido_paterno", "apellido_materno") if fields.get(key)
+        )
         if nombre_completo:
-             data_to_save["nombre"] = nombre_completo.strip()
-             
-        # Extracción de fecha de emisión (para C4/DNI)
-        emision_match = re.search(r"Fecha de Emisión\s*:\s*(\d{4}-\d{2}-\d{2})", result["message"])
+            data_to_save["nombre"] = nombre_completo
+        # Fecha de emisión (para C4/DNI)
+        emision_match = _ISO_DATE_RE.match(fields.get("fecha_de_emision", ""))
         if emision_match:
-            data_to_save["fecha_emision"] = emision_match.group(1)
+            data_to_save["fecha_emision"] = emision_match.group(0)
 
+    # 3. Teléfono y documentos extranjeros: el documento es el parámetro del comando
+    elif command_name in _SAVE_BY_PARAM:
+        tipo_archivo, param_key = _SAVE_BY_PARAM[command_name]
+        if tipo_archivo == "telefono" and not param:
+            return (None, None)
+        if param:
+            data_to_save[param_key] = param
+        _copy_save_fields(data_to_save, fields, _SAVE_FIELDS_BY_PARAM_TIPO[tipo_archivo])
 
-    # 3. Teléfono (Comandos: /tel, /telp, /osiptel, /claro, /entel)
-    elif command_name in ["tel", "telp", "osiptel", "claro", "entel"] and len(command.split(' ')) > 1:
-        tipo_archivo = "telefono"
-        
-        # El número de teléfono es el parámetro del comando
-        numero = command.split(' ')[1].strip()
-        data_to_save["numero"] = numero
-        
-        # Extracción de operador
-        op_match = re.search(r"Operador\s*:\s*(.*)", result["message"])
-        if op_match:
-            data_to_save["operador"] = op_match.group(1).strip()
-            
-        # Extracción de titular
-        titular_match = re.search(r"Titular\s*:\s*(.*)", result["message"])
-        if titular_match:
-            data_to_save["titular"] = titular_match.group(1).strip()
-        
-    # 4. Otros casos personalizados (ej: /cedula, /pasaporte)
-    elif command_name in ["cedula", "denpas", "denci"]:
-        
-        tipo_archivo = "extranjero"
-        if command_name == "denpas": tipo_archivo = "denuncia_pasaporte"
-        elif command_name == "denci": tipo_archivo = "denuncia_cedula"
-        
-        # El valor del documento es el parámetro del comando
-        doc_value = command.split(' ')[1].strip() if len(command.split(' ')) > 1 else ""
-        
-        if doc_value:
-             # Asignar el valor al tipo de documento correspondiente
-            if command_name == "cedula":
-                data_to_save["cedula"] = doc_value
-            elif command_name == "denpas":
-                data_to_save["pasaporte"] = doc_value
-            elif command_name == "denci":
-                data_to_save["cedula_identidad"] = doc_value
-                
-        # Intenta extraer el nombre
-        nombre_match = re.search(r"Nombre\s*:\s*(.*)", result["message"])
-        if nombre_match:
-            data_to_save["nombre"] = nombre_match.group(1).strip()
-            
-        
     # Si logramos extraer datos, le añadimos un ID de marca de tiempo (simulado)
     if data_to_save:
         # Usamos un ID único basado en el tiempo para el ejemplo, como en tus ejemplos
@@ -451,9 +1957,188 @@ def _extract_data_for_save(command: str, result: dict) -> tuple[str, dict] | tup
     return (tipo_archivo, data_to_save)
 
 
+# --- Cola de guardado persistente (write-behind hacia SAVE_API_BASE_URL) ---
+
+# Cada resultado guardable se escribe primero en una cola SQLite local y la respuesta al cliente no
+# espera a la API. SAVE_QUEUE_CONCURRENCY tareas la vacían con una sesión HTTP compartida (conexiones
+# keep-alive), reintentando con espera exponencial. Tras SAVE_MAX_ATTEMPTS fallos, o ante un 4xx
+# definitivo, el registro pasa a la tabla save_dead_letter para revisarlo a mano.
+SAVE_QUEUE_DB = os.getenv("SAVE_QUEUE_DB", "save_queue.db") # Vacío = solo en memoria (se pierde al reiniciar)
+SAVE_QUEUE_CONCURRENCY = int(os.getenv("SAVE_QUEUE_CONCURRENCY", "4")) # Peticiones simultáneas a la API
+SAVE_REQUEST_TIMEOUT = int(os.getenv("SAVE_REQUEST_TIMEOUT", "15")) # Segundos por petición
+SAVE_MAX_ATTEMPTS = int(os.getenv("SAVE_MAX_ATTEMPTS", "8")) # Intentos antes de pasar a dead letter
+SAVE_RETRY_BASE = float(os.getenv("SAVE_RETRY_BASE", "2")) # Espera del primer reintento (se duplica)
+SAVE_RETRY_MAX = float(os.getenv("SAVE_RETRY_MAX", "600")) # Tope de la espera entre reintentos
+SAVE_POLL_INTERVAL = 1.0 # Segundos entre revisiones de la cola cuando no hay avisos nuevos
+# Un registro tomado por una tarea queda reservado este tiempo; si el proceso muere a mitad del envío,
+# vuelve a estar disponible al vencer la reserva (entrega al menos una vez).
+SAVE_LEASE_SECONDS = SAVE_REQUEST_TIMEOUT + 15
+# La API de guardado recibe un registro por GET. Para los tipos cuyo endpoint acepte lotes, se indica
+# la URL que recibe un POST con una lista JSON de registros: SAVE_BATCH_URLS='{"telefono": "https://.../lote"}'
+SAVE_BATCH_URLS = json.loads(os.getenv("SAVE_BATCH_URLS", "{}"))
+SAVE_BATCH_SIZE = int(os.getenv("SAVE_BATCH_SIZE", "50")) # Registros máximos por lote
+
+_save_queue_db = None
+_save_queue_lock = threading.Lock()
+_save_queue_wakeup = None # asyncio.Event del bucle de Telethon (se crea en el primer worker)
+save_queue_stats = {"enqueued": 0, "sent": 0, "batches": 0, "retries": 0, "dead_lettered": 0, "enqueue_errors": 0}
+
+# Sesión HTTP compartida: reutiliza las conexiones TLS en vez de abrir una por registro
+_save_session = requests.Session()
+_save_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=SAVE_QUEUE_CONCURRENCY))
+_save_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=SAVE_QUEUE_CONCURRENCY))
+
+def load_save_queue():
+    """Abre (o crea) la base SQLite de la cola de guardado. Los registros pendientes de una ejecución anterior se reanudan."""
+    global _save_queue_db
+    try:
+        _save_queue_db = sqlite3.connect(SAVE_QUEUE_DB or ":memory:", check_same_thread=False)
+    except Exception as e:
+        print(f"⚠️ No se pudo abrir la cola de guardado {SAVE_QUEUE_DB}: {e}. Se usará solo memoria.")
+        _save_queue_db = sqlite3.connect(":memory:", check_same_thread=False)
+    with _save_queue_lock:
+        _save_queue_db.execute(
+            "CREATE TABLE IF NOT EXISTS save_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, tipo TEXT, datos TEXT, "
+            "enqueued_at REAL, attempts INTEGER DEFAULT 0, next_attempt_at REAL, last_error TEXT)"
+        )
+        _save_queue_db.execute("CREATE INDEX IF NOT EXISTS save_queue_due ON save_queue (next_attempt_at)")
+        _save_queue_db.execute(
+            "CREATE TABLE IF NOT EXISTS save_dead_letter (id INTEGER PRIMARY KEY, tipo TEXT, datos TEXT, "
+            "enqueued_at REAL, attempts INTEGER, failed_at REAL, last_error TEXT)"
+        )
+        _save_queue_db.commit()
+        pending = _save_queue_db.execute("SELECT COUNT(*) FROM save_queue").fetchone()[0]
+    if pending:
+        print(f"💾 Cola de guardado: {pending} registro(s) pendiente(s) de una ejecución anterior.")
+
+def save_queue_put(tipo: str, datos: dict):
+    """Inserta un registro en la cola (bloqueante: se llama en un executor)."""
+    now = time.time()
+    with _save_queue_lock:
+        _save_queue_db.execute(
+            "INSERT INTO save_queue (tipo, datos, enqueued_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+            (tipo, json.dumps(datos, ensure_ascii=False), now, now),
+        )
+        _save_queue_db.commit()
+        save_queue_stats["enqueued"] += 1
+
+def _save_queue_claim() -> list[tuple]:
+    """
+    Reserva el siguiente registro vencido y, si su tipo admite lotes, otros del mismo tipo.
+    Devuelve [(id, tipo, datos, attempts), ...] o [] si no hay nada que enviar.
+    """
+    now = time.time()
+    with _save_queue_lock:
+        first = _save_queue_db.execute(
+            "SELECT id, tipo, datos, attempts FROM save_queue WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT 1",
+            (now,),
+        ).fetchone()
+        if first is None:
+            return []
+        rows = [first]
+        if first[1] in SAVE_BATCH_URLS and SAVE_BATCH_SIZE > 1:
+            rows += _save_queue_db.execute(
+                "SELECT id, tipo, datos, attempts FROM save_queue WHERE tipo = ? AND next_attempt_at <= ? AND id != ? "
+                "ORDER BY next_attempt_at, id LIMIT ?",
+                (first[1], now, first[0], SAVE_BATCH_SIZE - 1),
+            ).fetchall()
+        _save_queue_db.executemany(
+            "UPDATE save_queue SET next_attempt_at = ? WHERE id = ?",
+            [(now + SAVE_LEASE_SECONDS, row[0]) for row in rows],
+        )
+        _save_queue_db.commit()
+    return rows
+
+def _save_queue_done(rows: list[tuple]):
+    with _save_queue_lock:
+        _save_queue_db.executemany("DELETE FROM save_queue WHERE id = ?", [(row[0],) for row in rows])
+        _save_queue_db.commit()
+        save_queue_stats["sent"] += len(rows)
+
+def _save_queue_failed(rows: list[tuple], error: str, retryable: bool):
+    """Reprograma los registros con espera exponencial, o los pasa a dead letter si ya no tiene sentido reintentar."""
+    now = time.time()
+    with _save_queue_lock:
+        for row_id, tipo, datos, attempts in rows:
+            attempts += 1
+            if not retryable or attempts >= SAVE_MAX_ATTEMPTS:
+                _save_queue_db.execute(
+                    "INSERT OR REPLACE INTO save_dead_letter (id, tipo, datos, enqueued_at, attempts, failed_at, last_error) "
+                    "SELECT id, tipo, datos, enqueued_at, ?, ?, ? FROM save_queue WHERE id = ?",
+                    (attempts, now, error, row_id),
+                )
+                _save_queue_db.execute("DELETE FROM save_queue WHERE id = ?", (row_id,))
+                save_queue_stats["dead_lettered"] += 1
+                print(f"☠️ Registro de guardado /{tipo} (id {row_id}) enviado a dead letter tras {attempts} intento(s): {error}")
+            else:
+                delay = min(SAVE_RETRY_MAX, SAVE_RETRY_BASE * (2 ** (attempts - 1))) * random.uniform(0.8, 1.2)
+                _save_queue_db.execute(
+                    "UPDATE save_queue SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (attempts, now + delay, error, row_id),
+                )
+                save_queue_stats["retries"] += 1
+        _save_queue_db.commit()
+
+def _save_send(tipo: str, records: list[dict]) -> tuple[bool, str | None, bool]:
+    """
+    Envía uno o varios registros de un tipo a la API de guardado (bloqueante).
+    Devuelve (ok, error, reintentable).
+    """
+    try:
+        if len(records) > 1:
+            response = _save_session.post(SAVE_BATCH_URLS[tipo], json=records, timeout=SAVE_REQUEST_TIMEOUT)
+        else:
+            # URL-encode de cada valor, igual que siempre ha esperado la API
+            query_params = [f"{clave}={quote(str(valor))}" for clave, valor in records[0].items()]
+            response = _save_session.get(f"{SAVE_API_BASE_URL}/{tipo}?{'&'.join(query_params)}", timeout=SAVE_REQUEST_TIMEOUT)
+    except requests.exceptions.Timeout:
+        return False, "timeout", True
+    except requests.exceptions.RequestException as e:
+        return False, f"{type(e).__name__}: {e}", True
+
+    if response.status_code == 200:
+        return True, None, False
+    # 408 y 429 son transitorios; el resto de 4xx no mejorará reintentando el mismo registro
+    retryable = response.status_code >= 500 or response.status_code in (408, 429)
+    return False, f"HTTP {response.status_code}: {response.text[:200]}", retryable
+
+async def _save_queue_worker():
+    """Vacía la cola de guardado; se ejecutan SAVE_QUEUE_CONCURRENCY copias en el bucle de Telethon."""
+    global _save_queue_wakeup
+    if _save_queue_wakeup is None:
+        _save_queue_wakeup = asyncio.Event()
+    while True:
+        try:
+            rows = await loop.run_in_executor(None, _save_queue_claim)
+            if not rows:
+                try:
+                    await asyncio.wait_for(_save_queue_wakeup.wait(), timeout=SAVE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                _save_queue_wakeup.clear()
+                continue
+
+            tipo = rows[0][1]
+            records = [json.loads(row[2]) for row in rows]
+            ok, error, retryable = await loop.run_in_executor(None, _save_send, tipo, records)
+            if ok:
+                await loop.run_in_executor(None, _save_queue_done, rows)
+                if len(rows) > 1:
+                    save_queue_stats["batches"] += 1
+                print(f"✅ Datos guardados con éxito en la API /{tipo} ({len(rows)} registro(s)).")
+            else:
+                print(f"❌ Error al guardar en la API /{tipo}: {error}")
+                await loop.run_in_executor(None, _save_queue_failed, rows, error, retryable)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+            await asyncio.sleep(SAVE_POLL_INTERVAL)
+
 async def _guardar_datos_api(tipo: str, datos: dict):
     """
-    Ejecuta la llamada GET a la API externa para guardar los datos.
+    Encola los datos para la API externa de guardado. El envío real lo hacen las tareas de
+    _save_queue_worker, así que un timeout o un reinicio no pierde el registro.
 
     :param tipo: Nombre del archivo/tipo de dato (e.g., 'persona', 'telefono').
     :param datos: Diccionario de datos clave=valor a guardar.
@@ -463,348 +2148,1145 @@ async def _guardar_datos_api(tipo: str, datos: dict):
         return
 
     try:
-        # Construir la URL de la API de guardado
-        query_params = []
-        for clave, valor in datos.items():
-            # URL-encode tanto la clave como el valor
-            encoded_valor = quote(str(valor))
-            query_params.append(f"{clave}={encoded_valor}")
-        
-        full_url = f"{SAVE_API_BASE_URL}/{tipo}?{'&'.join(query_params)}"
-        
-        # Ejecutar la petición GET (Bloqueante, debe hacerse en un thread o con aiohttp, 
-        # pero para simplicidad con requests en un thread/executor)
-        # Usaremos el executor del loop de asyncio para hacer la llamada bloqueante
-        response = await loop.run_in_executor(
-            None, # Usa el ThreadPoolExecutor por defecto
-            lambda: requests.get(full_url, timeout=15) # 15 segundos de timeout para la API de guardado
-        )
-        
-        # Registrar el resultado (No es necesario devolverlo, solo para depuración)
-        if response.status_code == 200:
-            print(f"✅ Datos guardados con éxito en la API /{tipo}. Respuesta: {response.json().get('message', 'Sin mensaje')}")
-        else:
-            print(f"❌ Error al guardar en la API /{tipo}. Estado: {response.status_code}. Respuesta: {response.text}")
-
-    except requests.exceptions.Timeout:
-        print(f"❌ Timeout al intentar guardar en la API /{tipo}.")
+        await loop.run_in_executor(None, save_queue_put, tipo, datos)
+        if _save_queue_wakeup is not None:
+            _save_queue_wakeup.set()
     except Exception as e:
-        print(f"❌ Error interno al guardar en la API /{tipo}: {e}")
-        
+        save_queue_stats["enqueue_errors"] += 1
+        print(f"❌ Error al encolar el guardado en la API /{tipo}: {e}")
+
+def get_save_queue_status() -> dict:
+    """Profundidad y retraso de la cola de guardado para /status."""
+    if _save_queue_db is None:
+        return {"enabled": False}
+    now = time.time()
+    with _save_queue_lock:
+        depth, due, oldest = _save_queue_db.execute(
+            "SELECT COUNT(*), SUM(next_attempt_at <= ?), MIN(enqueued_at) FROM save_queue", (now,)
+        ).fetchone()
+        dead = _save_queue_db.execute("SELECT COUNT(*) FROM save_dead_letter").fetchone()[0]
+    return {
+        "enabled": True,
+        "persistent": bool(SAVE_QUEUE_DB),
+        "depth": depth,
+        "due": due or 0,
+        "lag_seconds": round(now - oldest, 1) if oldest else 0,
+        "dead_letter": dead,
+        "concurrency": SAVE_QUEUE_CONCURRENCY,
+        "batch_tipos": sorted(SAVE_BATCH_URLS),
+        **save_queue_stats,
+    }
+
+if GATEWAY_ROLE != "worker": # La cola es del dueño del cliente de Telegram (broker o standalone)
+    load_save_queue()
+
+# ----------------------------------------------------------------------
+# --- PLANIFICADOR DE ENVÍOS POR CUENTA Y BOT ---------------------------
+# ----------------------------------------------------------------------
+
+class BotBusyError(Exception):
+    """El bot no puede aceptar el comando ahora (cola llena o FloodWait largo). No cuenta como fallo del bot."""
+
+# {(cuenta, bot_id): {"queue": asyncio.PriorityQueue, "slots": asyncio.Semaphore, "worker": asyncio.Task, ...}}
+# Cada cuenta de Telegram tiene su propia cola hacia cada bot. Solo se usa desde el bucle de Telethon.
+_bot_schedulers = {}
+_dispatch_seq = itertools.count() # Desempate FIFO dentro de un mismo carril de prioridad
+
+def _scheduler_limits(bot_id: str) -> tuple[int, float]:
+    limits = SCHEDULER_LIMITS.get(bot_id, {})
+    max_in_flight = int(limits.get("max_in_flight", SCHEDULER_MAX_IN_FLIGHT))
+    messages_per_second = float(limits.get("messages_per_second", SCHEDULER_MESSAGES_PER_SECOND))
+    return max_in_flight, messages_per_second
+
+def _get_bot_scheduler(account: dict, bot_id: str) -> dict:
+    """Devuelve (y crea la primera vez) la cola y el worker de envíos de la cuenta hacia el bot."""
+    route = (account["name"], bot_id)
+    state = _bot_schedulers.get(route)
+    if state is None:
+        max_in_flight, messages_per_second = _scheduler_limits(bot_id)
+        state = {
+            "account": account,
+            "bot_id": bot_id,
+            "queue": asyncio.PriorityQueue(maxsize=SCHEDULER_QUEUE_SIZE),
+            "slots": asyncio.Semaphore(max_in_flight),
+            "max_in_flight": max_in_flight,
+            "send_interval": 1 / messages_per_second if messages_per_second > 0 else 0,
+            "next_send_at": 0.0, # loop.time() del próximo envío permitido por el límite de velocidad
+            "in_flight": 0,
+            "sent": 0,
+            "rejected": 0,
+        }
+        _bot_schedulers[route] = state
+        state["worker"] = asyncio.ensure_future(_bot_dispatch_worker(route))
+    return state
+
+def account_flood_wait_remaining(account: dict) -> float:
+    """Segundos que le quedan a la cuenta en pausa por FloodWait (0 si no está pausada)."""
+    return max(0.0, account["paused_until"] - loop.time())
+
+def bot_load(bot_id: str) -> float:
+    """Carga del bot sumando todas las cuentas: comandos en curso / máximo permitido."""
+    states = [state for (_, route_bot_id), state in _bot_schedulers.items() if route_bot_id == bot_id]
+    capacity = sum(state["max_in_flight"] for state in states)
+    return sum(state["in_flight"] + state["queue"].qsize() for state in states) / capacity if capacity else 0.0
+
+async def _bot_dispatch_worker(route: tuple):
+    """Saca comandos de la cola de (cuenta, bot) y los envía respetando los límites y los FloodWait."""
+    state = _bot_schedulers[route]
+    while True:
+        priority, seq, job = await state["queue"].get()
+        if job["future"].done():
+            continue # El llamador ya desistió mientras esperaba en la cola
+        try:
+            await _dispatch_job(state, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Un error inesperado no debe dejar la ruta sin worker (todo lo demás quedaría colgado)
+            traceback.print_exc()
+            if not job["future"].done():
+                job["future"].set_exception(e)
+
+async def _dispatch_job(state: dict, job: dict):
+    """Envía un comando de la cola. Ante un FloodWait corto se reintenta aquí mismo al terminar la pausa."""
+    account, bot_id = state["account"], state["bot_id"]
+    while True:
+        await state["slots"].acquire()
+        try:
+            if account_flood_wait_remaining(account) > SCHEDULER_MAX_FLOOD_WAIT:
+                raise BotBusyError(f"Cuenta {account['name']} en FloodWait por {int(account_flood_wait_remaining(account))}s.")
+            delay = max(account["paused_until"], state["next_send_at"]) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if job["future"].done():
+                state["slots"].release()
+                return
+
+            state["next_send_at"] = loop.time() + state["send_interval"]
+            sent_message = await account["client"].send_message(bot_id, job["command"])
+            state["sent"] += 1
+            state["in_flight"] += 1
+            account["sent"] += 1
+            if job["future"].done():
+                # Nadie espera ya la respuesta: liberar el cupo
+                _scheduler_release(account["name"], bot_id)
+            else:
+                job["future"].set_result(sent_message)
+            return
+
+        except errors.FloodWaitError as e:
+            # El FloodWait es de la cuenta: pausa sus envíos a todos los bots
+            state["slots"].release()
+            account["paused_until"] = loop.time() + e.seconds
+            account["flood_waits"] += 1
+            print(f"🐢 FloodWait de {e.seconds}s en la cuenta {account['name']} (enviando a {bot_id}). Cuenta en pausa.")
+            if e.seconds > SCHEDULER_MAX_FLOOD_WAIT:
+                if not job["future"].done():
+                    job["future"].set_exception(BotBusyError(f"Cuenta {account['name']} en FloodWait por {e.seconds}s."))
+                return
+            # Reintentar el mismo comando cuando termine la pausa (la espera está al inicio del bucle).
+            # No se vuelve a encolar: la cola puede haberse llenado mientras tanto.
+        except Exception as e:
+            state["slots"].release()
+            if not job["future"].done():
+                job["future"].set_exception(e)
+            return
+
+def _scheduler_release(account_name: str, bot_id: str):
+    """Libera el cupo de 'en curso' de (cuenta, bot) cuando termina la espera de un comando enviado."""
+    state = _bot_schedulers.get((account_name, bot_id))
+    if state and state["in_flight"] > 0:
+        state["in_flight"] -= 1
+        state["slots"].release()
+
+async def _scheduler_send(account: dict, bot_id: str, command: str, priority: int = PRIORITY_INTERACTIVE):
+    """
+    Encola el comando para el bot en la cola de la cuenta y espera a que se envíe. Devuelve el mensaje enviado.
+    El llamador DEBE invocar _scheduler_release(cuenta, bot_id) cuando termine de esperar la respuesta.
+
+    :raises BotBusyError: si la cola está llena o la cuenta está en un FloodWait largo.
+    """
+    state = _get_bot_scheduler(account, bot_id)
+    if account_flood_wait_remaining(account) > SCHEDULER_MAX_FLOOD_WAIT:
+        state["rejected"] += 1
+        raise BotBusyError(f"Cuenta {account['name']} en FloodWait por {int(account_flood_wait_remaining(account))}s.")
+
+    job = {"command": command, "future": loop.create_future()}
+    try:
+        state["queue"].put_nowait((priority, next(_dispatch_seq), job))
+    except asyncio.QueueFull:
+        state["rejected"] += 1
+        raise BotBusyError(f"Cola de envíos de {account['name']} hacia {bot_id} llena ({SCHEDULER_QUEUE_SIZE}).")
+    return await job["future"]
+
+def select_account(bot_id: str) -> dict | None:
+    """
+    Elige la cuenta que enviará el comando al bot: autorizada, sin FloodWait largo y con
+    la menor carga (comandos en curso + en cola hacia ese bot, y luego total enviado).
+    """
+    candidates = [
+        account for account in accounts
+        if account["authorized"] is not False and account_flood_wait_remaining(account) <= SCHEDULER_MAX_FLOOD_WAIT
+    ]
+    if not candidates:
+        return None
+
+    def _load(account):
+        state = _bot_schedulers.get((account["name"], bot_id))
+        route_load = (state["in_flight"] + state["queue"].qsize()) / state["max_in_flight"] if state else 0.0
+        return (account_flood_wait_remaining(account) > 0, route_load, account["sent"])
+
+    return min(candidates, key=_load)
+
+def get_scheduler_status() -> dict:
+    """Estado de las colas de envío por cuenta y bot para /status."""
+    return {
+        f"{account_name}|{bot_id}": {
+            "queued": state["queue"].qsize(),
+            "in_flight": state["in_flight"],
+            "max_in_flight": state["max_in_flight"],
+            "sent": state["sent"],
+            "rejected": state["rejected"],
+        }
+        for (account_name, bot_id), state in list(_bot_schedulers.items())
+    }
+
 # ----------------------------------------------------------------------
 # --- FUNCIÓN CENTRAL MODIFICADA ---------------------------------------
 # ----------------------------------------------------------------------
 
-async def _call_api_command(command: str, timeout: int = TIMEOUT_TOTAL):
-    """Envía un comando al bot y espera la respuesta(s), con lógica de respaldo y bloqueo por fallo."""
-    if not await client.is_user_authorized():
-        raise Exception("Cliente no autorizado. Por favor, inicie sesión.")
+# Consultas en curso por clave normalizada: {clave: asyncio.Task} (solo se usa desde el bucle de Telethon)
+_inflight_commands = {}
+coalescing_stats = {"leaders": 0, "coalesced": 0}
+
+async def _run_flight(key: str, command: str, timeout: int, priority: int):
+    """Consulta compartida: la tarea es de la consulta, no de quien la inició."""
+    try:
+        result = await _call_api_command_upstream(command, timeout, priority)
+        cache_put(command, result)
+        return result
+    finally:
+        _inflight_commands.pop(key, None)
+
+async def _call_api_command(command: str, timeout: int = TIMEOUT_TOTAL, use_cache: bool = True, priority: int = PRIORITY_INTERACTIVE):
+    """
+    Punto de entrada de las consultas: responde desde la caché de resultados si hay una
+    entrada vigente, se une a una consulta idéntica que ya esté en curso y, si no,
+    consulta a los bots y cachea la respuesta exitosa.
+    """
+    if use_cache:
+        cached = cache_get(command)
+        if cached is not None:
+            print(f"🗃️ Respuesta desde caché: {command}")
+            cached["cached"] = True
+            return cached
+
+    # Single-flight: si ya hay una consulta idéntica en curso, esperamos su resultado
+    # en lugar de enviar otro mensaje al bot y registrar otra espera.
+    key = _normalize_command_key(command)
+    flight = _inflight_commands.get(key)
+    if flight is not None:
+        coalescing_stats["coalesced"] += 1
+        print(f"🔗 Consulta idéntica en curso, compartiendo resultado: {command}")
+    else:
+        flight = loop.create_task(_run_flight(key, command, timeout, priority))
+        # Evita el aviso "exception was never retrieved" si nadie más esperaba esta consulta
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        _inflight_commands[key] = flight
+        coalescing_stats["leaders"] += 1
+
+    # Con shield, cancelar a un llamador (también al primero) no cancela la consulta de los demás
+    result = await asyncio.shield(flight)
+    # Cada llamador recibe su propia copia (las rutas modifican el dict, ej: pop("bot_used"))
+    return copy.deepcopy(result)
+
+def _new_waiter(command: str, command_name: str, dni: str | None, account: dict, bot_id: str) -> dict:
+    """Crea la estructura de espera de un comando enviado a un bot."""
+    return {
+        "future": loop.create_future(),
+        "first_message": loop.create_future(), # Se resuelve con el PRIMER mensaje (para el hedging)
+        "messages": [], # Aquí se acumularán todos los mensajes
+        "dni": dni,
+        "query_key": None if dni else _query_key_for_command(command), # Para correlacionar comandos sin DNI
+        "sent_msg_id": None, # ID del mensaje enviado al bot (para su 'reply_to')
+        "command": command,
+        "timer": None, 
+        "idle_timer": None, # Timer de silencio: resuelve antes del timeout si el bot ya terminó
+        "sent_to_bot": bot_id,
+        "account": account, # Cuenta de Telegram que envía el comando
+        "route": (account["name"], bot_id), # Las respuestas se buscan por (cuenta, bot)
+        "has_response": False, # CRUCIAL: Indica si se recibió *al menos un* mensaje
+        "expected_media": EXPECTED_MEDIA_BY_COMMAND.get(command_name, set()),
+        "media_seen": set(),
+        "pages_seen": set(),
+        "pages_total": None,
+        "pending_downloads": set(), # Futures de descargas de media aún en curso
+        "resolve_after_downloads": False, # El bot ya terminó; falta solo la media
+        "first_timer": None, # Plazo para el PRIMER mensaje (aprendido del perfil)
+        "idle_gap": None, # Silencio aprendido del perfil (None = valores por defecto)
+        "sent_at": None, # loop.time() al enviar el comando
+        "first_at": None, # loop.time() del primer mensaje
+        "last_at": None, # loop.time() del último mensaje
+        "max_gap": 0.0, # Mayor silencio entre mensajes consecutivos
+    }
+
+def _start_attempt(command: str, command_name: str, dni: str | None, bot_id: str, default_timeout: float, priority: int) -> dict:
+    """
+    Registra la espera de un intento en un bot y lanza su envío en segundo plano.
+    Devuelve {"command_id", "bot_id", "waiter", "timing", "task"}; 'task' termina con la lista
+    de mensajes, un dict de error/timeout o una excepción del envío.
+    Lanza BotBusyError si ninguna cuenta del pool puede enviar ahora al bot.
+    """
+    account = select_account(bot_id)
+    if account is None:
+        raise BotBusyError(f"Ninguna cuenta disponible para enviar a {bot_id}")
+    command_id = next(_command_ids) # ID único de este intento
+    waiter_data = _new_waiter(command, command_name, dni, account, bot_id)
+
+    # Si ya hay un perfil aprendido para este comando y bot, se usan sus plazos
+    timing = get_command_timing(command_name, bot_id, default_timeout)
+    waiter_data["idle_gap"] = timing["idle_gap"]
+
+    with _messages_lock:
+        _register_waiter(command_id, waiter_data)
+
+    attempt = {"command_id": command_id, "bot_id": bot_id, "waiter": waiter_data, "timing": timing}
+    attempt["task"] = asyncio.ensure_future(_run_attempt(attempt, command, command_name, priority))
+    return attempt
+
+async def _run_attempt(attempt: dict, command: str, command_name: str, priority: int):
+    """Envía el comando al bot del intento y espera su respuesta (lista de mensajes o dict de error)."""
+    bot_id = attempt["bot_id"]
+    command_id = attempt["command_id"]
+    waiter_data = attempt["waiter"]
+    account = waiter_data["account"]
+    current_timeout = attempt["timing"]["first_deadline"]
+
+    # Función de timeout para el Future
+    def _on_timeout():
+        with _messages_lock:
+            waiter_data = _unregister_waiter(command_id)
+            if waiter_data:
+                _cancel_waiter_timers(waiter_data)
+            if waiter_data and not waiter_data["future"].done():
+                
+                # Lógica de Failover/Bloqueo
+                if waiter_data["messages"]:
+                    # LLEGÓ RESPUESTA(S). Se devuelve la lista de mensajes acumulados (EXITO)
+                    print(f"✅ Timeout alcanzado para acumulación en {bot_id}. Devolviendo {len(waiter_data['messages'])} mensaje(s).")
+                    waiter_data["future"].set_result(waiter_data["messages"]) # 👈 DEVUELVE LA LISTA COMPLETA
+                else:
+                    # NO LLEGÓ NINGÚN mensaje (Fallo de NO RESPUESTA): registrar la falla del bot
+                    record_bot_failure(bot_id)
+                    record_command_timeout(command_name, bot_id)
+                    waiter_data["future"].set_result(
+                        {"status": "error_timeout", "message": f"Tiempo de espera de respuesta agotado ({current_timeout}s). No se recibió NINGÚN mensaje para el comando: {command}.", "bot": bot_id, "fail_recorded": True}
+                    )
+
+    # Si no llega NINGÚN mensaje en el plazo aprendido, se trata como timeout (failover).
+    # Si ya llegaron mensajes, el timer de silencio o el tope total cierran la respuesta.
+    def _on_first_deadline():
+        if not waiter_data["has_response"]:
+            _on_timeout()
+
+    print(f"📡 Enviando comando a {bot_id} desde {account['name']} [Timeout: {current_timeout}s]: {command}")
+
+    slot_acquired = False
+    try:
+        # Enviar el mensaje al bot a través de su cola (límites de envío y FloodWait).
+        # El tiempo en la cola no puede superar el plazo del primer mensaje.
+        sent_message = await asyncio.wait_for(_scheduler_send(account, bot_id, command, priority), timeout=current_timeout)
+        slot_acquired = True
+        with _messages_lock:
+            _index_waiter_reply(command_id, getattr(sent_message, "id", None))
+
+        # Los timers empiezan a contar desde el envío real (no desde la entrada a la cola)
+        waiter_data["sent_at"] = loop.time() if waiter_data["first_at"] is None else waiter_data["first_at"]
+        waiter_data["timer"] = loop.call_later(max(current_timeout, attempt["timing"]["total_deadline"]), _on_timeout)
+        waiter_data["first_timer"] = loop.call_later(current_timeout, _on_first_deadline)
+
+        # Esperar la respuesta (que será una lista de mensajes o un dict de error)
+        return await waiter_data["future"]
+    finally:
+        # Liberar el cupo del bot en el planificador
+        if slot_acquired:
+            _scheduler_release(account["name"], bot_id)
+        # Limpieza final: Asegurar que la espera y sus timers se eliminen si no se hizo antes
+        with _messages_lock:
+            if _unregister_waiter(command_id):
+                _cancel_waiter_timers(waiter_data)
+
+def _abandon_attempt(attempt: dict):
+    """
+    Cancela un intento que perdió la carrera del hedging. Sus mensajes tardíos se descartan
+    (no se mezclan con otra consulta ni ensucian el historial de /get).
+    """
+    waiter_data = attempt["waiter"]
+    with _messages_lock:
+        _unregister_waiter(attempt["command_id"])
+        _cancel_waiter_timers(waiter_data)
+        _discard_late_replies(waiter_data["route"], waiter_data.get("sent_msg_id"), waiter_data.get("dni"))
+    attempt["task"].cancel()
+    release_bot_probe(attempt["bot_id"])
+
+def get_hedge_delay(command_name: str, bot_id: str) -> float:
+    """Tiempo sin respuesta del bot principal tras el cual se lanza el mismo comando en otro bot."""
+    if HEDGE_DELAY > 0:
+        return HEDGE_DELAY
+    with _profiles_lock:
+        profile = command_profiles.get(command_name, {}).get(bot_id)
+        learned = _percentile(profile["ttfm"], 95) if profile and len(profile["ttfm"]) >= PROFILE_MIN_SAMPLES else None
+    if learned is None:
+        return HEDGE_DEFAULT_DELAY
+    return min(TIMEOUT_FAILOVER, max(1.0, learned))
+
+async def _race_attempts(attempts: list) -> dict:
+    """
+    Espera a que el primero de los intentos empiece a responder y abandona el resto.
+    Si un intento termina sin respuesta (timeout/error), la carrera sigue con los demás.
+    Devuelve el intento ganador (o el último que terminó, si ninguno respondió).
+    """
+    pending = list(attempts)
+    while True:
+        waitables = {}
+        for attempt in pending:
+            waitables[attempt["waiter"]["first_message"]] = attempt
+            waitables[attempt["task"]] = attempt
+        done, _ = await asyncio.wait(waitables.keys(), return_when=asyncio.FIRST_COMPLETED)
+
+        # ¿Algún intento empezó a responder?
+        winner = next((waitables[d] for d in done if d is waitables[d]["waiter"]["first_message"]), None)
+        if winner is None:
+            finished = [waitables[d] for d in done]
+            pending = [a for a in pending if a not in finished]
+            if not pending:
+                return finished[-1]
+            for attempt in finished:
+                # Marcar la excepción como leída: la carrera sigue con los demás intentos
+                if attempt["task"].done() and not attempt["task"].cancelled():
+                    attempt["task"].exception()
+            continue
+
+        for attempt in pending:
+            if attempt is not winner:
+                print(f"✂️ {winner['bot_id']} respondió primero. Se descarta el intento en {attempt['bot_id']}.")
+                _abandon_attempt(attempt)
+        return winner
+
+# --- Salida estructurada por familia de comandos ---
+
+# Con STRUCTURED_OUTPUT=1 cada respuesta lleva además "data": los pares del bot ya tipados y
+# agrupados por familia de comandos, para que los clientes no tengan que volver a parsear 'message'.
+# Se calcula una vez al consolidar la respuesta (y queda en la caché con ella).
+#   {"family": "familia", "record": {"dni": "45678912", "nombres": ...},
+#    "items": [{"dni": "23456789", "parentesco": "MADRE", "edad": 61}, ...]}
+# 'items' solo aparece en las familias que devuelven listas.
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "0") == "1"
+
+# Solo comandos que envía alguna ruta (lo comprueba tests/test_structured_output.py)
+STRUCTURED_FAMILY_BY_COMMAND = {
+    "dni": "persona", "dnif": "persona", "dnidb": "persona", "dnifdb": "persona",
+    "dnivaz": "persona", "dnivam": "persona", "dnivel": "persona", "dniveln": "persona",
+    "cedula": "extranjero", # Igual que en _SAVE_BY_PARAM
+    "c4": "ficha_c4",
+    "antpen": "antecedentes", "antpol": "antecedentes", "antjud": "antecedentes", "antpenv": "antecedentes",
+    "osiptel": "telefono", "claro": "telefono", "entel": "telefono",
+    "fa": "familia", "fadb": "familia", "fb": "familia", "fbdb": "familia",
+    "tra": "trabajo", "sue": "trabajo", "tremp": "trabajadores",
+    "nm": "nombres", "nmv": "nombres",
+    "dend": "denuncia_dni", "dence": "denuncia_carnet_extranjeria", "denpas": "denuncia_pasaporte",
+    "denci": "denuncia_cedula", "denp": "denuncia_placa", "denar": "denuncia_arma", "dencl": "denuncia_clave",
+}
+
+# Familias con listas: clave con la que empieza cada elemento (además de los separadores "---")
+# y cuántos de esos grupos iniciales son la cabecera (en /fa el primero es el titular).
+# Sin 'item_start' los elementos se separan solo por "---".
+STRUCTURED_LIST_FAMILIES = {
+    "familia": {"item_start": "dni", "header_groups": 1},
+    "trabajo": {"item_start": "ruc", "header_groups": 0},
+    "trabajadores": {"item_start": "dni", "header_groups": 0}, # /tremp: trabajadores de una empresa (RUC)
+    "nombres": {"item_start": "dni", "header_groups": 0},
+    "denuncia_dni": {"item_start": None, "header_groups": 0},
+    "denuncia_carnet_extranjeria": {"item_start": None, "header_groups": 0},
+    "denuncia_pasaporte": {"item_start": None, "header_groups": 0},
+    "denuncia_cedula": {"item_start": None, "header_groups": 0},
+    "denuncia_placa": {"item_start": None, "header_groups": 0},
+    "denuncia_arma": {"item_start": None, "header_groups": 0},
+    "denuncia_clave": {"item_start": None, "header_groups": 0},
+}
+
+# Tipos de los valores por clave normalizada; el resto queda como texto. Las claves "fecha_*" se pasan
+# a ISO (AAAA-MM-DD) y dni/ruc se quedan solo con sus dígitos (texto, para no perder ceros a la izquierda).
+_STRUCTURED_INT_KEYS = {"edad", "hijos", "denuncias", "cantidad", "total"}
+_STRUCTURED_FLOAT_KEYS = {"estatura", "sueldo", "remuneracion", "monto"}
+_STRUCTURED_EMPTY_VALUES = {"", "-", "--", "n/a", "null", "none"}
+_DMY_DATE_RE = re.compile(r"(\d{2})/(\d{2})/(\d{4})")
 
-    command_id = time.time() # ID temporal
+def _structured_value(key: str, value: str):
+    """Convierte el valor de un par a su tipo (int, float, fecha ISO, dígitos del documento o texto)."""
+    if value.lower() in _STRUCTURED_EMPTY_VALUES:
+        return None
+    canonical = _CANONICAL_FIELDS.get(key.rsplit("_", 1)[-1])
+    if canonical:
+        value_match = canonical[1].match(value)
+        if value_match:
+            return value_match.group(0).lower() if canonical[2] else value_match.group(0)
+        return value
+    try:
+        if key in _STRUCTURED_INT_KEYS:
+            return int(value)
+        if key in _STRUCTURED_FLOAT_KEYS:
+            return float(value.replace("S/", "").replace(",", "").strip())
+    except ValueError:
+        return value
+    if key.startswith("fecha"):
+        iso_match = _ISO_DATE_RE.match(value)
+        if iso_match:
+            return iso_match.group(0)
+        dmy_match = _DMY_DATE_RE.match(value)
+        if dmy_match:
+            return f"{dmy_match.group(3)}-{dmy_match.group(2)}-{dmy_match.group(1)}"
+    return value
+
+def _structured_record(group: list) -> dict:
+    record = {}
+    for key, value in group:
+        if key not in record:
+            record[key] = _structured_value(key, value)
+    return record
+
+def build_structured_output(command: str, list_of_messages: list) -> dict:
+    """Agrupa y tipa los pares de todos los mensajes de una respuesta según la familia del comando."""
+    command_name = command.split(' ')[0].lstrip('/').lower()
+    family = STRUCTURED_FAMILY_BY_COMMAND.get(command_name, "generico")
+    # Pares de todas las páginas en orden; entre mensajes cuenta como un separador
+    pairs = []
+    for msg in list_of_messages:
+        pairs.extend(msg.get("pairs") or ())
+        pairs.append(None)
+
+    list_spec = STRUCTURED_LIST_FAMILIES.get(family)
+    if list_spec is None:
+        return {"family": family, "record": _structured_record(pair for pair in pairs if pair)}
+
+    # Grupos: se corta en cada separador y en cada clave que abre un elemento
+    groups = [[]]
+    for pair in pairs:
+        if pair is None or (pair[0] == list_spec["item_start"] and groups[-1]):
+            groups.append([])
+        if pair is not None:
+            groups[-1].append(pair)
+
+    header = []
+    items = []
+    header_groups = list_spec["header_groups"]
+    for group in groups:
+        if not group:
+            continue
+        if not items and list_spec["item_start"] and group[0][0] != list_spec["item_start"]:
+            header.extend(group) # Datos del consultado antes del primer elemento
+        elif header_groups > 0:
+            header.extend(group)
+            header_groups -= 1
+        else:
+            items.append(_structured_record(group))
+    return {"family": family, "record": _structured_record(header), "items": items}
+
+def _build_final_json(list_of_messages: list, bot_id: str, command: str = "") -> dict:
+    """Consolida la lista de mensajes del bot en el JSON de respuesta (message + fields + urls [+ data])."""
+    # Usamos el primer mensaje como base para la respuesta final
+    final_result = list_of_messages[0].copy() 
+    
+    # Lista de mensajes de texto completos (limpios)
+    final_result["full_messages"] = [msg["message"] for msg in list_of_messages] 
+    
+    # Consolidar todas las URLs
+    consolidated_urls = {} 
+    
+    # Mapeo de tipos de foto a claves de URL para PRESERVAR EL JSON ORIGINAL
+    type_map = {
+        "rostro": "ROSTRO", 
+        "huella": "HUELLA", 
+        "firma": "FIRMA", 
+        "adverso": "ADVERSO", 
+        "reverso": "REVERSO"
+    }
+    
+    for msg in list_of_messages:
+        for url_obj in msg.get("urls", []):
+            # Usar el tipo de foto/documento como clave (mayúsculas)
+            key = type_map.get(url_obj["type"].lower())
+            
+            if key:
+                # Si ya existe una foto con ese tipo, no la sobreescribimos
+                if key not in consolidated_urls:
+                    consolidated_urls[key] = url_obj["url"]
+            else:
+                # Para otros archivos (pdfs, etc.), usar la clave 'FILE'. 
+                # Si es un comando que devuelve varios PDFs (como /denp), se usa una enumeración.
+                base_key = "FILE"
+                i = 1
+                # Si ya existe 'FILE', probamos con 'FILE_1', 'FILE_2', etc.
+                if base_key in consolidated_urls:
+                    while f"{base_key}_{i}" in consolidated_urls:
+                        i += 1
+                    consolidated_urls[f"{base_key}_{i}"] = url_obj["url"]
+                else:
+                    consolidated_urls[base_key] = url_obj["url"]
+
+        # Asegurarnos de que los fields (como DNI) se capturen si no vinieron en el primer mensaje
+        if not final_result["fields"].get("dni") and msg["fields"].get("dni"):
+            final_result["fields"] = msg["fields"]
+
+    # Completar con los campos de las demás páginas/mensajes (sin pisar los del mensaje elegido)
+    merged_fields = dict(final_result["fields"])
+    for msg in list_of_messages:
+        for key, value in msg["fields"].items():
+            merged_fields.setdefault(key, value)
+    final_result["fields"] = merged_fields
+
+    final_result["urls"] = consolidated_urls 
+    
+    # Unimos todos los mensajes de texto para la clave principal 'message'
+    # Mantenemos el formato de unir por '\n---\n' para simular un único mensaje grande
+    final_result["message"] = "\n---\n".join(final_result["full_messages"])
+    final_result.pop("full_messages")
     
+    # Reconstruir el JSON para que se parezca al original (message + fields + urls)
+    final_json = {
+        "message": final_result["message"],
+        "fields": dict(final_result["fields"]),
+        "urls": final_result["urls"],
+    }
+    if STRUCTURED_OUTPUT:
+        final_json["data"] = build_structured_output(command, list_of_messages)
+    
+    # Si el campo 'dni' está en fields, lo movemos al nivel superior para compatibilidad
+    if final_json["fields"].get("dni"):
+        final_json["dni"] = final_json["fields"]["dni"]
+        final_json["fields"].pop("dni")
+    
+    # Si la consulta fue exitosa con al menos 1 mensaje
+    final_json["status"] = "ok"
+    final_json["bot_used"] = bot_id
+    return final_json
+
+async def _call_api_command_upstream(command: str, timeout: int = TIMEOUT_TOTAL, priority: int = PRIORITY_INTERACTIVE):
+    """Envía un comando al bot y espera la respuesta(s), con lógica de respaldo, hedging y circuit breaker."""
+    if not await _refresh_accounts_authorization():
+        raise Exception("Cliente no autorizado. Por favor, inicie sesión.")
+
     # Extraer DNI del comando si existe
     dni_match = re.search(r"/\w+\s+(\d{8})", command)
     dni = dni_match.group(1) if dni_match else None
+    command_name = command.split(' ')[0].lstrip('/')
     
-    # Lista de bots a intentar
-    bots_to_try = [LEDERDATA_BOT_ID, LEDERDATA_BACKUP_BOT_ID]
-    
+    # Bots del pool a intentar: preferencia del comando y luego reparto por peso, salud y carga
+    remaining_bots = select_bots_for_command(command_name)
+    if not remaining_bots:
+        return {"status": "error", "message": f"Ningún bot del pool soporta el comando /{command_name}.", "bot_used": None}
+    attempts_made = 0
+    last_error = None
+
+    def _next_available_bot():
+        """Saca de la lista el siguiente bot disponible (reservando su prueba si está semi-abierto)."""
+        while remaining_bots:
+            bot_id = remaining_bots.pop(0)
+            if claim_bot(bot_id):
+                return bot_id
+            print(f"🚫 Bot {bot_id} está BLOQUEADO temporalmente. Saltando al siguiente bot.")
+        return None
+
     # ----------------------------------------------------------------------
-    # Lógica de Intento con Verificación de Bloqueo
+    # Lógica de Intentos: failover secuencial y, si está activo, hedging
     # ----------------------------------------------------------------------
-    
-    for attempt, current_bot_id in enumerate(bots_to_try, 1):
-        
-        # 1. Verificar si el bot está bloqueado
-        if is_bot_blocked(current_bot_id) and attempt == 1:
-            print(f"🚫 Bot {current_bot_id} está BLOQUEADO temporalmente. Saltando al bot de respaldo.")
-            continue # Saltar al siguiente bot (el de respaldo)
-        elif is_bot_blocked(current_bot_id) and attempt == 2:
-            print(f"🚫 Bot de Respaldo {current_bot_id} también está BLOQUEADO. No hay bots disponibles.")
-            break # Salir del bucle, ambos fallaron
-
-        # 2. Preparar el Future y Waiter
-        future = loop.create_future()
-        waiter_data = {
-            "future": future,
-            "messages": [], # Aquí se acumularán todos los mensajes
-            "dni": dni,
-            "command": command,
-            "timer": None, 
-            "sent_to_bot": current_bot_id,
-            "has_response": False # CRUCIAL: Indica si se recibió *al menos un* mensaje
-        }
-        
-        # El tiempo de espera será el de failover para el bot principal, y el total para el de respaldo.
-        current_timeout = TIMEOUT_FAILOVER if attempt == 1 else TIMEOUT_TOTAL
-        
-        # Función de timeout para el Future
-        def _on_timeout(bot_id_on_timeout=current_bot_id, command_id_on_timeout=command_id):
-            with _messages_lock:
-                waiter_data = response_waiters.pop(command_id_on_timeout, None)
-                if waiter_data and not waiter_data["future"].done():
-                    
-                    # Lógica de Failover/Bloqueo
-                    if waiter_data["messages"]:
-                        # LLEGÓ RESPUESTA(S). Se devuelve la lista de mensajes acumulados (EXITO)
-                        # YA NO SE INTENTA EN EL OTRO BOT (si fuera intento 1)
-                        print(f"✅ Timeout alcanzado para acumulación en {bot_id_on_timeout}. Devolviendo {len(waiter_data['messages'])} mensaje(s).")
-                        loop.call_soon_threadsafe(
-                            waiter_data["future"].set_result, 
-                            waiter_data["messages"] # 👈 DEVUELVE LA LISTA COMPLETA
-                        )
-                    else:
-                        # NO LLEGÓ NINGÚN mensaje (Fallo de NO RESPUESTA).
-                        # 1. Registrar la falla del bot (solo si no se recibió NINGÚN mensaje)
-                        if not waiter_data["has_response"]:
-                            record_bot_failure(bot_id_on_timeout)
-                        
-                        # 2. Resolver el future con un indicador de fallo
-                        loop.call_soon_threadsafe(
-                            waiter_data["future"].set_result, 
-                            {"status": "error_timeout", "message": f"Tiempo de espera de respuesta agotado ({current_timeout}s). No se recibió NINGÚN mensaje para el comando: {command}.", "bot": bot_id_on_timeout, "fail_recorded": not waiter_data["has_response"]}
-                        )
-
-        # Establecer el timer de timeout en el loop de Telethon
-        waiter_data["timer"] = loop.call_later(current_timeout, _on_timeout)
 
-        with _messages_lock:
-            # 3. Usamos el mismo command_id pero actualizamos el waiter_data
-            response_waiters[command_id] = waiter_data
+    while True:
+        current_bot_id = _next_available_bot()
+        if current_bot_id is None:
+            break
+        attempts_made += 1
 
-        print(f"📡 Enviando comando (Intento {attempt}) a {current_bot_id} [Timeout: {current_timeout}s]: {command}")
-        
+        # El último bot disponible tiene el tiempo total; los anteriores, el de failover
+        default_timeout = TIMEOUT_FAILOVER if remaining_bots else TIMEOUT_TOTAL
         try:
-            # 4. Enviar el mensaje al bot
-            await client.send_message(current_bot_id, command)
-            
-            # 5. Esperar la respuesta (que será una lista de mensajes o un dict de error)
-            result = await future
-            
-            # 6. Lógica de Failover
-            # Si el resultado es un fallo por NO RESPUESTA y estamos en el intento 1, pasamos al siguiente bot.
-            if isinstance(result, dict) and result.get("status") == "error_timeout" and attempt == 1:
-                print(f"⌛ Timeout de NO RESPUESTA de {LEDERDATA_BOT_ID}. Intentando con {LEDERDATA_BACKUP_BOT_ID}.")
-                continue # Pasa al siguiente intento/bot
-            elif isinstance(result, dict) and result.get("status") == "error_timeout" and attempt == 2:
-                # El bot de respaldo falló también. Retornar el error final.
-                return result 
-            
-            # Si el resultado es un error de formato del bot (dict, si solo llegó uno de error de formato)
-            if isinstance(result, dict) and "Por favor, usa el formato correcto" in result.get("message", ""):
-                 return {"status": "error_bot_format", "message": result.get("message"), "bot_used": current_bot_id}
-
-            # Si llega aquí con un resultado (lista de mensajes), YA NO SE INTENTA EL OTRO BOT.
+            attempt = _start_attempt(command, command_name, dni, current_bot_id, default_timeout, priority)
+        except BotBusyError as e:
+            # Todas las cuentas están en FloodWait largo para este bot: no es un fallo del bot
+            print(f"⏳ {e}. Pasando al siguiente bot.")
+            release_bot_probe(current_bot_id)
+            last_error = {"status": "error", "message": str(e), "bot_used": current_bot_id}
+            continue
 
-            # 7. Lógica de Consolidación de Respuestas
-            
-            # El resultado debe ser una lista de mensajes recibidos (lista_de_mensajes).
-            list_of_messages = result if isinstance(result, list) else [] # Debe ser una lista
-            
-            if isinstance(list_of_messages, list) and len(list_of_messages) > 0:
-                
-                # Usamos el primer mensaje como base para la respuesta final
-                final_result = list_of_messages[0].copy() 
-                
-                # Lista de mensajes de texto completos (limpios)
-                final_result["full_messages"] = [msg["message"] for msg in list_of_messages] 
-                
-                # Consolidar todas las URLs
-                consolidated_urls = {} 
-                
-                # Mapeo de tipos de foto a claves de URL para PRESERVAR EL JSON ORIGINAL
-                type_map = {
-                    "rostro": "ROSTRO", 
-                    "huella": "HUELLA", 
-                    "firma": "FIRMA", 
-                    "adverso": "ADVERSO", 
-                    "reverso": "REVERSO"
-                }
-                
-                for msg in list_of_messages:
-                    for url_obj in msg.get("urls", []):
-                        # Usar el tipo de foto/documento como clave (mayúsculas)
-                        key = type_map.get(url_obj["type"].lower())
-                        
-                        if key:
-                            # Si ya existe una foto con ese tipo, no la sobreescribimos
-                            if key not in consolidated_urls:
-                                consolidated_urls[key] = url_obj["url"]
-                        else:
-                            # Para otros archivos (pdfs, etc.), usar la clave 'FILE'. 
-                            # Si es un comando que devuelve varios PDFs (como /denp), se usa una enumeración.
-                            base_key = "FILE"
-                            i = 1
-                            # Si ya existe 'FILE', probamos con 'FILE_1', 'FILE_2', etc.
-                            if base_key in consolidated_urls:
-                                while f"{base_key}_{i}" in consolidated_urls:
-                                    i += 1
-                                consolidated_urls[f"{base_key}_{i}"] = url_obj["url"]
-                            else:
-                                consolidated_urls[base_key] = url_obj["url"]
-
-                    # Asegurarnos de que los fields (como DNI) se capturen si no vinieron en el primer mensaje
-                    if not final_result["fields"].get("dni") and msg["fields"].get("dni"):
-                        final_result["fields"] = msg["fields"]
-                        
-                final_result["urls"] = consolidated_urls 
-                
-                # Unimos todos los mensajes de texto para la clave principal 'message'
-                # Mantenemos el formato de unir por '\n---\n' para simular un único mensaje grande
-                final_result["message"] = "\n---\n".join(final_result["full_messages"])
-                final_result.pop("full_messages")
-                
-                # Limpiar campos no necesarios para el JSON final
-                final_result.pop("chat_id", None)
-                final_result.pop("from_id", None)
-                final_result.pop("date", None)
-                
-                # Reconstruir el JSON para que se parezca al original (message + fields + urls)
-                final_json = {
-                    "message": final_result["message"],
-                    "fields": final_result["fields"],
-                    "urls": final_result["urls"],
-                }
-                
-                # Si el campo 'dni' está en fields, lo movemos al nivel superior para compatibilidad
-                if final_json["fields"].get("dni"):
-                    final_json["dni"] = final_json["fields"]["dni"]
-                    final_json["fields"].pop("dni")
-                
-                # Si la consulta fue exitosa con al menos 1 mensaje
-                final_json["status"] = "ok"
-                final_json["bot_used"] = current_bot_id
-                
-                # ----------------------------------------------------------------------
-                # >>> LÓGICA DE GUARDADO AUTOMÁTICO (¡AÑADIDO AQUÍ!) <<<
-                # ----------------------------------------------------------------------
-                try:
-                    tipo, datos = _extract_data_for_save(command, final_json)
-                    if tipo and datos:
-                        # Ejecutar la función de guardado en segundo plano
-                        # Usamos create_task para que NO BLOQUEE la respuesta al cliente API
-                        asyncio.create_task(_guardar_datos_api(tipo, datos))
-                        print(f"💾 Tarea de guardado de datos ({tipo}) iniciada en segundo plano.")
+        # Hedging: si el bot no ha enviado nada tras su p95 de tiempo al primer mensaje,
+        # el mismo comando se lanza también en el siguiente bot y gana el primero que responda.
+        if HEDGE_ENABLED and remaining_bots:
+            hedge_delay = get_hedge_delay(command_name, current_bot_id)
+            done, _ = await asyncio.wait({attempt["waiter"]["first_message"], attempt["task"]}, timeout=hedge_delay)
+            if not done:
+                hedge_bot_id = _next_available_bot()
+                if hedge_bot_id:
+                    attempts_made += 1
+                    print(f"🪁 {current_bot_id} sin respuesta tras {hedge_delay:.1f}s. Hedging con {hedge_bot_id}.")
+                    hedge_timeout = TIMEOUT_FAILOVER if remaining_bots else TIMEOUT_TOTAL
+                    try:
+                        hedge_attempt = _start_attempt(command, command_name, dni, hedge_bot_id, hedge_timeout, priority)
+                    except BotBusyError as e:
+                        print(f"⏳ {e}. Se sigue esperando a {current_bot_id}.")
+                        release_bot_probe(hedge_bot_id)
                     else:
-                        print("⚠️ Datos no mapeados para guardado automático. Omitiendo.")
-                except Exception as save_e:
-                    print(f"❌ Error al iniciar la tarea de guardado: {save_e}")
-                # ----------------------------------------------------------------------
+                        attempt = await _race_attempts([attempt, hedge_attempt])
+                        current_bot_id = attempt["bot_id"]
+
+        waiter_data = attempt["waiter"]
+        try:
+            result = await attempt["task"]
+        
+        # --- Bot ocupado (cola llena / FloodWait largo / demasiado tiempo en cola): no es un fallo del bot ---
+        except (BotBusyError, asyncio.TimeoutError) as e:
+            error_msg = str(e) or f"El comando no pudo enviarse a {current_bot_id} dentro del plazo."
+            print(f"⏳ {error_msg} Pasando al siguiente bot.")
+            release_bot_probe(current_bot_id)
+            last_error = {"status": "error", "message": error_msg, "bot_used": current_bot_id}
+            continue
 
-                return final_json
-                
-            # Si list_of_messages está vacío
-            else: 
-                # Esto debería ser cubierto por el error_timeout, pero por si acaso.
-                return {"status": "error", "message": f"Respuesta vacía o inesperada del bot {current_bot_id}.", "bot_used": current_bot_id}
-            
         # --- CAPTURA DE ERROR CLAVE: UserBlockedError ---
-        except UserBlockedError as e:
+        except UserBlockedError:
             error_msg = f"Error de Telethon/conexión/fallo: You blocked this user (caused by SendMessageRequest)"
             print(f"❌ Error de BLOQUEO en {current_bot_id}: {error_msg}. Registrando fallo y pasando al siguiente bot.")
-            
-            # Registrar la falla por bloqueo inmediatamente
-            record_bot_failure(current_bot_id)
-            
-            # Limpiar el waiter y cancelar el timer ANTES de pasar al siguiente intento
-            with _messages_lock:
-                 if command_id in response_waiters:
-                    waiter_data = response_waiters.pop(command_id, None)
-                    if waiter_data and waiter_data["timer"]:
-                        waiter_data["timer"].cancel()
-                        
-            if attempt == 1:
-                continue # Pasa al bot de respaldo
-            else:
-                # Si falla el intento 2 por bloqueo, retornamos el error final.
-                return {"status": "error", "message": error_msg, "bot_used": current_bot_id}
+            # Registrar la falla por bloqueo inmediatamente (abre el circuito sin esperar más fallos)
+            record_bot_failure(current_bot_id, force_open=True)
+            last_error = {"status": "error", "message": error_msg, "bot_used": current_bot_id}
+            continue
             
         except Exception as e:
             # Si hay un error de Telethon/conexión GENERAL (diferente a UserBlockedError).
             error_msg = f"Error de Telethon/conexión/fallo: {str(e)}"
-            if attempt == 1:
-                print(f"❌ Error en {LEDERDATA_BOT_ID}: {error_msg}. Intentando con {LEDERDATA_BACKUP_BOT_ID}.")
-                # Registrar la falla por error de conexión
-                record_bot_failure(LEDERDATA_BOT_ID)
-                
-                # Limpiar el waiter y cancelar el timer ANTES de pasar al siguiente intento
-                with _messages_lock:
-                     if command_id in response_waiters:
-                        waiter_data = response_waiters.pop(command_id, None)
-                        if waiter_data and waiter_data["timer"]:
-                            waiter_data["timer"].cancel()
-                            
-                continue
+            print(f"❌ Error en {current_bot_id}: {error_msg}. Intentando con el siguiente bot.")
+            record_bot_failure(current_bot_id)
+            last_error = {"status": "error", "message": error_msg, "bot_used": current_bot_id}
+            continue
+
+        # Lógica de Failover: si el resultado es un fallo por NO RESPUESTA, pasamos al siguiente bot.
+        if isinstance(result, dict) and result.get("status") == "error_timeout":
+            print(f"⌛ Timeout de NO RESPUESTA de {current_bot_id}. Intentando con el siguiente bot.")
+            last_error = result
+            continue
+
+        # El bot respondió: registrar el éxito y su latencia al primer mensaje en su circuito
+        if waiter_data["first_at"] is not None:
+            record_bot_success(current_bot_id, latency=waiter_data["first_at"] - waiter_data["sent_at"])
+        
+        # Si el resultado es un error de formato del bot (dict, si solo llegó uno de error de formato)
+        if isinstance(result, dict) and "Por favor, usa el formato correcto" in result.get("message", ""):
+             return {"status": "error_bot_format", "message": result.get("message"), "bot_used": current_bot_id}
+
+        # Si llega aquí con un resultado (lista de mensajes), YA NO SE INTENTA EL OTRO BOT.
+        list_of_messages = result if isinstance(result, list) else [] # Debe ser una lista
+        if not list_of_messages:
+            # Esto debería ser cubierto por el error_timeout, pero por si acaso.
+            return {"status": "error", "message": f"Respuesta vacía o inesperada del bot {current_bot_id}.", "bot_used": current_bot_id}
+
+        # Alimentar el perfil del comando con los tiempos de esta respuesta
+        if waiter_data["first_at"] is not None:
+            record_command_profile(
+                command_name, current_bot_id,
+                ttfm=waiter_data["first_at"] - waiter_data["sent_at"],
+                ttlm=waiter_data["last_at"] - waiter_data["sent_at"],
+                max_gap=waiter_data["max_gap"],
+                message_count=len(list_of_messages),
+                media_count=sum(len(msg.get("urls", [])) for msg in list_of_messages),
+            )
+
+        # Lógica de Consolidación de Respuestas
+        final_json = _build_final_json(list_of_messages, current_bot_id, command)
+        
+        # ----------------------------------------------------------------------
+        # >>> LÓGICA DE GUARDADO AUTOMÁTICO (¡AÑADIDO AQUÍ!) <<<
+        # ----------------------------------------------------------------------
+        try:
+            tipo, datos = _extract_data_for_save(command, final_json)
+            if tipo and datos:
+                # Ejecutar la función de guardado en segundo plano
+                # Usamos create_task para que NO BLOQUEE la respuesta al cliente API
+                asyncio.create_task(_guardar_datos_api(tipo, datos))
+                print(f"💾 Datos ({tipo}) encolados para guardado en segundo plano.")
             else:
-                # Si falla el intento 2, retornamos el error final.
-                return {"status": "error", "message": error_msg, "bot_used": current_bot_id}
-        finally:
-            # 8. Limpieza final: Asegurar que el Future y el Timer se eliminen si no se hizo antes
-            with _messages_lock:
-                if command_id in response_waiters:
-                    waiter_data = response_waiters.pop(command_id, None)
-                    if waiter_data and waiter_data["timer"]:
-                        waiter_data["timer"].cancel()
-
-    # Si se llegó aquí es porque ambos bots fallaron o estaban bloqueados.
-    final_bot = LEDERDATA_BOT_ID
-    if is_bot_blocked(LEDERDATA_BACKUP_BOT_ID) or not is_bot_blocked(LEDERDATA_BOT_ID):
-         final_bot = LEDERDATA_BOT_ID
-    elif is_bot_blocked(LEDERDATA_BOT_ID) and not is_bot_blocked(LEDERDATA_BACKUP_BOT_ID):
-         final_bot = LEDERDATA_BACKUP_BOT_ID
-    
-    return {"status": "error", "message": f"Falló la consulta después de 2 intentos. Ambos bots están bloqueados o agotaron el tiempo de espera.", "bot_used": final_bot}
+                print("⚠️ Datos no mapeados para guardado automático. Omitiendo.")
+        except Exception as save_e:
+            print(f"❌ Error al iniciar la tarea de guardado: {save_e}")
+        # ----------------------------------------------------------------------
+
+        return final_json
+
+    # Si se llegó aquí es porque todos los bots fallaron o estaban bloqueados.
+    if last_error:
+        return last_error
+    return {"status": "error", "message": f"Falló la consulta después de {attempts_made} intento(s). Todos los bots están bloqueados o agotaron el tiempo de espera.", "bot_used": None}
 
 
 # --- Rutina de reconexión / ping ---
 
 async def _ensure_connected():
-    """Mantiene la conexión y autorización activa."""
+    """Mantiene la conexión y autorización activa de todas las cuentas del pool."""
     while True:
-        try:
-            if not client.is_connected():
-                print("🔌 Intentando reconectar Telethon...")
-                await client.connect()
-            
-            if client.is_connected() and not await client.is_user_authorized():
-                 print("⚠️ Telethon conectado, pero no autorizado. Reintentando auth...")
-                 # Si la sesión es de StringSession, no puede re-auth si no hay 2FA/login
-                 # Pero si es un archivo de sesión, intentar start() podría ayudar.
-                 try:
-                    await client.start()
-                 except Exception:
-                     pass
-
-            # Intentar obtener la entidad de ambos bots después de la reconexión/auth
-            if await client.is_user_authorized():
-                await client.get_entity(LEDERDATA_BOT_ID) 
-                await client.get_entity(LEDERDATA_BACKUP_BOT_ID) 
-                # Un ping simple para mantener viva la conexión
-                await client.get_dialogs(limit=1) 
-                print("✅ Reconexión y verificación de bots exitosa.")
-            else:
-                 print("🔴 Cliente no autorizado. Requerido /login.")
+        for account in accounts:
+            account_client = account["client"]
+            try:
+                if not account_client.is_connected():
+                    print(f"🔌 Intentando reconectar Telethon ({account['name']})...")
+                    await account_client.connect()
+                
+                if account_client.is_connected() and not await account_client.is_user_authorized() and account_client is client:
+                     print("⚠️ Telethon conectado, pero no autorizado. Reintentando auth...")
+                     # Si la sesión es de StringSession, no puede re-auth si no hay 2FA/login
+                     # Pero si es un archivo de sesión, intentar start() podría ayudar.
+                     try:
+                        await account_client.start()
+                     except Exception:
+                         pass
+
+                # Intentar obtener la entidad de todos los bots del pool después de la reconexión/auth
+                account["authorized"] = await account_client.is_user_authorized()
+                if account["authorized"]:
+                    for bot_id in ALL_BOT_IDS:
+                        await account_client.get_entity(bot_id) 
+                    # Un ping simple para mantener viva la conexión
+                    await account_client.get_dialogs(limit=1) 
+                    print(f"✅ Reconexión y verificación de bots exitosa ({account['name']}).")
+                else:
+                     print(f"🔴 Cuenta {account['name']} no autorizada. Requerido /login o una sesión válida.")
 
 
+            except Exception:
+                traceback.print_exc()
+        await asyncio.sleep(300) # Dormir 5 minutos
+
+if GATEWAY_ROLE != "worker":
+    asyncio.run_coroutine_threadsafe(_ensure_connected(), loop)
+
+async def _persist_state_periodically():
+    """Guarda los perfiles de comandos, la salud de los bots y el índice de media cada PROFILE_SAVE_INTERVAL segundos."""
+    while True:
+        await asyncio.sleep(PROFILE_SAVE_INTERVAL)
+        try:
+            await loop.run_in_executor(None, save_command_profiles)
+            await loop.run_in_executor(None, save_bot_health)
+            await loop.run_in_executor(None, save_media_store)
         except Exception:
             traceback.print_exc()
-        await asyncio.sleep(300) # Dormir 5 minutos
 
-asyncio.run_coroutine_threadsafe(_ensure_connected(), loop)
+if GATEWAY_ROLE != "worker":
+    # Solo el dueño del estado lo guarda (un worker sobrescribiría el de broker con datos vacíos)
+    asyncio.run_coroutine_threadsafe(_persist_state_periodically(), loop)
+    asyncio.run_coroutine_threadsafe(_retention_loop(), loop)
+    for _ in range(max(1, SAVE_QUEUE_CONCURRENCY)):
+        asyncio.run_coroutine_threadsafe(_save_queue_worker(), loop)
 
-# --- Rutas HTTP Base (Login/Status/General) ---
+# ----------------------------------------------------------------------
+# --- TRABAJOS ASÍNCRONOS (JOBS) ----------------------------------------
+# ----------------------------------------------------------------------
 
-@app.route("/")
-def root():
-    return jsonify({
-        "status": "ok",
-        "message": "Gateway API para LEDER DATA Bot activo. Consulta /status para la sesión.",
-    })
+# Para clientes que no pueden mantener la conexión HTTP abierta 25-45 s: POST /jobs devuelve un
+# job_id al instante, la consulta corre en segundo plano (vía _call_api_command, con caché y
+# coalescing) y el resultado se consulta en GET /jobs/<job_id> o llega por POST a 'callback_url'.
+JOBS_MAX_ENTRIES = int(os.getenv("JOBS_MAX_ENTRIES", "2000")) # Tope de trabajos guardados
+JOB_TTL = int(os.getenv("JOB_TTL", "3600")) # Segundos que se conserva un trabajo terminado
+JOB_CALLBACK_TIMEOUT = float(os.getenv("JOB_CALLBACK_TIMEOUT", "10"))
+JOB_CALLBACK_RETRIES = int(os.getenv("JOB_CALLBACK_RETRIES", "3")) # Intentos de entrega del webhook
+# Hosts permitidos para callback_url, separados por comas (vacío = cualquier host público).
+# Nunca se aceptan direcciones privadas, de loopback ni link-local: el resultado lleva datos personales.
+JOB_CALLBACK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("JOB_CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()}
 
-@app.route("/status")
-def status():
+# Sesión compartida para los webhooks (conexiones keep-alive entre entregas)
+_callback_session = requests.Session()
+
+# {job_id: {"id", "command", "status": pending|running|done|error, "result", "http_status", "callback_url", ...}}
+# En orden de creación. Solo se usa desde el bucle de Telethon (en el broker, si hay varios procesos).
+_jobs = OrderedDict()
+
+def _job_view(job: dict) -> dict:
+    """Representación pública de un trabajo (lo que devuelven /jobs y el webhook)."""
+    view = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "command": job["command"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+    }
+    if job["status"] in ("done", "error"):
+        view["http_status"] = job["http_status"]
+        view["result"] = job["result"]
+    if job["callback_url"]:
+        view["callback"] = {"url": job["callback_url"], "status": job["callback_status"], "attempts": job["callback_attempts"]}
+    return view
+
+def _prune_jobs():
+    """Borra los trabajos terminados que superaron JOB_TTL y, si el almacén está lleno, los terminados más antiguos."""
+    now = time.time()
+    for job_id in [job_id for job_id, job in _jobs.items() if job["finished_ts"] and now - job["finished_ts"] > JOB_TTL]:
+        del _jobs[job_id]
+    if len(_jobs) >= JOBS_MAX_ENTRIES:
+        finished = [job_id for job_id, job in _jobs.items() if job["finished_ts"]]
+        for job_id in finished[:len(_jobs) - JOBS_MAX_ENTRIES + 1]:
+            del _jobs[job_id]
+
+def check_callback_url(url: str) -> str | None:
+    """
+    Valida un callback_url (bloqueante: resuelve el DNS). Devuelve None si se puede usar o el motivo
+    del rechazo: esquema no http(s), host fuera de JOB_CALLBACK_ALLOWED_HOSTS o alguna dirección
+    que no sea pública (privada, loopback, link-local, reservada...).
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return "'callback_url' debe ser una URL http(s)."
+    host = parts.hostname.lower()
+    if JOB_CALLBACK_ALLOWED_HOSTS and host not in JOB_CALLBACK_ALLOWED_HOSTS:
+        return f"'callback_url': el host {host} no está permitido."
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or (443 if parts.scheme == "https" else 80))}
+    except (socket.gaierror, ValueError):
+        return f"'callback_url': no se pudo resolver {host}."
+    for address in addresses:
+        if not ipaddress.ip_address(address.split("%", 1)[0]).is_global:
+            return f"'callback_url': {host} apunta a una dirección no pública."
+    return None
+
+def _post_job_callback(url: str, payload: dict):
+    """POST del webhook (bloqueante). Se revalida el destino en cada intento (el DNS puede haber cambiado)."""
+    error = check_callback_url(url)
+    if error:
+        raise ValueError(error)
+    # Sin redirecciones: una 3xx podría llevar el resultado a un host interno
+    return _callback_session.post(url, json=payload, timeout=JOB_CALLBACK_TIMEOUT, allow_redirects=False)
+
+async def _deliver_job_callback(job: dict):
+    """Envía el resultado del trabajo a su callback_url (POST JSON), con reintentos y backoff."""
+    payload = _job_view(job)
+    for attempt in range(1, JOB_CALLBACK_RETRIES + 1):
+        job["callback_attempts"] = attempt
+        try:
+            response = await loop.run_in_executor(None, _post_job_callback, job["callback_url"], payload)
+            if response.status_code < 300:
+                job["callback_status"] = "delivered"
+                return
+            print(f"⚠️ Webhook del trabajo {job['id']} respondió {response.status_code} (intento {attempt}).")
+        except Exception as e:
+            print(f"⚠️ Error al entregar el webhook del trabajo {job['id']} (intento {attempt}): {e}")
+        if attempt < JOB_CALLBACK_RETRIES:
+            await asyncio.sleep(2 ** attempt)
+    job["callback_status"] = "failed"
+
+async def _run_job(job: dict, use_cache: bool):
+    job["status"] = "running"
+    try:
+        result = await _call_api_command(job["command"], timeout=TIMEOUT_FAILOVER, use_cache=use_cache)
+        job["result"], job["http_status"] = _result_to_http(result)
+    except Exception as e:
+        job["result"], job["http_status"] = {"status": "error", "message": f"Error interno: {str(e)}"}, 500
+    job["status"] = "done" if job["http_status"] == 200 else "error"
+    job["finished_at"] = datetime.now(timezone.utc).isoformat()
+    job["finished_ts"] = time.time()
+    print(f"📦 Trabajo {job['id']} terminado ({job['status']}): {job['command']}")
+    if job["callback_url"]:
+        await _deliver_job_callback(job)
+
+async def _backend_job_submit(command: str, callback_url: str | None = None, use_cache: bool = True) -> dict | None:
+    """Crea un trabajo y lanza la consulta en segundo plano. Devuelve None si el almacén está lleno de trabajos en curso."""
+    _prune_jobs()
+    if len(_jobs) >= JOBS_MAX_ENTRIES:
+        return None
+    job = {
+        "id": uuid.uuid4().hex,
+        "command": command,
+        "status": "pending",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "finished_at": None,
+        "finished_ts": None, # time.time() al terminar (para la expiración)
+        "result": None,
+        "http_status": None,
+        "callback_url": callback_url,
+        "callback_status": "pending" if callback_url else None,
+        "callback_attempts": 0,
+    }
+    _jobs[job["id"]] = job
+    job["task"] = asyncio.ensure_future(_run_job(job, use_cache))
+    return _job_view(job)
+
+async def _backend_job_status(job_id: str) -> dict | None:
+    _prune_jobs()
+    job = _jobs.get(job_id)
+    return _job_view(job) if job else None
+
+def get_jobs_status() -> dict:
+    """Resumen del almacén de trabajos para /status."""
+    by_status = {}
+    for job in list(_jobs.values()):
+        by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+    return {"stored": len(_jobs), "max_entries": JOBS_MAX_ENTRIES, "ttl": JOB_TTL, **by_status}
+
+# ----------------------------------------------------------------------
+# --- STREAMING DE RESULTADOS PARCIALES (SSE) ---------------------------
+# ----------------------------------------------------------------------
+
+# {clave normalizada del comando: {asyncio.Queue, ...}}: quién sigue cada consulta en /stream.
+# _on_new_message publica aquí cada mensaje apenas llega, antes de que se consolide la respuesta.
+# Solo se usa desde el bucle de Telethon.
+_stream_listeners = {}
+
+def _publish_partial_message(command: str, msg_obj: dict):
+    """Entrega un mensaje recién recibido a los streams que siguen el comando."""
+    listeners = _stream_listeners.get(_normalize_command_key(command), ())
+    if listeners:
+        public = public_message(msg_obj)
+        for listener in listeners:
+            listener.put_nowait(public)
+
+async def stream_api_command(command: str, use_cache: bool = True):
+    """
+    Ejecuta el comando como _call_api_command, pero produce eventos mientras llegan los mensajes:
+    ("message", mensaje limpio con sus 'urls') por cada mensaje del bot y, al final,
+    ("result", {"http_status", "result"}) con el JSON consolidado de siempre.
+    """
+    key = _normalize_command_key(command)
+    listener = asyncio.Queue()
+    _stream_listeners.setdefault(key, set()).add(listener)
+    # La consulta corre como tarea propia: si el cliente se desconecta sigue y su resultado queda en caché
+    task = asyncio.ensure_future(_call_api_command(command, timeout=TIMEOUT_FAILOVER, use_cache=use_cache))
+    deadline = loop.time() + TIMEOUT_TOTAL + 5 # Mismo tope que run_coro
     try:
-        is_auth = run_coro(client.is_user_authorized())
+        while not task.done():
+            getter = asyncio.ensure_future(listener.get())
+            await asyncio.wait({getter, task}, timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield "message", getter.result()
+                continue
+            getter.cancel()
+            if loop.time() >= deadline:
+                break
+        while not listener.empty():
+            yield "message", listener.get_nowait()
+
+        if not task.done():
+            yield "result", {"http_status": 500, "result": {"status": "error", "message": "Error interno: tiempo de espera agotado."}}
+            return
+        try:
+            payload, status_code = _result_to_http(task.result())
+        except Exception as e:
+            payload, status_code = {"status": "error", "message": f"Error interno: {str(e)}"}, 500
+        yield "result", {"http_status": status_code, "result": payload}
+    finally:
+        listeners = _stream_listeners.get(key)
+        if listeners is not None:
+            listeners.discard(listener)
+            if not listeners:
+                del _stream_listeners[key]
+
+def _sse_event(event: str, data) -> str:
+    """Formatea un evento Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# ----------------------------------------------------------------------
+# --- CONSULTAS EN LOTE -------------------------------------------------
+# ----------------------------------------------------------------------
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500")) # Parámetros máximos por lote
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8")) # Consultas de un lote en curso a la vez
+
+async def stream_batch_commands(commands: list, use_cache: bool = True):
+    """
+    Ejecuta los comandos de un lote ('commands[i]' es el comando del parámetro i, o None si no
+    pasó la validación). Los repetidos se consultan una sola vez, con prioridad PRIORITY_BULK
+    (las consultas interactivas pasan antes en el planificador) y como máximo BATCH_CONCURRENCY
+    a la vez. Produce ("result", {"indexes", "http_status", "result"}) en orden de finalización
+    y un ("summary", {...}) final.
+    """
+    unique = {}
+    for index, command in enumerate(commands):
+        if command:
+            unique.setdefault(_normalize_command_key(command), (command, []))[1].append(index)
+
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def _run(command: str, indexes: list) -> dict:
+        async with slots:
+            try:
+                # shield: si el cliente se desconecta, las consultas ya enviadas terminan (y se cachean)
+                result = await asyncio.shield(_call_api_command(command, timeout=TIMEOUT_FAILOVER, use_cache=use_cache, priority=PRIORITY_BULK))
+                payload, status_code = _result_to_http(result)
+            except Exception as e:
+                payload, status_code = {"status": "error", "message": f"Error interno: {str(e)}"}, 500
+        return {"indexes": indexes, "http_status": status_code, "result": payload}
+
+    tasks = [asyncio.ensure_future(_run(command, indexes)) for command, indexes in unique.values()]
+    cache_hits = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            data = await next_done
+            cache_hits += 1 if data["result"].get("cached") else 0
+            yield "result", data
+    finally:
+        for task in tasks:
+            task.cancel() # Las que aún esperaban turno ya no se lanzan
+    yield "summary", {"unique": len(unique), "cache_hits": cache_hits}
+
+def _prepare_batch(data: dict) -> tuple[list | None, str | None]:
+    """
+    Valida un lote {"command": "dni", "params": ["12345678", {"dni": "87654321"}, ...]} con las
+    mismas reglas que la ruta del comando. Un parámetro de texto vale como 'dni' y como 'query';
+    un objeto lleva los parámetros de la ruta. Devuelve ([{"index", "param", "command", "error"}], None)
+    o (None, mensaje de error para un 400).
+    """
+    route_name = str(data.get("command") or "").strip().lstrip("/")
+    params = data.get("params")
+    if not route_name:
+        return None, "Parámetro 'command' es requerido (ej: dni, c4, antpen)."
+    if not isinstance(params, list) or not params:
+        return None, "Parámetro 'params' es requerido y debe ser una lista no vacía."
+    if len(params) > BATCH_MAX_ITEMS:
+        return None, f"Máximo {BATCH_MAX_ITEMS} parámetros por lote."
+
+    items = []
+    for index, param in enumerate(params):
+        if isinstance(param, dict):
+            args = _merge_request_params(param)
+        else:
+            args = {"dni": str(param).strip(), "query": str(param).strip()}
+        command, error = _build_command_for_route(route_name, args)
+        if error and error.startswith("Comando no soportado"):
+            return None, error
+        items.append({"index": index, "param": param, "command": command, "error": error})
+    return items, None
+
+def _batch_invalid_lines(items: list) -> str:
+    """Líneas NDJSON de los parámetros que no pasaron la validación (se envían primero)."""
+    return "".join(
+        json.dumps({"index": item["index"], "param": item["param"], "http_status": 400, "result": {"status": "error", "message": item["error"]}}) + "\n"
+        for item in items if item["error"]
+    )
+
+def _batch_event_lines(items: list, event: str, data: dict) -> str:
+    """Convierte un evento de stream_batch_commands en líneas NDJSON (una por parámetro del lote)."""
+    if event == "result" and "indexes" in data:
+        return "".join(
+            json.dumps({"index": index, "param": items[index]["param"], "command": items[index]["command"], "http_status": data["http_status"], "result": data["result"]}, default=str) + "\n"
+            for index in data["indexes"]
+        )
+    if event == "summary":
+        data = {"done": True, "total": len(items), "invalid": sum(1 for item in items if item["error"]), **data}
+    return json.dumps(data, default=str) + "\n"
+
+# ----------------------------------------------------------------------
+# --- Backend de Telegram: local o en el broker (IPC por socket Unix) ---
+# ----------------------------------------------------------------------
+
+# Las rutas HTTP no tocan el cliente ni el estado de Telegram directamente: piden operaciones del
+# backend con backend_call(). En "standalone" y "broker" se ejecutan en este proceso; en "worker"
+# viajan al broker como una línea JSON {"op", "params"} y vuelven como {"ok", "result" | "error"}.
+
+async def _backend_status() -> dict:
+    try:
+        is_auth = await client.is_user_authorized()
     except Exception:
         is_auth = False
 
@@ -815,60 +3297,269 @@ def status():
     except Exception:
         pass
     
-    # Agregar estado de bloqueo de bots
+    # Agregar estado de salud (circuit breaker) de los bots
     bot_status = {}
     for bot_id in ALL_BOT_IDS:
-        is_blocked = is_bot_blocked(bot_id)
-        bot_status[bot_id] = {
-            "blocked": is_blocked,
-            "last_fail": bot_fail_tracker.get(bot_id).isoformat() if bot_fail_tracker.get(bot_id) else None
-        }
+        bot_status[bot_id] = get_bot_health_status(bot_id)
 
-    return jsonify({
+    return {
         "authorized": bool(is_auth),
         "pending_phone": pending_phone["phone"],
         "session_loaded": True if SESSION_STRING else False,
         "session_string": current_session,
         "bot_status": bot_status,
+        "cache": get_cache_status(),
+        "coalescing": {**coalescing_stats, "in_flight": len(_inflight_commands)},
+        "scheduler": get_scheduler_status(),
+        "accounts": get_accounts_status(),
+        "jobs": get_jobs_status(),
+        "media": get_media_status(),
+        "downloads_dir": get_retention_status(),
+        "save_queue": get_save_queue_status(),
+    }
+
+async def _backend_get_messages() -> list:
+    with _messages_lock:
+        return [public_message(msg) for msg in messages]
+
+async def _backend_profiles() -> dict:
+    return get_profiles_summary()
+
+async def _backend_login(phone: str) -> dict:
+    await client.connect()
+    if await client.is_user_authorized(): return {"status": "already_authorized"}
+    try:
+        await client.send_code_request(phone)
+        pending_phone["phone"] = phone
+        pending_phone["sent_at"] = datetime.utcnow().isoformat()
+        return {"status": "code_sent", "phone": phone}
+    except Exception as e: return {"status": "error", "error": str(e)}
+
+async def _backend_sign_in(code: str) -> dict | None:
+    """Completa el login pendiente. Devuelve None si no hay login pendiente."""
+    phone = pending_phone["phone"]
+    if not phone: return None
+    try:
+        await client.sign_in(phone, code)
+        await client.start()
+        pending_phone["phone"] = None
+        pending_phone["sent_at"] = None
+        new_string = client.session.save()
+        return {"status": "authenticated", "session_string": new_string}
+    except errors.SessionPasswordNeededError: return {"status": "error", "error": "2FA requerido"}
+    except Exception as e: return {"status": "error", "error": str(e)}
+
+async def _backend_send(chat_id: str, msg: str) -> dict:
+    target = int(chat_id) if chat_id.isdigit() else chat_id
+    entity = await client.get_entity(target)
+    await client.send_message(entity, msg)
+    return {"status": "sent", "to": chat_id, "msg": msg}
+
+BACKEND_OPS = {
+    "command": _call_api_command,
+    "status": _backend_status,
+    "get": _backend_get_messages,
+    "profiles": _backend_profiles,
+    "login": _backend_login,
+    "code": _backend_sign_in,
+    "send": _backend_send,
+    "job_submit": _backend_job_submit,
+    "job_status": _backend_job_status,
+}
+
+# Operaciones que producen una secuencia de eventos (event, data) en lugar de un único resultado
+BACKEND_STREAM_OPS = {
+    "command_stream": stream_api_command,
+    "batch_stream": stream_batch_commands,
+    "media_stream": stream_lazy_media,
+}
+
+async def _open_broker_connection():
+    try:
+        return await asyncio.open_unix_connection(BROKER_SOCKET, limit=BROKER_MAX_LINE)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise Exception(f"Broker de Telegram no disponible en {BROKER_SOCKET}: {e}")
+
+async def _broker_request(op: str, params: dict):
+    """Envía una operación al broker por el socket Unix y devuelve su resultado (modo worker)."""
+    reader, writer = await _open_broker_connection()
+    try:
+        writer.write(json.dumps({"op": op, "params": params}).encode() + b"\n")
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise Exception("El broker de Telegram cerró la conexión sin responder.")
+    response = json.loads(line)
+    if not response["ok"]:
+        raise Exception(response["error"])
+    return response["result"]
+
+def backend_call(op: str, **params):
+    """Ejecuta una operación del backend de Telegram y espera su resultado (bloqueante, para Flask)."""
+    if GATEWAY_ROLE == "worker":
+        return run_coro(_broker_request(op, params))
+    return run_coro(BACKEND_OPS[op](**params))
+
+async def backend_call_async(op: str, **params):
+    """Versión asíncrona de backend_call para las rutas aiohttp, que ya corren en el bucle de Telethon."""
+    if GATEWAY_ROLE == "worker":
+        operation = _broker_request(op, params)
+    else:
+        operation = BACKEND_OPS[op](**params)
+    # Mismo tope que run_coro. Con shield, si el cliente HTTP se desconecta la consulta sigue (y queda en caché)
+    return await asyncio.wait_for(asyncio.shield(operation), timeout=TIMEOUT_TOTAL + 5)
+
+async def _broker_stream(op: str, params: dict):
+    """Como _broker_request, para operaciones de BACKEND_STREAM_OPS: produce (event, data) por línea."""
+    reader, writer = await _open_broker_connection()
+    try:
+        writer.write(json.dumps({"op": op, "params": params}).encode() + b"\n")
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise Exception("El broker de Telegram cerró la conexión sin terminar el stream.")
+            response = json.loads(line)
+            if not response["ok"]:
+                raise Exception(response["error"])
+            if response.get("done"):
+                return
+            if "data_b64" in response: # Eventos binarios (ej: trozos de archivos)
+                yield response["event"], base64.b64decode(response["data_b64"])
+            else:
+                yield response["event"], response["data"]
+    finally:
+        writer.close()
+
+async def backend_stream_async(op: str, **params):
+    """Eventos (event, data) de una operación de BACKEND_STREAM_OPS, local o desde el broker."""
+    if GATEWAY_ROLE == "worker":
+        stream = _broker_stream(op, params)
+    else:
+        stream = BACKEND_STREAM_OPS[op](**params)
+    async for item in stream:
+        yield item
+
+# Eventos que backend_stream adelanta a un cliente lento. Con la cola llena el productor espera,
+# así un archivo grande no se acumula entero en memoria si quien descarga va más lento.
+BACKEND_STREAM_BUFFER = int(os.getenv("BACKEND_STREAM_BUFFER", "8"))
+
+def backend_stream(op: str, idle_timeout: float | None = TIMEOUT_TOTAL + 10, **params):
+    """
+    Versión bloqueante de backend_stream_async para Flask: generador que se consume desde el hilo
+    de la petición. 'idle_timeout' es la espera máxima entre eventos (None = sin límite).
+    """
+    events_queue = asyncio.Queue(maxsize=BACKEND_STREAM_BUFFER) # Se usa solo desde el bucle de Telethon
+
+    async def _pump():
+        try:
+            async for item in backend_stream_async(op, **params):
+                await events_queue.put(item) # Contrapresión: espera a que el consumidor saque eventos
+        except Exception as e:
+            await events_queue.put(("result", {"http_status": 500, "result": {"status": "error", "message": f"Error interno: {str(e)}"}}))
+        await events_queue.put(None) # Si se cancela (cliente desconectado) no hace falta el fin
+
+    async def _next_event():
+        return await asyncio.wait_for(events_queue.get(), timeout=idle_timeout)
+
+    future = asyncio.run_coroutine_threadsafe(_pump(), loop)
+    try:
+        while True:
+            try:
+                item = asyncio.run_coroutine_threadsafe(_next_event(), loop).result()
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                break
+            yield item
+    finally:
+        future.cancel() # Cliente desconectado: deja de seguir la consulta (que sigue en segundo plano)
+
+async def _handle_broker_connection(reader, writer):
+    """
+    Atiende a un worker: una petición JSON por línea y una respuesta JSON por línea
+    (o, para BACKEND_STREAM_OPS, una línea por evento y una final {"ok": true, "done": true}).
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request_data = json.loads(line)
+                stream_operation = BACKEND_STREAM_OPS.get(request_data.get("op"))
+                if stream_operation is not None:
+                    async for event, data in stream_operation(**request_data.get("params", {})):
+                        if isinstance(data, bytes):
+                            line = {"ok": True, "event": event, "data_b64": base64.b64encode(data).decode()}
+                        else:
+                            line = {"ok": True, "event": event, "data": data}
+                        writer.write(json.dumps(line, default=str).encode() + b"\n")
+                        await writer.drain()
+                    response = {"ok": True, "done": True}
+                else:
+                    operation = BACKEND_OPS.get(request_data.get("op"))
+                    if operation is None:
+                        raise ValueError(f"Operación desconocida: {request_data.get('op')}")
+                    response = {"ok": True, "result": await operation(**request_data.get("params", {}))}
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            writer.write(json.dumps(response, default=str).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass # El worker se fue (timeout o reinicio): la consulta en curso sigue y queda en caché
+    finally:
+        writer.close()
+
+async def _start_broker_server():
+    """Abre el socket Unix del broker (modo broker)."""
+    if os.path.exists(BROKER_SOCKET):
+        os.unlink(BROKER_SOCKET) # Socket huérfano de una ejecución anterior
+    server = await asyncio.start_unix_server(_handle_broker_connection, path=BROKER_SOCKET, limit=BROKER_MAX_LINE)
+    os.chmod(BROKER_SOCKET, 0o600)
+    return server
+
+# --- Rutas HTTP Base (Login/Status/General) ---
+
+@app.route("/")
+def root():
+    return jsonify({
+        "status": "ok",
+        "message": "Gateway API para LEDER DATA Bot activo. Consulta /status para la sesión.",
     })
 
+@app.route("/status")
+def status():
+    try:
+        data = backend_call("status")
+    except Exception as e:
+        # Modo worker sin broker: se informa en lugar de fallar
+        return jsonify({"authorized": False, "gateway_role": GATEWAY_ROLE, "error": str(e)}), 503
+    data["gateway_role"] = GATEWAY_ROLE
+    return jsonify(data)
+
+@app.route("/profiles")
+def profiles():
+    """Perfiles de respuesta aprendidos por comando y bot (solo lectura)."""
+    return jsonify({"profiles": backend_call("profiles")})
+
 @app.route("/login")
 def login():
     phone = request.args.get("phone")
     if not phone: return jsonify({"error": "Falta parámetro phone"}), 400
 
-    async def _send_code():
-        await client.connect()
-        if await client.is_user_authorized(): return {"status": "already_authorized"}
-        try:
-            await client.send_code_request(phone)
-            pending_phone["phone"] = phone
-            pending_phone["sent_at"] = datetime.utcnow().isoformat()
-            return {"status": "code_sent", "phone": phone}
-        except Exception as e: return {"status": "error", "error": str(e)}
-
-    result = run_coro(_send_code())
+    result = backend_call("login", phone=phone)
     return jsonify(result)
 
 @app.route("/code")
 def code():
     code = request.args.get("code")
     if not code: return jsonify({"error": "Falta parámetro code"}), 400
-    if not pending_phone["phone"]: return jsonify({"error": "No hay login pendiente"}), 400
 
-    phone = pending_phone["phone"]
-    async def _sign_in():
-        try:
-            await client.sign_in(phone, code)
-            await client.start()
-            pending_phone["phone"] = None
-            pending_phone["sent_at"] = None
-            new_string = client.session.save()
-            return {"status": "authenticated", "session_string": new_string}
-        except errors.SessionPasswordNeededError: return {"status": "error", "error": "2FA requerido"}
-        except Exception as e: return {"status": "error", "error": str(e)}
-
-    result = run_coro(_sign_in())
+    result = backend_call("code", code=code)
+    if result is None: return jsonify({"error": "No hay login pendiente"}), 400
     return jsonify(result)
 
 @app.route("/send")
@@ -878,25 +3569,19 @@ def send_msg():
     if not chat_id or not msg:
         return jsonify({"error": "Faltan parámetros"}), 400
 
-    async def _send(): 
-        target = int(chat_id) if chat_id.isdigit() else chat_id
-        entity = await client.get_entity(target)
-        await client.send_message(entity, msg)
-        return {"status": "sent", "to": chat_id, "msg": msg}
     try:
-        result = run_coro(_send())
+        result = backend_call("send", chat_id=chat_id, msg=msg)
         return jsonify(result)
     except Exception as e:
         return jsonify({"status": "error", "error": str(e)}), 500 
 
 @app.route("/get")
 def get_msgs():
-    with _messages_lock:
-        data = list(messages)
-        return jsonify({
-            "message": "found data" if data else "no data",
-            "result": {"quantity": len(data), "coincidences": data},
-        })
+    data = backend_call("get")
+    return jsonify({
+        "message": "found data" if data else "no data",
+        "result": {"quantity": len(data), "coincidences": data},
+    })
 
 @app.route("/files/<path:filename>")
 def files(filename):
@@ -904,77 +3589,72 @@ def files(filename):
     Ruta para descargar archivos. Se añade as_attachment=True para forzar la descarga 
     en lugar de visualizar el archivo, lo que es ideal para appcreator24.
     """
-    return send_from_directory(DOWNLOAD_DIR, filename, as_attachment=True)
+    # Se resuelve una sola vez: nada de lo que sigue (lazy, variantes) debe ver una ruta fuera de DOWNLOAD_DIR
+    filename = resolve_media_filename(filename)
+    if filename is None:
+        return jsonify({"status": "error", "message": "Archivo no encontrado."}), 404
+    width, fmt, error = parse_variant_args(request.args)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    if MEDIA_MODE == "lazy" and not os.path.isfile(os.path.join(DOWNLOAD_DIR, filename)):
+        if width or fmt:
+            # La variante necesita el original completo: se baja de Telegram sin enviarlo
+            for _ in backend_stream("media_stream", filename=filename):
+                pass
+        else:
+            response = _lazy_media_response(filename)
+            if response is not None:
+                return response
+    touch_media_file(filename) # Último acceso para la retención LRU
+    if width or fmt:
+        variant_path = image_variant_path(filename, width, fmt)
+        if variant_path:
+            etag = media_etag(filename)
+            response = send_file(
+                variant_path, as_attachment=True, conditional=True, max_age=FILES_MAX_AGE,
+                etag=f"{etag}-{os.path.basename(variant_path)}" if isinstance(etag, str) else True,
+            )
+            response.headers["Cache-Control"] = FILES_CACHE_CONTROL
+            return response
+    # conditional=True: Range / If-Range / If-None-Match (206 y 304). El cuerpo sale por el
+    # wsgi.file_wrapper del servidor (sendfile en gunicorn) o por X-Sendfile si está activo.
+    response = send_from_directory(
+        DOWNLOAD_DIR, filename, as_attachment=True, conditional=True, etag=media_etag(filename), max_age=FILES_MAX_AGE
+    )
+    response.headers["Cache-Control"] = FILES_CACHE_CONTROL
+    return response
+
+def _lazy_media_response(filename: str):
+    """Respuesta en streaming de un archivo en modo lazy, o None si no está registrado."""
+    events_iter = backend_stream("media_stream", filename=filename)
+    first = next(events_iter, None)
+    if first is None or first[0] != "meta":
+        return None
+    meta = first[1]
+
+    def _chunks():
+        for event, chunk in events_iter:
+            if event == "chunk":
+                yield chunk
+
+    headers = {"Content-Disposition": f'attachment; filename="{os.path.basename(filename)}"', "Cache-Control": FILES_CACHE_CONTROL}
+    if meta["size"]:
+        headers["Content-Length"] = str(meta["size"])
+    return Response(_chunks(), mimetype=meta["mime_type"], headers=headers)
 
 # ----------------------------------------------------------------------
 # --- Rutas HTTP de API (Comandos LEDER DATA) ----------------------------
 # ----------------------------------------------------------------------
 
-# --- 1. Handlers para comandos basados en DNI (8 dígitos) o 1 parámetro simple ---
+# --- Construcción de comandos (compartida por Flask y aiohttp) ---
 
-@app.route("/dni", methods=["GET"])
-@app.route("/dnif", methods=["GET"]) 
-@app.route("/dnidb", methods=["GET"])
-@app.route("/dnifdb", methods=["GET"])
-@app.route("/c4", methods=["GET"])
-@app.route("/dnivaz", methods=["GET"]) 
-@app.route("/dnivam", methods=["GET"])
-@app.route("/dnivel", methods=["GET"])
-@app.route("/dniveln", methods=["GET"])
-@app.route("/fa", methods=["GET"])
-@app.route("/fadb", methods=["GET"])
-@app.route("/fb", methods=["GET"])
-@app.route("/fbdb", methods=["GET"])
-@app.route("/cnv", methods=["GET"])
-@app.route("/cdef", methods=["GET"])
-@app.route("/antpen", methods=["GET"])
-@app.route("/antpol", methods=["GET"])
-@app.route("/antjud", methods=["GET"])
-@app.route("/actancc", methods=["GET"])
-@app.route("/actamcc", methods=["GET"])
-@app.route("/actadcc", methods=["GET"])
-@app.route("/osiptel", methods=["GET"])
-@app.route("/claro", methods=["GET"])
-@app.route("/entel", methods=["GET"])
-@app.route("/pro", methods=["GET"]) # SUNARP
-@app.route("/sen", methods=["GET"]) # SENTINEL
-@app.route("/sbs", methods=["GET"]) # SBS
-@app.route("/tra", methods=["GET"]) # TRABAJOS
-@app.route("/tremp", methods=["GET"]) # TRABAJADORES POR EMPRESA
-@app.route("/sue", methods=["GET"]) # SUELDOS
-@app.route("/cla", methods=["GET"]) # CONSTANCIA DE LOGROS
-@app.route("/sune", methods=["GET"]) # TITULOS UNIVERSITARIOS
-@app.route("/cun", methods=["GET"]) # CARNET UNIVERSITARIO
-@app.route("/colp", methods=["GET"]) # COLEGIADOS
-@app.route("/mine", methods=["GET"]) # TITULOS INSTITUTOS
-@app.route("/pasaporte", methods=["GET"]) # PASAPORTE
-@app.route("/seeker", methods=["GET"]) # SEEKER
-@app.route("/afp", methods=["GET"]) # AFPS
-@app.route("/bdir", methods=["GET"]) # DIRECCION INVERSA
-@app.route("/meta", methods=["GET"]) # METADATA COMPLETA 
-@app.route("/fis", methods=["GET"]) # FISCALIA 
-@app.route("/fisdet", methods=["GET"]) # FISCALIA DETALLADO (Para cubrir tu mención, se envía como comando)
-@app.route("/det", methods=["GET"]) # DETENIDOS 
-@app.route("/rqh", methods=["GET"]) # REQUISITORIAS HISTORICAS 
-@app.route("/antpenv", methods=["GET"]) # ANTECEDENTES PENALES VERIFICADOR
-@app.route("/dend", methods=["GET"]) # DENUNCIAS POLICIALES (DNI)
-@app.route("/dence", methods=["GET"]) # DENUNCIAS POLICIALES (CE) (AGREGADO)
-@app.route("/denpas", methods=["GET"]) # DENUNCIAS POLICIALES (PASAPORTE) (AGREGADO)
-@app.route("/denci", methods=["GET"]) # DENUNCIAS POLICIALES (CEDULA) (AGREGADO)
-@app.route("/denp", methods=["GET"]) # DENUNCIAS POLICIALES (PLACA) (AGREGADO)
-@app.route("/denar", methods=["GET"]) # DENUNCIAS POLICIALES (ARMAMENTO) (AGREGADO)
-@app.route("/dencl", methods=["GET"]) # DENUNCIAS POLICIALES (CLAVE) (AGREGADO)
-@app.route("/agv", methods=["GET"]) # ÁRBOL GENEALÓGICO VISUAL (AGREGADO)
-@app.route("/agvp", methods=["GET"]) # ÁRBOL GENEALÓGICO VISUAL PROFESIONAL (AGREGADO)
-@app.route("/cedula", methods=["GET"]) # VENEZOLANOS CEDULA (AGREGADO)
-def api_dni_based_command():
+def _build_dni_based_command(command_name: str, args) -> tuple[str | None, str | None]:
     """
-    Maneja comandos que solo requieren un DNI o un parámetro simple.
-    El parámetro se espera bajo el nombre 'query'. Para RENIEC es 'dni'.
+    Construye el comando del bot para las rutas de DNI / parámetro simple a partir de los
+    parámetros de la petición ('args' de Flask o 'query' de aiohttp).
+    Devuelve (comando, None) o (None, mensaje de error para un 400).
     """
     
-    command_name = request.path.lstrip('/') 
-    
     # Comandos que esperan DNI de 8 dígitos
     dni_required_commands = [
         "dni", "dnif", "dnidb", "dnifdb", "c4", "dnivaz", "dnivam", "dnivel", "dniveln", 
@@ -998,9 +3678,9 @@ def api_dni_based_command():
     param = ""
 
     if command_name in dni_required_commands:
-        param = request.args.get("dni")
+        param = args.get("dni")
         if not param or not param.isdigit() or len(param) != 8:
-            return jsonify({"status": "error", "message": f"Parámetro 'dni' es requerido y debe ser un número de 8 dígitos para /{command_name}."}), 400
+            return None, f"Parámetro 'dni' es requerido y debe ser un número de 8 dígitos para /{command_name}."
     
     elif command_name in query_required_commands:
         
@@ -1010,85 +3690,63 @@ def api_dni_based_command():
         if command_name == "fisdet":
             # Formato: /fisdet <caso|distritojudicial>
             # Buscamos 'dni' (o caso/distritojudicial) o 'query'
-            param_value = request.args.get("caso") or request.args.get("distritojudicial") or request.args.get("query")
+            param_value = args.get("caso") or args.get("distritojudicial") or args.get("query")
             
             # Si el usuario usa el formato 'dni|detalle' (aunque el nuevo formato pide caso/distrito)
             if not param_value:
-                dni_val = request.args.get("dni")
-                det_val = request.args.get("detalle")
+                dni_val = args.get("dni")
+                det_val = args.get("detalle")
                 if dni_val and det_val:
                     param_value = f"{dni_val}|{det_val}"
                 elif dni_val:
                     param_value = dni_val # Usar solo DNI si detalle no está
         
         elif command_name == "dence":
-            param_value = request.args.get("carnet_extranjeria")
+            param_value = args.get("carnet_extranjeria")
         elif command_name == "denpas":
-            param_value = request.args.get("pasaporte")
+            param_value = args.get("pasaporte")
         elif command_name == "denci":
-            param_value = request.args.get("cedula_identidad")
+            param_value = args.get("cedula_identidad")
         elif command_name == "denp":
-            param_value = request.args.get("placa")
+            param_value = args.get("placa")
         elif command_name == "denar":
-            param_value = request.args.get("serie_armamento")
+            param_value = args.get("serie_armamento")
         elif command_name == "dencl":
-            param_value = request.args.get("clave_denuncia")
+            param_value = args.get("clave_denuncia")
             
         # --- Lógica para otros comandos de query ---
         elif command_name == "cedula":
-            param_value = request.args.get("cedula")
+            param_value = args.get("cedula")
         
         # Si no se encontró el parámetro específico, usamos 'query' (o dni de fallback)
-        param = param_value or request.args.get("dni") or request.args.get("query")
+        param = param_value or args.get("dni") or args.get("query")
              
         if not param:
-            return jsonify({"status": "error", "message": f"Parámetro de consulta es requerido para /{command_name}."}), 400
+            return None, f"Parámetro de consulta es requerido para /{command_name}."
     
     elif command_name in optional_commands:
-        param_dni = request.args.get("dni")
-        param_query = request.args.get("query")
-        param_pasaporte = request.args.get("pasaporte") if command_name == "pasaporte" else None
+        param_dni = args.get("dni")
+        param_query = args.get("query")
+        param_pasaporte = args.get("pasaporte") if command_name == "pasaporte" else None
         
         param = param_dni or param_query or param_pasaporte or ""
         
     else:
         # En caso de que se añadan nuevos comandos no cubiertos por DNI o Query
-        param = request.args.get("dni") or request.args.get("query") or ""
+        param = args.get("dni") or args.get("query") or ""
 
         
     # Construir comando
-    command = f"/{command_name} {param}".strip() # strip() elimina espacio si param está vacío
-    
-    # Ejecutar comando
-    try:
-        # Usamos el timeout de failover para el bot principal. El de respaldo usará TIMEOUT_TOTAL
-        result = run_coro(_call_api_command(command, timeout=TIMEOUT_FAILOVER))
-        
-        if result.get("status", "").startswith("error"):
-            # Si el error es un timeout o de telethon, devolvemos 500, sino 400
-            is_timeout_or_connection_error = "timeout" in result.get("message", "").lower() or "telethon" in result.get("message", "").lower() or result.get("status") == "error_timeout"
-            status_code = 500 if is_timeout_or_connection_error else 400
-            # Mantenemos la estructura de respuesta de error simple
-            result.pop("bot_used", None)
-            return jsonify(result), status_code
-            
-        # Si es exitoso, el JSON ya viene en el formato esperado
-        return jsonify(result)
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Error interno: {str(e)}"}), 500
-
-# --- 2. Handler dedicado para Nombres (Formato complejo) ---
-
-@app.route("/dni_nombres", methods=["GET"])
-def api_dni_nombres():
-    """Maneja la consulta por nombres: /nm nombres(s)|apellidopaterno|apellidomaterno"""
+    return f"/{command_name} {param}".strip(), None # strip() elimina espacio si param está vacío
     
-    nombres = unquote(request.args.get("nombres", "")).strip()
-    ape_paterno = unquote(request.args.get("apepaterno", "")).strip()
-    ape_materno = unquote(request.args.get("apematerno", "")).strip()
+def _build_nombres_command(args) -> tuple[str | None, str | None]:
+    """Comando /nm nombres(s)|apellidopaterno|apellidomaterno a partir de los parámetros de la petición."""
+    nombres = unquote(args.get("nombres", "")).strip()
+    ape_paterno = unquote(args.get("apepaterno", "")).strip()
+    ape_materno = unquote(args.get("apematerno", "")).strip()
 
     if not ape_paterno or not ape_materno:
-        return jsonify({"status": "error", "message": "Faltan parámetros: 'apepaterno' y 'apematerno' son obligatorios."}), 400
+        return None, "Faltan parámetros: 'apepaterno' y 'apematerno' son obligatorios."
 
     # 1. Formatear Nombres: reemplazar espacios con "," (si hay más de 1 palabra)
     formatted_nombres = nombres.replace(" ", ",")
@@ -1098,16 +3756,156 @@ def api_dni_nombres():
     formatted_apematerno = ape_materno.replace(" ", "+")
 
     # 3. Construir comando
-    command = f"/nm {formatted_nombres}|{formatted_apepaterno}|{formatted_apematerno}"
+    return f"/nm {formatted_nombres}|{formatted_apepaterno}|{formatted_apematerno}", None
+
+def _build_venezolanos_nombres_command(args) -> tuple[str | None, str | None]:
+    """Comando /nmv <nombres_apellidos> a partir de los parámetros de la petición."""
+    query = unquote(args.get("query", "")).strip()
+    
+    if not query:
+        return None, "Parámetro 'query' (nombres_apellidos) es requerido para /venezolanos_nombres."
+
+    # Se asume que /nmv toma una cadena simple de nombres/apellidos
+    return f"/nmv {query}", None
+
+def _dni_based_routes() -> set:
+    """Rutas de comandos simples: las que registran los decoradores de api_dni_based_command."""
+    return {rule.rule for rule in app.url_map.iter_rules() if rule.endpoint == "api_dni_based_command"}
+
+def _build_command_for_route(route_name: str, args) -> tuple[str | None, str | None]:
+    """Comando del bot para cualquier ruta de consulta (ej: 'dni', 'c4', 'dni_nombres') con sus parámetros."""
+    if route_name == "dni_nombres":
+        return _build_nombres_command(args)
+    if route_name == "venezolanos_nombres":
+        return _build_venezolanos_nombres_command(args)
+    if f"/{route_name}" in _dni_based_routes():
+        return _build_dni_based_command(route_name, args)
+    return None, f"Comando no soportado: '{route_name}'."
+
+def _merge_request_params(*sources) -> dict:
+    """Une los parámetros de query, formulario y cuerpo JSON (el último gana), como cadenas."""
+    params = {}
+    for source in sources:
+        if source:
+            params.update({key: str(value) for key, value in source.items()})
+    return params
+
+def _prepare_job(params: dict) -> tuple[str | None, str | None]:
+    """
+    Valida una petición de trabajo: devuelve (comando, None) o (None, mensaje de error para un 400).
+    Bloqueante (resuelve el host de callback_url): en aiohttp se llama en un executor.
+    """
+    callback_url = params.get("callback_url")
+    if callback_url:
+        error = check_callback_url(callback_url)
+        if error:
+            return None, error
+    route_name = params.get("command", "").strip().lstrip("/")
+    if not route_name:
+        return None, "Parámetro 'command' es requerido (ej: dni, c4, dni_nombres)."
+    return _build_command_for_route(route_name, params)
+
+def _result_to_http(result: dict) -> tuple[dict, int]:
+    """Código HTTP de la respuesta de un comando: 200, o 500/400 para errores (timeout/Telethon vs. resto)."""
+    if result.get("status", "").startswith("error"):
+        # Si el error es un timeout o de telethon, devolvemos 500, sino 400
+        is_timeout_or_connection_error = "timeout" in result.get("message", "").lower() or "telethon" in result.get("message", "").lower() or result.get("status") == "error_timeout"
+        status_code = 500 if is_timeout_or_connection_error else 400
+        # Mantenemos la estructura de respuesta de error simple
+        result.pop("bot_used", None)
+        return result, status_code
+        
+    # Si es exitoso, el JSON ya viene en el formato esperado
+    return result, 200
+
+# --- 1. Handlers para comandos basados en DNI (8 dígitos) o 1 parámetro simple ---
+
+@app.route("/dni", methods=["GET"])
+@app.route("/dnif", methods=["GET"]) 
+@app.route("/dnidb", methods=["GET"])
+@app.route("/dnifdb", methods=["GET"])
+@app.route("/c4", methods=["GET"])
+@app.route("/dnivaz", methods=["GET"]) 
+@app.route("/dnivam", methods=["GET"])
+@app.route("/dnivel", methods=["GET"])
+@app.route("/dniveln", methods=["GET"])
+@app.route("/fa", methods=["GET"])
+@app.route("/fadb", methods=["GET"])
+@app.route("/fb", methods=["GET"])
+@app.route("/fbdb", methods=["GET"])
+@app.route("/cnv", methods=["GET"])
+@app.route("/cdef", methods=["GET"])
+@app.route("/antpen", methods=["GET"])
+@app.route("/antpol", methods=["GET"])
+@app.route("/antjud", methods=["GET"])
+@app.route("/actancc", methods=["GET"])
+@app.route("/actamcc", methods=["GET"])
+@app.route("/actadcc", methods=["GET"])
+@app.route("/osiptel", methods=["GET"])
+@app.route("/claro", methods=["GET"])
+@app.route("/entel", methods=["GET"])
+@app.route("/pro", methods=["GET"]) # SUNARP
+@app.route("/sen", methods=["GET"]) # SENTINEL
+@app.route("/sbs", methods=["GET"]) # SBS
+@app.route("/tra", methods=["GET"]) # TRABAJOS
+@app.route("/tremp", methods=["GET"]) # TRABAJADORES POR EMPRESA
+@app.route("/sue", methods=["GET"]) # SUELDOS
+@app.route("/cla", methods=["GET"]) # CONSTANCIA DE LOGROS
+@app.route("/sune", methods=["GET"]) # TITULOS UNIVERSITARIOS
+@app.route("/cun", methods=["GET"]) # CARNET UNIVERSITARIO
+@app.route("/colp", methods=["GET"]) # COLEGIADOS
+@app.route("/mine", methods=["GET"]) # TITULOS INSTITUTOS
+@app.route("/pasaporte", methods=["GET"]) # PASAPORTE
+@app.route("/seeker", methods=["GET"]) # SEEKER
+@app.route("/afp", methods=["GET"]) # AFPS
+@app.route("/bdir", methods=["GET"]) # DIRECCION INVERSA
+@app.route("/meta", methods=["GET"]) # METADATA COMPLETA 
+@app.route("/fis", methods=["GET"]) # FISCALIA 
+@app.route("/fisdet", methods=["GET"]) # FISCALIA DETALLADO (Para cubrir tu mención, se envía como comando)
+@app.route("/det", methods=["GET"]) # DETENIDOS 
+@app.route("/rqh", methods=["GET"]) # REQUISITORIAS HISTORICAS 
+@app.route("/antpenv", methods=["GET"]) # ANTECEDENTES PENALES VERIFICADOR
+@app.route("/dend", methods=["GET"]) # DENUNCIAS POLICIALES (DNI)
+@app.route("/dence", methods=["GET"]) # DENUNCIAS POLICIALES (CE) (AGREGADO)
+@app.route("/denpas", methods=["GET"]) # DENUNCIAS POLICIALES (PASAPORTE) (AGREGADO)
+@app.route("/denci", methods=["GET"]) # DENUNCIAS POLICIALES (CEDULA) (AGREGADO)
+@app.route("/denp", methods=["GET"]) # DENUNCIAS POLICIALES (PLACA) (AGREGADO)
+@app.route("/denar", methods=["GET"]) # DENUNCIAS POLICIALES (ARMAMENTO) (AGREGADO)
+@app.route("/dencl", methods=["GET"]) # DENUNCIAS POLICIALES (CLAVE) (AGREGADO)
+@app.route("/agv", methods=["GET"]) # ÁRBOL GENEALÓGICO VISUAL (AGREGADO)
+@app.route("/agvp", methods=["GET"]) # ÁRBOL GENEALÓGICO VISUAL PROFESIONAL (AGREGADO)
+@app.route("/cedula", methods=["GET"]) # VENEZOLANOS CEDULA (AGREGADO)
+def api_dni_based_command():
+    """
+    Maneja comandos que solo requieren un DNI o un parámetro simple.
+    El parámetro se espera bajo el nombre 'query'. Para RENIEC es 'dni'.
+    """
+    command, error = _build_dni_based_command(request.path.lstrip('/'), request.args)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
     
-    # 4. Ejecutar comando
+    # Ejecutar comando
     try:
-        result = run_coro(_call_api_command(command, timeout=TIMEOUT_FAILOVER))
-        if result.get("status", "").startswith("error"):
-            is_timeout_or_connection_error = "timeout" in result.get("message", "").lower() or "telethon" in result.get("message", "").lower() or result.get("status") == "error_timeout"
-            result.pop("bot_used", None)
-            return jsonify(result), 500 if is_timeout_or_connection_error else 400
-        return jsonify(result)
+        # Usamos el timeout de failover para el bot principal. El de respaldo usará TIMEOUT_TOTAL
+        result = backend_call("command", command=command, timeout=TIMEOUT_FAILOVER, use_cache=request.args.get("nocache") != "1")
+        payload, status_code = _result_to_http(result)
+        return jsonify(payload), status_code
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error interno: {str(e)}"}), 500
+
+# --- 2. Handler dedicado para Nombres (Formato complejo) ---
+
+@app.route("/dni_nombres", methods=["GET"])
+def api_dni_nombres():
+    """Maneja la consulta por nombres: /nm nombres(s)|apellidopaterno|apellidomaterno"""
+    command, error = _build_nombres_command(request.args)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    
+    try:
+        result = backend_call("command", command=command, timeout=TIMEOUT_FAILOVER, use_cache=request.args.get("nocache") != "1")
+        payload, status_code = _result_to_http(result)
+        return jsonify(payload), status_code
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error interno: {str(e)}"}), 500
 
@@ -1116,40 +3914,361 @@ def api_dni_nombres():
 @app.route("/venezolanos_nombres", methods=["GET"])
 def api_venezolanos_nombres():
     """Maneja la consulta por nombres venezolanos: /nmv <nombres_apellidos>"""
-    
-    query = unquote(request.args.get("query", "")).strip()
-    
-    if not query:
-        return jsonify({"status": "error", "message": "Parámetro 'query' (nombres_apellidos) es requerido para /venezolanos_nombres."}), 400
-
-    # Se asume que /nmv toma una cadena simple de nombres/apellidos
-    command = f"/nmv {query}"
+    command, error = _build_venezolanos_nombres_command(request.args)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
     
     try:
-        result = run_coro(_call_api_command(command, timeout=TIMEOUT_FAILOVER))
-        if result.get("status", "").startswith("error"):
-            is_timeout_or_connection_error = "timeout" in result.get("message", "").lower() or "telethon" in result.get("message", "").lower() or result.get("status") == "error_timeout"
-            result.pop("bot_used", None)
-            return jsonify(result), 500 if is_timeout_or_connection_error else 400
-        return jsonify(result)
+        result = backend_call("command", command=command, timeout=TIMEOUT_FAILOVER, use_cache=request.args.get("nocache") != "1")
+        payload, status_code = _result_to_http(result)
+        return jsonify(payload), status_code
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error interno: {str(e)}"}), 500
         
+# --- 4. Trabajos asíncronos (consulta en segundo plano + sondeo o webhook) ---
+
+@app.route("/jobs", methods=["POST"])
+def api_job_submit():
+    """
+    Crea un trabajo para cualquier ruta de consulta y responde de inmediato con su job_id.
+    'command' es el nombre de la ruta (ej: dni, c4, dni_nombres) y el resto son sus parámetros
+    habituales (en query, formulario o JSON). 'callback_url' (opcional) recibe el resultado final.
+    """
+    body = request.get_json(silent=True)
+    params = _merge_request_params(request.args, request.form, body if isinstance(body, dict) else None)
+    command, error = _prepare_job(params)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    try:
+        job = backend_call("job_submit", command=command, callback_url=params.get("callback_url"), use_cache=params.get("nocache") != "1")
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error interno: {str(e)}"}), 500
+    if job is None:
+        return jsonify({"status": "error", "message": "Demasiados trabajos en curso. Intente más tarde."}), 503
+    job["status_url"] = f"{PUBLIC_URL}/jobs/{job['job_id']}"
+    return jsonify(job), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def api_job_status(job_id):
+    """Estado de un trabajo; incluye 'result' y 'http_status' cuando ya terminó."""
+    job = backend_call("job_status", job_id=job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Trabajo no encontrado o expirado."}), 404
+    return jsonify(job)
+
+# --- 5. Streaming de resultados parciales (Server-Sent Events) ---
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} # Sin buffers de proxy
+
+@app.route("/stream/<route_name>", methods=["GET"])
+def api_stream_command(route_name):
+    """
+    Variante en streaming de las rutas de consulta (ej: /stream/dni?dni=12345678): un evento
+    'message' por cada mensaje del bot apenas llega y un evento 'result' con el JSON consolidado.
+    """
+    command, error = _build_command_for_route(route_name, request.args)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    use_cache = request.args.get("nocache") != "1"
+
+    def _events():
+        for event, data in backend_stream("command_stream", command=command, use_cache=use_cache):
+            yield _sse_event(event, data)
+
+    return Response(_events(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+# --- 6. Consultas en lote (NDJSON en orden de finalización) ---
+
+@app.route("/batch", methods=["POST"])
+def api_batch():
+    """
+    Lote de consultas de un mismo comando: {"command": "dni", "params": ["12345678", ...]}.
+    Responde NDJSON: una línea por parámetro a medida que termina (las de validación primero)
+    y una última línea {"done": true, ...} con el resumen.
+    """
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    items, error = _prepare_batch(data)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    commands = [item["command"] for item in items]
+    use_cache = not data.get("nocache") and request.args.get("nocache") != "1"
+
+    def _lines():
+        yield _batch_invalid_lines(items)
+        # Sin límite entre líneas: cada consulta del lote ya tiene sus propios plazos
+        for event, event_data in backend_stream("batch_stream", idle_timeout=None, commands=commands, use_cache=use_cache):
+            yield _batch_event_lines(items, event, event_data)
+
+    return Response(_lines(), mimetype="application/x-ndjson", headers=SSE_HEADERS)
+
 # ----------------------------------------------------------------------
-# --- Inicio de la Aplicación ------------------------------------------
+# --- Servidor HTTP nativo (aiohttp) sobre el bucle de Telethon ---------
 # ----------------------------------------------------------------------
 
-if __name__ == "__main__":
+# Mismas rutas y respuestas que la app Flask (SERVER_MODE=aiohttp). Los handlers corren en el
+# bucle de Telethon, así que esperan al bot con 'await' en lugar de bloquear un hilo en run_coro.
+
+@web.middleware
+async def _cors_middleware(request, handler):
+    response = await handler(request)
+    if not response.prepared: # Los streams (SSE) ya enviaron sus cabeceras
+        response.headers["Access-Control-Allow-Origin"] = "*" # Equivalente a CORS(app) en Flask
+    return response
+
+async def _aio_root(request):
+    return web.json_response({
+        "status": "ok",
+        "message": "Gateway API para LEDER DATA Bot activo. Consulta /status para la sesión.",
+    })
+
+async def _aio_status(request):
     try:
-        run_coro(client.connect())
-        # Intentar iniciar la sesión (si es persistente)
-        if not run_coro(client.is_user_authorized()):
-             run_coro(client.start())
-             
-        # Esto ayuda a Telethon a resolver la entidad de ambos bots al inicio
-        run_coro(client.get_entity(LEDERDATA_BOT_ID)) 
-        run_coro(client.get_entity(LEDERDATA_BACKUP_BOT_ID)) 
+        data = await backend_call_async("status")
+    except Exception as e:
+        return web.json_response({"authorized": False, "gateway_role": GATEWAY_ROLE, "error": str(e)}, status=503)
+    data["gateway_role"] = GATEWAY_ROLE
+    return web.json_response(data)
+
+async def _aio_profiles(request):
+    return web.json_response({"profiles": await backend_call_async("profiles")})
+
+async def _aio_login(request):
+    phone = request.query.get("phone")
+    if not phone: return web.json_response({"error": "Falta parámetro phone"}, status=400)
+    return web.json_response(await backend_call_async("login", phone=phone))
+
+async def _aio_code(request):
+    code = request.query.get("code")
+    if not code: return web.json_response({"error": "Falta parámetro code"}, status=400)
+    result = await backend_call_async("code", code=code)
+    if result is None: return web.json_response({"error": "No hay login pendiente"}, status=400)
+    return web.json_response(result)
+
+async def _aio_send(request):
+    chat_id = request.query.get("chat_id")
+    msg = request.query.get("msg")
+    if not chat_id or not msg:
+        return web.json_response({"error": "Faltan parámetros"}, status=400)
+    try:
+        return web.json_response(await backend_call_async("send", chat_id=chat_id, msg=msg))
+    except Exception as e:
+        return web.json_response({"status": "error", "error": str(e)}, status=500)
+
+async def _aio_get(request):
+    data = await backend_call_async("get")
+    return web.json_response({
+        "message": "found data" if data else "no data",
+        "result": {"quantity": len(data), "coincidences": data},
+    })
+
+def _etag_matches(etag: str, if_none_match: str | None) -> bool:
+    """If-None-Match con comparación débil, como Werkzeug: lista de ETags o '*'."""
+    for candidate in (if_none_match or "").split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/").strip('"') == etag:
+            return True
+    return False
+
+async def _aio_set_media_etag(request, response):
+    """FileResponse pone su propio ETag (mtime + tamaño): /files publica el de media_etag, como en Flask."""
+    etag = request.get("media_etag")
+    if etag and response.status in (200, 206, 304):
+        response.etag = etag
+
+async def _aio_files(request):
+    """Igual que /files en Flask: descarga forzada (as_attachment) y sin salir de DOWNLOAD_DIR."""
+    # resolve_media_filename, isfile y touch_media_file tocan el disco: fuera del bucle
+    filename = await loop.run_in_executor(None, resolve_media_filename, request.match_info["filename"])
+    if filename is None:
+        raise web.HTTPNotFound()
+    path = os.path.join(DOWNLOAD_DIR, filename)
+    width, fmt, error = parse_variant_args(request.query)
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    if not await loop.run_in_executor(None, os.path.isfile, path):
+        if MEDIA_MODE == "lazy":
+            if width or fmt:
+                # La variante necesita el original completo: se baja de Telegram sin enviarlo
+                async for _ in backend_stream_async("media_stream", filename=filename):
+                    pass
+            else:
+                response = await _aio_lazy_media_response(request, filename)
+                if response is not None:
+                    return response
+        if not await loop.run_in_executor(None, os.path.isfile, path):
+            raise web.HTTPNotFound()
+    await loop.run_in_executor(None, touch_media_file, filename) # Último acceso para la retención LRU
+    etag = media_etag(filename)
+    if width or fmt:
+        variant_path = await loop.run_in_executor(None, image_variant_path, filename, width, fmt)
+        if variant_path:
+            path = variant_path
+            etag = f"{etag}-{os.path.basename(variant_path)}" if isinstance(etag, str) else True
+    headers = {"Content-Disposition": f'attachment; filename="{os.path.basename(path)}"', "Cache-Control": FILES_CACHE_CONTROL}
+    if isinstance(etag, str):
+        # Mismo ETag y mismo 304 que Flask; con True queda el ETag propio de FileResponse
+        if _etag_matches(etag, request.headers.get("If-None-Match")):
+            response = web.Response(status=304, headers={"Cache-Control": FILES_CACHE_CONTROL})
+            response.etag = etag
+            return response
+        request["media_etag"] = etag # Lo aplica _aio_set_media_etag al enviar las cabeceras
+    # FileResponse usa sendfile y atiende Range
+    return web.FileResponse(path, headers=headers)
+
+async def _aio_lazy_media_response(request, filename: str):
+    """Streaming de un archivo en modo lazy, o None si no está registrado."""
+    response = None
+    async for event, data in backend_stream_async("media_stream", filename=filename):
+        if event == "meta":
+            headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": FILES_CACHE_CONTROL, "Access-Control-Allow-Origin": "*"}
+            if data["size"]:
+                headers["Content-Length"] = str(data["size"])
+            response = web.StreamResponse(headers={**headers, "Content-Type": data["mime_type"]})
+            await response.prepare(request)
+        elif event == "chunk" and response is not None:
+            await response.write(data)
+    return response
+
+async def _aio_run_command(command: str, request) -> web.Response:
+    try:
+        result = await backend_call_async("command", command=command, timeout=TIMEOUT_FAILOVER, use_cache=request.query.get("nocache") != "1")
+        payload, status_code = _result_to_http(result)
+        return web.json_response(payload, status=status_code)
+    except Exception as e:
+        return web.json_response({"status": "error", "message": f"Error interno: {str(e)}"}, status=500)
+
+async def _aio_dni_based_command(request):
+    command, error = _build_dni_based_command(request.path.lstrip('/'), request.query)
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    return await _aio_run_command(command, request)
+
+async def _aio_dni_nombres(request):
+    command, error = _build_nombres_command(request.query)
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    return await _aio_run_command(command, request)
+
+async def _aio_venezolanos_nombres(request):
+    command, error = _build_venezolanos_nombres_command(request.query)
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    return await _aio_run_command(command, request)
+
+async def _aio_job_submit(request):
+    body = None
+    if request.content_type == "application/json":
+        try:
+            body = await request.json()
+        except ValueError: # JSON inválido (json.JSONDecodeError): como get_json(silent=True) en Flask
+            body = None
+    params = _merge_request_params(request.query, await request.post(), body if isinstance(body, dict) else None)
+    command, error = await loop.run_in_executor(None, _prepare_job, params)
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    try:
+        job = await backend_call_async("job_submit", command=command, callback_url=params.get("callback_url"), use_cache=params.get("nocache") != "1")
+    except Exception as e:
+        return web.json_response({"status": "error", "message": f"Error interno: {str(e)}"}, status=500)
+    if job is None:
+        return web.json_response({"status": "error", "message": "Demasiados trabajos en curso. Intente más tarde."}, status=503)
+    job["status_url"] = f"{PUBLIC_URL}/jobs/{job['job_id']}"
+    return web.json_response(job, status=202)
+
+async def _aio_job_status(request):
+    job = await backend_call_async("job_status", job_id=request.match_info["job_id"])
+    if job is None:
+        return web.json_response({"status": "error", "message": "Trabajo no encontrado o expirado."}, status=404)
+    return web.json_response(job)
+
+async def _aio_stream_command(request):
+    command, error = _build_command_for_route(request.match_info["route_name"], request.query)
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    response = web.StreamResponse(headers={**SSE_HEADERS, "Content-Type": "text/event-stream", "Access-Control-Allow-Origin": "*"})
+    await response.prepare(request)
+    async for event, data in backend_stream_async("command_stream", command=command, use_cache=request.query.get("nocache") != "1"):
+        await response.write(_sse_event(event, data).encode())
+    return response
+
+async def _aio_batch(request):
+    try:
+        data = await request.json()
     except Exception:
-        pass
-    print(f"🚀 App corriendo en http://0.0.0.0:{PORT}")
-    app.run(host="0.0.0.0", port=PORT, threaded=True)
+        data = {}
+    items, error = _prepare_batch(data if isinstance(data, dict) else {})
+    if error:
+        return web.json_response({"status": "error", "message": error}, status=400)
+    commands = [item["command"] for item in items]
+    use_cache = not data.get("nocache") and request.query.get("nocache") != "1"
+    response = web.StreamResponse(headers={**SSE_HEADERS, "Content-Type": "application/x-ndjson", "Access-Control-Allow-Origin": "*"})
+    await response.prepare(request)
+    await response.write(_batch_invalid_lines(items).encode())
+    async for event, event_data in backend_stream_async("batch_stream", commands=commands, use_cache=use_cache):
+        await response.write(_batch_event_lines(items, event, event_data).encode())
+    return response
+
+def create_aiohttp_app() -> web.Application:
+    aio_app = web.Application(middlewares=[_cors_middleware])
+    aio_app.on_response_prepare.append(_aio_set_media_etag)
+    aio_app.router.add_get("/", _aio_root)
+    aio_app.router.add_get("/status", _aio_status)
+    aio_app.router.add_get("/profiles", _aio_profiles)
+    aio_app.router.add_get("/login", _aio_login)
+    aio_app.router.add_get("/code", _aio_code)
+    aio_app.router.add_get("/send", _aio_send)
+    aio_app.router.add_get("/get", _aio_get)
+    aio_app.router.add_get("/files/{filename:.+}", _aio_files)
+    # Las rutas de comandos son las mismas que registran los decoradores de api_dni_based_command
+    for route in sorted(_dni_based_routes()):
+        aio_app.router.add_get(route, _aio_dni_based_command)
+    aio_app.router.add_get("/dni_nombres", _aio_dni_nombres)
+    aio_app.router.add_get("/venezolanos_nombres", _aio_venezolanos_nombres)
+    aio_app.router.add_post("/jobs", _aio_job_submit)
+    aio_app.router.add_get("/jobs/{job_id}", _aio_job_status)
+    aio_app.router.add_get("/stream/{route_name}", _aio_stream_command)
+    aio_app.router.add_post("/batch", _aio_batch)
+    return aio_app
+
+async def _start_aiohttp_server():
+    runner = web.AppRunner(create_aiohttp_app())
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    return runner
+
+# ----------------------------------------------------------------------
+# --- Inicio de la Aplicación ------------------------------------------
+# ----------------------------------------------------------------------
+
+if __name__ == "__main__":
+    if GATEWAY_ROLE != "worker":
+        try:
+            run_coro(client.connect())
+            # Intentar iniciar la sesión (si es persistente)
+            if not run_coro(client.is_user_authorized()):
+                 run_coro(client.start())
+        except Exception:
+            pass
+        for _account in accounts:
+            try:
+                if not _account["client"].is_connected():
+                    run_coro(_account["client"].connect())
+                # Esto ayuda a Telethon a resolver la entidad de todos los bots del pool al inicio
+                for bot_id in ALL_BOT_IDS:
+                    run_coro(_account["client"].get_entity(bot_id)) 
+            except Exception:
+                pass
+
+    if GATEWAY_ROLE == "broker":
+        run_coro(_start_broker_server())
+        print(f"🛰️ Broker de Telegram escuchando en {BROKER_SOCKET}")
+        # Todo el trabajo corre en el hilo del bucle de Telethon; el hilo principal solo espera
+        threading.Event().wait()
+    elif SERVER_MODE == "aiohttp":
+        run_coro(_start_aiohttp_server())
+        print(f"🚀 App (aiohttp) corriendo en http://0.0.0.0:{PORT}")
+        threading.Event().wait()
+    else:
+        print(f"🚀 App corriendo en http://0.0.0.0:{PORT}")
+        app.run(host="0.0.0.0", port=PORT, threaded=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los tests importan main.py desde la raíz del repositorio (igual que benchmarks/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,49 @@
+import time
+
+import main
+
+
+def test_backend_stream_waits_for_a_slow_consumer(monkeypatch):
+    produced = []
+
+    async def _many_chunks():
+        for index in range(50):
+            produced.append(index)
+            yield "chunk", index
+
+    monkeypatch.setattr(main, "GATEWAY_ROLE", "standalone")
+    monkeypatch.setitem(main.BACKEND_STREAM_OPS, "test_stream", _many_chunks)
+
+    received = []
+    for event, data in main.backend_stream("test_stream", idle_timeout=5):
+        received.append(data)
+        time.sleep(0.01) # Consumidor lento
+        # El productor nunca se adelanta más que el búfer (más el evento que tiene en la mano)
+        assert len(produced) - len(received) <= main.BACKEND_STREAM_BUFFER + 1
+
+    assert received == list(range(50))
+
+
+def test_backend_stream_stops_the_producer_when_the_consumer_leaves(monkeypatch):
+    produced = []
+
+    async def _endless_chunks():
+        index = 0
+        while True:
+            produced.append(index)
+            yield "chunk", index
+            index += 1
+
+    monkeypatch.setattr(main, "GATEWAY_ROLE", "standalone")
+    monkeypatch.setitem(main.BACKEND_STREAM_OPS, "test_stream", _endless_chunks)
+
+    events_iter = main.backend_stream("test_stream", idle_timeout=5)
+    for _ in range(3):
+        next(events_iter)
+    events_iter.close()
+    time.sleep(0.1)
+    stopped_at = len(produced)
+    time.sleep(0.1)
+
+    assert stopped_at == len(produced)
+    assert stopped_at <= 3 + main.BACKEND_STREAM_BUFFER + 1
@@ -0,0 +1,32 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("width", ["²", "٣", "-5", "0", "12px", ""])
+def test_parse_variant_args_rejects_non_ascii_or_invalid_widths(width):
+    _, _, error = main.parse_variant_args({"w": width})
+    assert error is not None
+
+
+def test_parse_variant_args_rounds_up_to_an_allowed_width():
+    assert main.parse_variant_args({"w": "100", "format": "WEBP"}) == (128, "webp", None)
+
+
+def test_variants_of_same_stem_different_extension_do_not_collide(tmp_path, monkeypatch):
+    if main.Image is None:
+        pytest.skip("Pillow no está instalado")
+    download_dir, variants_dir = tmp_path / "downloads", tmp_path / "variants"
+    download_dir.mkdir()
+    variants_dir.mkdir()
+    monkeypatch.setattr(main, "DOWNLOAD_DIR", str(download_dir))
+    monkeypatch.setattr(main, "VARIANTS_DIR", str(variants_dir))
+    main.Image.new("RGB", (300, 200), "red").save(download_dir / "x.jpg")
+    main.Image.new("RGB", (300, 200), "blue").save(download_dir / "x.png")
+
+    jpg_variant = main.image_variant_path("x.jpg", 128, "webp")
+    png_variant = main.image_variant_path("x.png", 128, "webp")
+
+    assert jpg_variant and png_variant and jpg_variant != png_variant
+    with main.Image.open(jpg_variant) as jpg_image, main.Image.open(png_variant) as png_image:
+        assert jpg_image.convert("RGB").getpixel((0, 0)) != png_image.convert("RGB").getpixel((0, 0))
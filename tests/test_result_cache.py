@@ -0,0 +1,36 @@
+import main
+
+
+def _cached_result(monkeypatch, tmp_path, checks):
+    monkeypatch.setattr(main, "CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "DOWNLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "_result_cache", main.OrderedDict())
+    (tmp_path / "photo_1.jpg").write_bytes(b"jpg")
+    original_check = main._result_files_exist
+
+    def _counting_check(result):
+        checks.append(result)
+        return original_check(result)
+
+    monkeypatch.setattr(main, "_result_files_exist", _counting_check)
+    main.cache_put("/dni 45678912", {"status": "ok", "urls": {"FOTO": f"{main.PUBLIC_URL}/files/photo_1.jpg"}})
+
+
+def test_file_check_is_cached_with_the_entry(monkeypatch, tmp_path):
+    checks = []
+    _cached_result(monkeypatch, tmp_path, checks)
+    monkeypatch.setattr(main, "CACHE_FILES_CHECK_SECONDS", 60)
+
+    assert main.cache_get("/dni 45678912") is not None
+    assert main.cache_get("/dni 45678912") is not None
+    assert len(checks) == 1
+
+
+def test_missing_file_invalidates_the_entry(monkeypatch, tmp_path):
+    checks = []
+    _cached_result(monkeypatch, tmp_path, checks)
+    monkeypatch.setattr(main, "CACHE_FILES_CHECK_SECONDS", 0)
+    (tmp_path / "photo_1.jpg").unlink()
+
+    assert main.cache_get("/dni 45678912") is None
+    assert "/dni 45678912" not in main._result_cache
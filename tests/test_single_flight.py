@@ -0,0 +1,31 @@
+import asyncio
+
+import main
+
+
+def test_follower_gets_the_result_when_the_leader_is_cancelled(monkeypatch):
+    upstream_calls = []
+
+    async def _slow_upstream(command, timeout, priority):
+        upstream_calls.append(command)
+        await asyncio.sleep(0.2)
+        return {"status": "ok", "command": command}
+
+    monkeypatch.setattr(main, "_call_api_command_upstream", _slow_upstream)
+    monkeypatch.setattr(main, "cache_put", lambda command, result: None)
+
+    async def _scenario():
+        leader = asyncio.ensure_future(main._call_api_command("/dni 45678912", use_cache=False))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(main._call_api_command("/dni 45678912", use_cache=False))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        result = await follower
+        return leader, result
+
+    leader, result = asyncio.run_coroutine_threadsafe(_scenario(), main.loop).result(timeout=5)
+
+    assert leader.cancelled()
+    assert result == {"status": "ok", "command": "/dni 45678912"}
+    assert upstream_calls == ["/dni 45678912"]
+    assert main._inflight_commands == {}
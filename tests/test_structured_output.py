@@ -0,0 +1,26 @@
+import main
+
+
+def _routed_commands() -> set:
+    """Nombres de comando que envía alguna ruta HTTP registrada."""
+    commands = {route.lstrip("/") for route in main._dni_based_routes()}
+    for route_name, args in (
+        ("dni_nombres", {"nombres": "JUAN", "apepaterno": "QUISPE", "apematerno": "MAMANI"}),
+        ("venezolanos_nombres", {"query": "MARIA PEREZ"}),
+    ):
+        command, error = main._build_command_for_route(route_name, args)
+        assert error is None
+        commands.add(command.split(" ")[0].lstrip("/"))
+    return commands
+
+
+def test_every_structured_family_command_has_a_route():
+    assert set(main.STRUCTURED_FAMILY_BY_COMMAND) <= _routed_commands()
+
+
+def test_list_families_are_known():
+    assert set(main.STRUCTURED_LIST_FAMILIES) <= set(main.STRUCTURED_FAMILY_BY_COMMAND.values())
+
+
+def test_cedula_family_matches_save_tipo():
+    assert main.STRUCTURED_FAMILY_BY_COMMAND["cedula"] == main._SAVE_BY_PARAM["cedula"][0]